@@ -23,12 +23,13 @@ def create_app(config_class=Config):
     login_manager.login_message = 'Please log in to access this page.'
     login_manager.login_message_category = 'info'
 
-    # Import models here to avoid circular imports
-    from app.models import User
+    # Session users come from the identity cache (app/identity.py)
+    from app.identity import identity_cache
+    identity_cache.init_app(app)
 
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        return identity_cache.load(int(user_id))
 
     # Register Blueprints
     from app.main import bp as main_bp
@@ -49,10 +50,90 @@ def create_app(config_class=Config):
     from app.profile import bp as profile_bp
     app.register_blueprint(profile_bp, url_prefix='/profile')
 
+    # Uploaded media with ranges, sendfile offload and long-lived caching
+    from app.media import bp as media_bp
+    app.register_blueprint(media_bp)
+
+    from app.uploads import bp as uploads_bp
+    app.register_blueprint(uploads_bp, url_prefix='/api/uploads')
+
     # Import and register new api_bp blueprint for messaging API routes
     from app.messages.api_routes import api_bp
     app.register_blueprint(api_bp, url_prefix='/messages/api')
 
+    from app.messages.inbox import messages_cli
+    app.cli.add_command(messages_cli)
+
+    # Event push channel
+    from app.events import event_bus, events_cli
+    event_bus.init_app(app)
+    app.cli.add_command(events_cli)
+
+    # Home feed timelines
+    from app.feed import timeline_store, feed_cli
+    timeline_store.init_app(app)
+    app.cli.add_command(feed_cli)
+
+    from app.counters import counters_cli
+    app.cli.add_command(counters_cli)
+
+    from app.post_list import posts_cli
+    app.cli.add_command(posts_cli)
+
+    # People and post search
+    from app.search import search_service
+    search_service.init_app(app)
+
+    from app.typeahead import typeahead_index
+    typeahead_index.start()
+
+    # Connection graph cache
+    from app.graph import connection_graph
+    connection_graph.init_app(app)
+
+    # Navbar unread badges
+    from app.badges import badge_counters, badges_cli
+    badge_counters.init_app(app)
+    app.cli.add_command(badges_cli)
+
+    # Write-behind notifications
+    from app.notifications import notification_pipeline, notifications_cli
+    notification_pipeline.init_app(app)
+    app.cli.add_command(notifications_cli)
+
+    from app.profile_views import profile_view_tracker
+    profile_view_tracker.init_app(app)
+
+    # Conditional GETs for logged-out pages
+    from app.http_cache import http_cache
+    http_cache.init_app(app)
+
+    # Rendered post card and profile header fragments
+    from app.fragments import fragment_cache, fragments_cli
+    fragment_cache.init_app(app)
+    app.cli.add_command(fragments_cli)
+
+    # Upload image variants
+    from app.images import image_processor
+    image_processor.init_app(app)
+
+    from app.uploads.chunked import uploads_cli
+    app.cli.add_command(uploads_cli)
+
+    # Deduplicated media store
+    from app.media_store import media_store, media_cli
+    media_store.init_app(app)
+    app.cli.add_command(media_cli)
+
+    # Link previews for link posts
+    from app.unfurl import link_unfurler, links_cli
+    link_unfurler.init_app(app)
+    app.cli.add_command(links_cli)
+
+    # People You May Know
+    from app.suggestions import suggestions_cli
+    app.cli.add_command(suggestions_cli)
+
     return app
 
 # Import models at the end to avoid circular imports
@@ -0,0 +1,48 @@
+"""
+Work deferred until the current transaction commits.
+
+Side effects that must not outlive a rolled back transaction (publishing
+events, enqueueing notifications, deleting files, background processing)
+are queued on the session and run from its after_commit hook; a rollback
+discards them.
+
+    @after_commit('pending_things')
+    def pending_things(items):
+        ...
+
+    pending_things.queue().append(item)
+"""
+from sqlalchemy import event as sa_event
+
+from app import db
+
+
+class AfterCommit:
+    """Items queued under one session.info key, handed to handler after each commit"""
+
+    def __init__(self, key, handler, container=list):
+        self.key = key
+        self.handler = handler
+        self.container = container
+        sa_event.listen(db.session, 'after_commit', self._run)
+        sa_event.listen(db.session, 'after_rollback', self._discard)
+
+    def queue(self, session=None):
+        """The list (or container) of items pending on session, db.session by default"""
+        session = db.session if session is None else session
+        return session.info.setdefault(self.key, self.container())
+
+    def _run(self, session):
+        items = session.info.pop(self.key, None)
+        if items:
+            self.handler(items)
+
+    def _discard(self, session):
+        session.info.pop(self.key, None)
+
+
+def after_commit(key, container=list):
+    """Decorator turning handler(items) into an AfterCommit queue stored under key"""
+    def decorator(handler):
+        return AfterCommit(key, handler, container)
+    return decorator
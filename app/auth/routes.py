@@ -3,7 +3,8 @@ from flask_login import login_user, logout_user, current_user, login_required
 from werkzeug.urls import url_parse
 from app import db
 from app.auth import bp
-from app.models import User, Notification
+from app.models import User
+from app.notifications import notify
 from app.forms import LoginForm, RegistrationForm
 from datetime import datetime
 import os
@@ -60,14 +61,13 @@ def register():
         db.session.commit()
 
         # Create welcome notification
-        welcome_notification = Notification(
+        notify(
             user_id=user.user_id,
             type='system',
             title='Welcome to LinkedIn Clone!',
             message='Thank you for joining our professional network. Complete your profile to get started.',
             action_url=url_for('profile.edit_profile')
         )
-        db.session.add(welcome_notification)
         db.session.commit()
 
         flash('Congratulations, you are now registered!', 'success')
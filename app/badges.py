@@ -0,0 +1,155 @@
+"""
+Unread badge counters for the navbar.
+
+Each user has one badge_counters row that holds their unread notification
+and unread message counts. Writers adjust it atomically when notifications
+are written or read and when messages arrive or are read. Rendering a badge
+is therefore a primary-key read, memoized for the rest of the request,
+instead of a COUNT over notifications and messages.
+
+`flask badges reconcile` recounts from the source tables and fixes drift.
+"""
+from collections import defaultdict
+
+import click
+from flask import g, has_request_context
+from flask.cli import AppGroup
+from flask_login import current_user
+from sqlalchemy import and_, event as sa_event, func, literal, select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from app import db
+from app.models import User, BadgeCounter, Notification, Message, conversation_participants
+
+badges_cli = AppGroup('badges', help='Unread badge counter commands.')
+
+COLUMNS = {'notifications': 'unread_notifications', 'messages': 'unread_messages'}
+
+
+class BadgeCounters:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.context_processor(self._inject)
+        app.extensions['badge_counters'] = self
+
+    def _inject(self):
+        if not current_user.is_authenticated:
+            return {}
+        counts = self.get(current_user.user_id)
+        return {'unread_notifications': counts['notifications'], 'unread_messages': counts['messages']}
+
+    def _memo(self):
+        return g.setdefault('badge_counts', {}) if has_request_context() else {}
+
+    def get(self, user_id):
+        """{'notifications': n, 'messages': m} for one user"""
+        memo = self._memo()
+        if user_id not in memo:
+            row = db.session.query(BadgeCounter.unread_notifications, BadgeCounter.unread_messages).filter(
+                BadgeCounter.user_id == user_id
+            ).first()
+            memo[user_id] = {'notifications': row[0] if row else 0, 'messages': row[1] if row else 0}
+        return memo[user_id]
+
+    def adjust(self, badge, deltas, connection=None):
+        """Add {user_id: delta} to one badge, creating rows as needed and never going below zero"""
+        column = BadgeCounter.__table__.c[COLUMNS[badge]]
+        by_delta = defaultdict(list)
+        for user_id, delta in deltas.items():
+            if delta:
+                by_delta[delta].append(user_id)
+        executor = connection if connection is not None else db.session
+        # One multi-row upsert per distinct delta (usually just +1 or -1)
+        for delta, user_ids in by_delta.items():
+            stmt = mysql_insert(BadgeCounter.__table__).values(
+                [{'user_id': user_id, column.name: max(delta, 0)} for user_id in user_ids]
+            )
+            executor.execute(stmt.on_duplicate_key_update({column.name: func.greatest(column + delta, 0)}))
+        memo = self._memo()
+        for user_id in deltas:
+            memo.pop(user_id, None)
+
+    def clear(self, badge, user_id):
+        column = COLUMNS[badge]
+        stmt = mysql_insert(BadgeCounter.__table__).values(user_id=user_id, **{column: 0})
+        db.session.execute(stmt.on_duplicate_key_update({column: 0}))
+        self._memo().pop(user_id, None)
+
+
+badge_counters = BadgeCounters()
+
+
+@sa_event.listens_for(Message, 'after_insert')
+def _count_unread_message(mapper, connection, target):
+    # Every other participant gets +1, in the same statement and transaction as the message
+    cp = conversation_participants
+    table = BadgeCounter.__table__
+    recipients = select([cp.c.user_id, literal(1)]).where(and_(
+        cp.c.conversation_id == target.conversation_id, cp.c.user_id != target.sender_id
+    ))
+    stmt = mysql_insert(table).from_select(['user_id', 'unread_messages'], recipients)
+    connection.execute(stmt.on_duplicate_key_update(unread_messages=table.c.unread_messages + 1))
+
+
+def actual_counts(user_ids):
+    """Recount both badges for a batch of users with one grouped query each"""
+    counts = {user_id: {'unread_notifications': 0, 'unread_messages': 0} for user_id in user_ids}
+
+    notifications = db.session.query(Notification.user_id, func.count()).filter(
+        Notification.user_id.in_(user_ids), Notification.is_read == False
+    ).group_by(Notification.user_id)
+    for user_id, count in notifications:
+        counts[user_id]['unread_notifications'] = count
+
+    cp = conversation_participants
+    messages = db.session.query(cp.c.user_id, func.count(Message.message_id)).select_from(cp).join(
+        Message, and_(
+            Message.conversation_id == cp.c.conversation_id,
+            Message.message_id > func.coalesce(cp.c.last_read_message_id, 0),
+            Message.sender_id != cp.c.user_id
+        )
+    ).filter(cp.c.user_id.in_(user_ids)).group_by(cp.c.user_id)
+    for user_id, count in messages:
+        counts[user_id]['unread_messages'] = count
+
+    return counts
+
+
+def reconcile_badges(user_ids):
+    """Fix drifted counters for a batch of users, returning how many changed"""
+    expected = actual_counts(user_ids)
+    stored = {row.user_id: {'unread_notifications': row.unread_notifications,
+                            'unread_messages': row.unread_messages}
+              for row in BadgeCounter.query.filter(BadgeCounter.user_id.in_(user_ids))}
+    zero = {'unread_notifications': 0, 'unread_messages': 0}
+    rows = [dict(values, user_id=user_id) for user_id, values in expected.items()
+            if stored.get(user_id, zero) != values]
+    if rows:
+        stmt = mysql_insert(BadgeCounter.__table__).values(rows)
+        db.session.execute(stmt.on_duplicate_key_update(
+            unread_notifications=stmt.inserted.unread_notifications,
+            unread_messages=stmt.inserted.unread_messages
+        ))
+    return len(rows)
+
+
+@badges_cli.command('reconcile')
+@click.option('--batch-size', default=500, show_default=True, help='Users recounted per transaction.')
+def reconcile_command(batch_size):
+    """Recount unread badges from notifications and messages and fix drift."""
+    last_id = 0
+    checked = fixed = 0
+    while True:
+        user_ids = [user_id for user_id, in db.session.query(User.user_id).filter(
+            User.user_id > last_id
+        ).order_by(User.user_id).limit(batch_size)]
+        if not user_ids:
+            break
+        fixed += reconcile_badges(user_ids)
+        db.session.commit()
+        checked += len(user_ids)
+        last_id = user_ids[-1]
+    click.echo(f'Checked {checked} users, fixed {fixed}')
@@ -0,0 +1,113 @@
+"""
+Write-behind batching shared by the notification and profile-view writers.
+
+Items are put on an in-process queue and a background thread (one per
+worker process) hands them to write() in batches: everything that arrives
+within flush_interval seconds, up to batch_size items. When asynchronous
+is off, write() runs on the caller's thread instead.
+
+A batch that fails to write, e.g. on a deadlock or a dropped connection,
+is retried up to max_attempts times with a growing delay. Writers commit
+each batch in one transaction, so a failed attempt leaves nothing behind.
+If every attempt fails, the batch is logged item by item before it is
+dropped.
+"""
+import atexit
+import os
+from abc import ABC, abstractmethod
+import queue
+import threading
+import time
+
+
+class WriteBehindQueue(ABC):
+    thread_name = 'write-behind'
+    max_attempts = 3
+    retry_delay = 0.5  # seconds, multiplied by the attempt number
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.asynchronous = True
+        self.flush_interval = 1.0
+        self.batch_size = 500
+        self._app = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def configure(self, app, asynchronous, flush_interval, batch_size):
+        if self._app is None:
+            atexit.register(self.flush)
+        self._app = app
+        self.asynchronous = asynchronous
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+    @abstractmethod
+    def write(self, items):
+        """Persist one batch of queued items"""
+
+    def enqueue(self, items):
+        if not items:
+            return
+        if not self.asynchronous:
+            self.write(items)
+            return
+        for item in items:
+            self.queue.put(item)
+        self._ensure_worker()
+
+    def _ensure_worker(self):
+        # Threads do not survive fork(), start one in each worker process
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+                self._thread.start()
+
+    def _drain(self, first, deadline):
+        batch = [first]
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_batch(self, batch):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                with self._app.app_context():
+                    self.write(batch)
+                return
+            except Exception:
+                if attempt < self.max_attempts:
+                    self._app.logger.warning('%s failed to write %d items (attempt %d of %d), retrying',
+                                             self.thread_name, len(batch), attempt, self.max_attempts,
+                                             exc_info=True)
+                    time.sleep(self.retry_delay * attempt)
+                    continue
+                self._app.logger.exception('%s dropped %d items after %d attempts',
+                                           self.thread_name, len(batch), attempt)
+                for item in batch:
+                    self._app.logger.error('%s lost item: %r', self.thread_name, item)
+
+    def _run(self):
+        while True:
+            first = self.queue.get()
+            self._write_batch(self._drain(first, time.monotonic() + self.flush_interval))
+
+    def flush(self):
+        """Write whatever is still queued on the calling thread"""
+        items = []
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if items and self._app is not None:
+            with self._app.app_context():
+                self.write(items)
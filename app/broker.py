@@ -0,0 +1,79 @@
+"""
+Small TCP brokers shared by the app workers: the event bus relay
+(`flask events broker`) and the fragment cache server (`flask fragments
+server`).
+
+Both speak multiprocessing.connection, which unpickles whatever an
+authenticated peer sends, so the authkey is all that stands between the
+port and code execution in every worker. Without an explicit authkey a
+broker only listens on a loopback address, using a development key.
+"""
+import ipaddress
+import socket
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+
+DEV_AUTHKEY = b'dev-broker-key'  # only accepted by brokers listening on loopback
+
+
+class BrokerConfigError(Exception):
+    pass
+
+
+def parse_address(url):
+    host, _, port = url.rpartition(':')
+    return (host or 'localhost', int(port))
+
+
+def is_loopback(host):
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except socket.gaierror:
+        return False
+    return bool(addresses) and all(ipaddress.ip_address(address.split('%', 1)[0]).is_loopback
+                                   for address in addresses)
+
+
+def client_authkey(configured):
+    return configured.encode() if configured else DEV_AUTHKEY
+
+
+def listen_authkey(address, configured, setting):
+    """The authkey to listen with; refuses the development key off loopback"""
+    if configured:
+        return configured.encode()
+    if not is_loopback(address[0]):
+        raise BrokerConfigError(f'{address[0]}:{address[1]} is not a loopback address; set {setting} '
+                                'to a random secret shared by the broker and the app workers')
+    return DEV_AUTHKEY
+
+
+def serve_forever(address, authkey, handle, connected=None, disconnected=None):
+    """Accept authenticated connections and call handle(conn, message) for every message
+
+    connected(conn) and disconnected(conn) track the open connections. Each
+    connection is served on its own thread.
+    """
+    listener = Listener(address, authkey=authkey)
+
+    def serve(conn):
+        try:
+            while True:
+                handle(conn, conn.recv())
+        except (EOFError, OSError):
+            pass
+        finally:
+            if disconnected is not None:
+                disconnected(conn)
+            conn.close()
+
+    while True:
+        try:
+            conn = listener.accept()
+        except (AuthenticationError, EOFError, OSError):
+            # A peer without the key, or one that hung up during the handshake
+            continue
+        if connected is not None:
+            connected(conn)
+        threading.Thread(target=serve, args=(conn,), daemon=True).start()
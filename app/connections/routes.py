@@ -2,8 +2,12 @@ from flask import render_template, redirect, url_for, flash, request, jsonify, c
 from flask_login import current_user, login_required
 from app import db
 from app.connections import bp
-from app.models import User, Connection, Notification
+from app.models import User, Connection, ConnectionSuggestion
+from app.notifications import notify
 from app.forms import ConnectionRequestForm
+from app.feed import timeline_store
+from app.pagination import keyset_paginate
+from app.suggestions import ensure_suggestions, suggestion_query
 from sqlalchemy import or_, and_, func
 from datetime import datetime
 
@@ -50,34 +54,20 @@ def my_network():
 @login_required
 def discover_people():
     """Discover new people to connect with"""
-    page = request.args.get('page', 1, type=int)
-
-    # Get users not already connected with
-    connected_user_ids = db.session.query(
-        Connection.requester_id, Connection.requested_id
-    ).filter(
-        or_(
-            Connection.requester_id == current_user.user_id,
-            Connection.requested_id == current_user.user_id
-        )
-    ).all()
-
-    # Flatten the list of connected user IDs
-    excluded_ids = set()
-    for req_id, resp_id in connected_user_ids:
-        excluded_ids.add(req_id)
-        excluded_ids.add(resp_id)
-
-    # Add current user to exclusion list
-    excluded_ids.add(current_user.user_id)
-
-    # Get suggested users
-    suggested_users = User.query.filter(
-        ~User.user_id.in_(excluded_ids)
-    ).paginate(page=page, per_page=current_app.config['USERS_PER_PAGE'], error_out=False)
+    cursor = request.args.get('cursor')
+
+    # Precomputed suggestions, best score first
+    ensure_suggestions(current_user.user_id)
+    suggested_users = keyset_paginate(
+        suggestion_query(current_user.user_id),
+        ConnectionSuggestion.score, ConnectionSuggestion.suggested_user_id,
+        cursor, current_app.config['USERS_PER_PAGE']
+    )
+    mutual_counts = {row.suggested_user_id: row.mutual_count for row in suggested_users.items}
+    suggested_users.items = [row.suggested_user for row in suggested_users.items]
 
     return render_template('connections/discover_people.html', title='People You May Know',
-                         users=suggested_users)
+                         users=suggested_users, mutual_counts=mutual_counts)
 
 @bp.route('/send_request/<int:user_id>', methods=['GET', 'POST'])
 @login_required
@@ -117,7 +107,7 @@ def send_connection_request(user_id):
         db.session.add(connection)
 
         # Create notification for target user
-        notification = Notification(
+        notify(
             user_id=user_id,
             type='connection_request',
             title=f'{current_user.get_full_name()} sent you a connection request',
@@ -125,7 +115,6 @@ def send_connection_request(user_id):
             related_user_id=current_user.user_id,
             action_url=url_for('connections.my_network')
         )
-        db.session.add(notification)
         db.session.commit()
 
         flash(f'Connection request sent to {target_user.get_full_name()}!', 'success')
@@ -154,7 +143,7 @@ def respond_to_request(connection_id, action):
         connection.updated_at = datetime.utcnow()
 
         # Create notification for requester
-        notification = Notification(
+        notify(
             user_id=connection.requester_id,
             type='connection_accepted',
             title=f'{current_user.get_full_name()} accepted your connection request',
@@ -162,7 +151,7 @@ def respond_to_request(connection_id, action):
             related_user_id=current_user.user_id,
             action_url=url_for('profile.view_profile', username=current_user.username)
         )
-        db.session.add(notification)
+        timeline_store.link_users(connection.requester, current_user)
 
         flash(f'You are now connected with {connection.requester.get_full_name()}!', 'success')
 
@@ -194,6 +183,7 @@ def remove_connection(user_id):
 
     user = User.query.get(user_id)
     db.session.delete(connection)
+    timeline_store.unlink_users(current_user.user_id, user_id)
     db.session.commit()
 
     return jsonify({
@@ -231,6 +221,8 @@ def block_user(user_id):
     ).first()
 
     if existing_connection:
+        if existing_connection.status == 'accepted':
+            timeline_store.unlink_users(current_user.user_id, user_id)
         existing_connection.status = 'blocked'
         existing_connection.updated_at = datetime.utcnow()
     else:
@@ -0,0 +1,75 @@
+"""
+Maintenance for the denormalized reaction/comment/share counters on Post.
+
+Routes keep the counters current with Post.adjust_counters(); the reconcile
+command recounts from the source tables and fixes any drift.
+"""
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func
+
+from app import db
+from app.models import Post, PostReaction, Comment, PostShare, REACTION_TYPES
+from app.fragments import fragment_cache
+
+counters_cli = AppGroup('counters', help='Post counter maintenance commands.')
+
+COUNTER_COLUMNS = ['reaction_count'] + [f'{t}_count' for t in REACTION_TYPES] + ['comment_count', 'share_count']
+
+
+def actual_counts(post_ids):
+    """Recount every counter for the given posts with one grouped query per table"""
+    counts = {post_id: dict.fromkeys(COUNTER_COLUMNS, 0) for post_id in post_ids}
+
+    reactions = db.session.query(
+        PostReaction.post_id, PostReaction.reaction_type, func.count()
+    ).filter(PostReaction.post_id.in_(post_ids)).group_by(
+        PostReaction.post_id, PostReaction.reaction_type
+    )
+    for post_id, reaction_type, count in reactions:
+        counts[post_id][f'{reaction_type}_count'] = count
+        counts[post_id]['reaction_count'] += count
+
+    for model, column in ((Comment, 'comment_count'), (PostShare, 'share_count')):
+        rows = db.session.query(model.post_id, func.count()).filter(
+            model.post_id.in_(post_ids)
+        ).group_by(model.post_id)
+        for post_id, count in rows:
+            counts[post_id][column] = count
+
+    return counts
+
+
+def reconcile_posts(post_ids):
+    """Fix drifted counters for a batch of posts, returning how many changed"""
+    expected = actual_counts(post_ids)
+    columns = [getattr(Post, name) for name in COUNTER_COLUMNS]
+    fixed = 0
+    for row in db.session.query(Post.post_id, *columns).filter(Post.post_id.in_(post_ids)):
+        stored = dict(zip(COUNTER_COLUMNS, row[1:]))
+        if stored != expected[row[0]]:
+            values = {getattr(Post, name): value for name, value in expected[row[0]].items()}
+            values[Post.updated_at] = Post.updated_at
+            Post.query.filter(Post.post_id == row[0]).update(values, synchronize_session=False)
+            fragment_cache.invalidate_after_commit('post', row[0])
+            fixed += 1
+    return fixed
+
+
+@counters_cli.command('reconcile')
+@click.option('--batch-size', default=500, show_default=True, help='Posts recounted per transaction.')
+def reconcile_command(batch_size):
+    """Recount post counters from the source tables and fix drift."""
+    last_id = 0
+    checked = fixed = 0
+    while True:
+        post_ids = [post_id for post_id, in db.session.query(Post.post_id).filter(
+            Post.post_id > last_id
+        ).order_by(Post.post_id).limit(batch_size)]
+        if not post_ids:
+            break
+        fixed += reconcile_posts(post_ids)
+        db.session.commit()
+        checked += len(post_ids)
+        last_id = post_ids[-1]
+    click.echo(f'Checked {checked} posts, fixed {fixed}')
@@ -0,0 +1,291 @@
+"""
+Publish/subscribe bus used to push message and notification events to
+connected clients.
+
+By default events are delivered inside the current process. When
+EVENT_BUS_URL is set, events are relayed through a small local broker
+(started with `flask events broker`) so every gunicorn worker sees them.
+"""
+import json
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from multiprocessing.connection import Client
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event as sa_event, select
+from sqlalchemy.orm import object_session
+
+from app.after_commit import after_commit
+from app.broker import BrokerConfigError, client_authkey, listen_authkey, parse_address, serve_forever
+from app.models import Message, Notification, conversation_participants
+
+events_cli = AppGroup('events', help='Event bus commands.')
+
+
+class Subscription:
+    """A queue of events for one channel, drained by a single consumer"""
+
+    def __init__(self, bus, channel, maxsize=100):
+        self.bus = bus
+        self.channel = channel
+        self.queue = queue.Queue(maxsize=maxsize)
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # Slow consumer: drop the event, clients resync on the next one
+            pass
+
+    def get(self, timeout=None):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+    def stream(self, timeout, heartbeat):
+        """Yield Server-Sent Events until timeout, then let the client reconnect"""
+        deadline = time.monotonic() + timeout
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                event = self.get(timeout=min(heartbeat, remaining))
+                if event is None:
+                    yield ': keepalive\n\n'
+                else:
+                    yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            self.close()
+
+
+class CallbackSubscriber:
+    """Runs a callback for every event on a channel, on the publishing thread"""
+
+    def __init__(self, bus, channel, callback):
+        self.bus = bus
+        self.channel = channel
+        self.callback = callback
+
+    def put(self, event):
+        self.callback(event)
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class LocalBackend:
+    """Delivers events to subscribers in this process only"""
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def publish(self, channel, event):
+        self.bus.dispatch(channel, event)
+
+
+class BrokerBackend:
+    """Relays events through the local broker so all workers receive them"""
+
+    def __init__(self, bus, address, authkey):
+        self.bus = bus
+        self.address = address
+        self.authkey = authkey
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        # Connections are not shared across fork(), reconnect in each worker
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = Client(self.address, authkey=self.authkey)
+            self._pid = os.getpid()
+            threading.Thread(target=self._reader, args=(self._conn,), daemon=True).start()
+        return self._conn
+
+    def _reader(self, conn):
+        try:
+            while True:
+                channel, event = conn.recv()
+                self.bus.dispatch(channel, event)
+        except (EOFError, OSError):
+            with self._lock:
+                if self._conn is conn:
+                    self._conn = None
+
+    def publish(self, channel, event):
+        with self._lock:
+            try:
+                self._connection().send((channel, event))
+            except (EOFError, OSError, ConnectionError):
+                self._conn = None
+                # Broker unavailable, still serve subscribers in this worker
+                self.bus.dispatch(channel, event)
+
+    def ensure_connected(self):
+        with self._lock:
+            try:
+                self._connection()
+            except (OSError, ConnectionError):
+                self._conn = None
+
+
+class EventBus:
+    def __init__(self, app=None):
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+        self.backend = LocalBackend(self)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        url = app.config.get('EVENT_BUS_URL')
+        if url:
+            self.backend = BrokerBackend(self, parse_address(url), client_authkey(app.config['EVENT_BUS_AUTHKEY']))
+        else:
+            self.backend = LocalBackend(self)
+        app.extensions['event_bus'] = self
+
+    def publish(self, channel, event):
+        self.backend.publish(channel, event)
+
+    def subscribe(self, channel):
+        return self._add(Subscription(self, channel))
+
+    def listen(self, channel, callback):
+        return self._add(CallbackSubscriber(self, channel, callback))
+
+    def _add(self, subscriber):
+        if isinstance(self.backend, BrokerBackend):
+            self.backend.ensure_connected()
+        with self._lock:
+            self._subscribers[subscriber.channel].add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.channel)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[subscriber.channel]
+
+    def dispatch(self, channel, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+
+event_bus = EventBus()
+
+
+def user_channel(user_id):
+    return f'user:{user_id}'
+
+
+def run_broker(address, authkey):
+    """Accept worker connections and fan every event out to all of them"""
+    clients = set()
+    lock = threading.Lock()
+
+    def connected(conn):
+        with lock:
+            clients.add(conn)
+
+    def disconnected(conn):
+        with lock:
+            clients.discard(conn)
+
+    def relay(conn, item):
+        with lock:
+            targets = list(clients)
+        for client in targets:
+            try:
+                client.send(item)
+            except (EOFError, OSError):
+                disconnected(client)
+
+    serve_forever(address, authkey, relay, connected, disconnected)
+
+
+@events_cli.command('broker')
+@click.option('--url', default=None, help='host:port to listen on (defaults to EVENT_BUS_URL).')
+def broker_command(url):
+    """Run the local event broker shared by all app workers."""
+    from flask import current_app
+    url = url or current_app.config.get('EVENT_BUS_URL') or 'localhost:6001'
+    address = parse_address(url)
+    try:
+        authkey = listen_authkey(address, current_app.config['EVENT_BUS_AUTHKEY'], 'EVENT_BUS_AUTHKEY')
+    except BrokerConfigError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Event broker listening on {url}')
+    run_broker(address, authkey)
+
+
+# Events are collected while rows are flushed and only published once the
+# transaction commits, so subscribers never see rolled back rows.
+
+@after_commit('pending_events')
+def pending_events(items):
+    for channel, payload in items:
+        event_bus.publish(channel, payload)
+
+
+def _pending(target):
+    session = object_session(target)
+    return pending_events.queue(session) if session is not None else None
+
+
+def publish_after_commit(target, channel, payload):
+    """Publish an event for a flushed row once its transaction commits"""
+    pending = _pending(target)
+    if pending is not None:
+        pending.append((channel, payload))
+
+
+@sa_event.listens_for(Message, 'after_insert')
+@sa_event.listens_for(Message, 'after_update')
+@sa_event.listens_for(Message, 'after_delete')
+def _queue_message_event(mapper, connection, target):
+    pending = _pending(target)
+    if pending is None:
+        return
+    participant_ids = [row[0] for row in connection.execute(
+        select([conversation_participants.c.user_id]).where(
+            conversation_participants.c.conversation_id == target.conversation_id
+        )
+    )]
+    payload = {
+        'type': 'message',
+        'conversation_id': target.conversation_id,
+        'message_id': target.message_id,
+        'sender_id': target.sender_id
+    }
+    for user_id in participant_ids:
+        pending.append((user_channel(user_id), payload))
+
+
+@sa_event.listens_for(Notification, 'after_insert')
+def _queue_notification_event(mapper, connection, target):
+    pending = _pending(target)
+    if pending is None:
+        return
+    pending.append((user_channel(target.user_id), {
+        'type': 'notification',
+        'notification_id': target.notification_id,
+        'notification_type': target.type,
+        'title': target.title,
+        'action_url': target.action_url
+    }))
+
@@ -0,0 +1,196 @@
+"""
+Precomputed home feed timelines.
+
+New posts are pushed into the timelines of the author's connections when
+they are created (fan-out on write). Authors whose audience is larger than
+FEED_FANOUT_LIMIT are not fanned out; their posts, like public posts from
+outside the network, are merged in when the feed is read.
+"""
+import heapq
+import time
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func, select, union_all
+
+from app import db
+from app.models import User, Post, Connection, TimelineEntry
+from app.pagination import decode_cursor, seek, build_page
+from app.post_list import with_authors
+
+feed_cli = AppGroup('feed', help='Home feed timeline commands.')
+
+
+class TimelineStore:
+    def __init__(self, app=None):
+        self.max_length = 800
+        self.fanout_limit = 5000
+        self.backfill_size = 50
+        self.pull_authors_ttl = 300
+        self._pull_authors = None
+        self._pull_authors_loaded = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_length = app.config['FEED_MAX_LENGTH']
+        self.fanout_limit = app.config['FEED_FANOUT_LIMIT']
+        self.backfill_size = app.config['FEED_BACKFILL_SIZE']
+        self.pull_authors_ttl = app.config['FEED_PULL_AUTHORS_TTL']
+        app.extensions['timeline_store'] = self
+
+    # Writes
+
+    def _insert(self, rows):
+        if rows:
+            db.session.execute(TimelineEntry.__table__.insert(), rows)
+
+    def fan_out_post(self, post):
+        """Push a newly created post into its audience's timelines"""
+        rows = [{'user_id': post.user_id, 'post_id': post.post_id,
+                 'author_id': post.user_id, 'created_at': post.created_at}]
+        if post.visibility != 'private' and post.user_id not in self.pull_authors():
+            author = post.author or User.query.get(post.user_id)
+            rows.extend({'user_id': user_id, 'post_id': post.post_id,
+                         'author_id': post.user_id, 'created_at': post.created_at}
+                        for user_id in author.get_connection_ids())
+        self._insert(rows)
+
+    def remove_post(self, post_id):
+        TimelineEntry.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+
+    def link_users(self, user_a, user_b):
+        """Backfill each user's recent posts into the other's timeline"""
+        for reader, author in ((user_a, user_b), (user_b, user_a)):
+            if author.user_id in self.pull_authors():
+                continue
+            posts = db.session.query(Post.post_id, Post.created_at).filter(
+                Post.user_id == author.user_id, Post.visibility != 'private'
+            ).order_by(Post.created_at.desc()).limit(self.backfill_size).all()
+            existing = {post_id for post_id, in db.session.query(TimelineEntry.post_id).filter(
+                TimelineEntry.user_id == reader.user_id, TimelineEntry.author_id == author.user_id
+            )}
+            self._insert([{'user_id': reader.user_id, 'post_id': post_id,
+                           'author_id': author.user_id, 'created_at': created_at}
+                          for post_id, created_at in posts if post_id not in existing])
+
+    def unlink_users(self, user_a_id, user_b_id):
+        TimelineEntry.query.filter(
+            ((TimelineEntry.user_id == user_a_id) & (TimelineEntry.author_id == user_b_id)) |
+            ((TimelineEntry.user_id == user_b_id) & (TimelineEntry.author_id == user_a_id))
+        ).delete(synchronize_session=False)
+
+    def rebuild(self, user):
+        """Recreate a user's timeline from the posts table"""
+        TimelineEntry.query.filter_by(user_id=user.user_id).delete(synchronize_session=False)
+        author_ids = user.get_connection_ids() - self.pull_authors()
+        posts = db.session.query(Post.post_id, Post.user_id, Post.created_at).filter(
+            (Post.user_id == user.user_id) |
+            (Post.user_id.in_(author_ids) & (Post.visibility != 'private'))
+        ).order_by(Post.created_at.desc()).limit(self.max_length).all()
+        self._insert([{'user_id': user.user_id, 'post_id': post_id,
+                       'author_id': author_id, 'created_at': created_at}
+                      for post_id, author_id, created_at in posts])
+        return len(posts)
+
+    def trim(self, user_id):
+        """Drop entries beyond the newest max_length for one user"""
+        cutoff = db.session.query(TimelineEntry.created_at).filter_by(user_id=user_id).order_by(
+            TimelineEntry.created_at.desc()
+        ).offset(self.max_length).limit(1).scalar()
+        if cutoff is None:
+            return 0
+        return TimelineEntry.query.filter(
+            TimelineEntry.user_id == user_id, TimelineEntry.created_at <= cutoff
+        ).delete(synchronize_session=False)
+
+    # Reads
+
+    def pull_authors(self):
+        """Users whose audience is too large to fan out, cached per process"""
+        now = time.monotonic()
+        if self._pull_authors is None or now - self._pull_authors_loaded > self.pull_authors_ttl:
+            sides = union_all(
+                select([Connection.requester_id.label('user_id')]).where(Connection.status == 'accepted'),
+                select([Connection.requested_id.label('user_id')]).where(Connection.status == 'accepted')
+            ).alias('sides')
+            rows = db.session.query(sides.c.user_id).group_by(sides.c.user_id).having(
+                func.count() > self.fanout_limit
+            ).all()
+            self._pull_authors = {user_id for user_id, in rows}
+            self._pull_authors_loaded = now
+        return self._pull_authors
+
+    def read(self, user, cursor_token, per_page):
+        """Merge the stored timeline with read-time sources into one keyset page"""
+        cursor = decode_cursor(cursor_token)
+
+        def read_source(query, created_col, id_col):
+            return seek(query, created_col, id_col, cursor).limit(per_page + 1).all()
+
+        sources = [
+            read_source(db.session.query(TimelineEntry.created_at, TimelineEntry.post_id).filter(
+                TimelineEntry.user_id == user.user_id
+            ), TimelineEntry.created_at, TimelineEntry.post_id),
+            read_source(db.session.query(Post.created_at, Post.post_id).filter(
+                Post.visibility == 'public'
+            ), Post.created_at, Post.post_id)
+        ]
+        pulled_ids = user.get_connection_ids() & self.pull_authors()
+        if pulled_ids:
+            sources.append(read_source(db.session.query(Post.created_at, Post.post_id).filter(
+                Post.user_id.in_(pulled_ids), Post.visibility != 'private'
+            ), Post.created_at, Post.post_id))
+
+        keys = []
+        seen = set()
+        for key in heapq.merge(*sources, reverse=cursor is None or cursor[0] == 'next'):
+            if key.post_id not in seen:
+                seen.add(key.post_id)
+                keys.append(key)
+                if len(keys) > per_page:
+                    break
+
+        page = build_page(keys, per_page, cursor, 'created_at', 'post_id')
+        page_ids = [key.post_id for key in page.items]
+        posts = {}
+        if page_ids:
+            posts = {post.post_id: post for post in with_authors(Post.query).filter(Post.post_id.in_(page_ids))}
+        page.items = [posts[post_id] for post_id in page_ids if post_id in posts]
+        return page
+
+
+timeline_store = TimelineStore()
+
+
+@feed_cli.command('rebuild')
+@click.option('--user-id', type=int, default=None, help='Only rebuild this user\'s timeline.')
+def rebuild_command(user_id):
+    """Rebuild home feed timelines from the posts table."""
+    if user_id is not None:
+        user_ids = [user_id]
+    else:
+        user_ids = [uid for uid, in db.session.query(User.user_id).order_by(User.user_id)]
+    count = 0
+    for uid in user_ids:
+        user = User.query.get(uid)
+        if user is None:
+            click.echo(f'User {uid} not found')
+            continue
+        timeline_store.rebuild(user)
+        db.session.commit()
+        count += 1
+    click.echo(f'Rebuilt {count} timelines')
+
+
+@feed_cli.command('trim')
+def trim_command():
+    """Trim every timeline to FEED_MAX_LENGTH entries."""
+    oversized = db.session.query(TimelineEntry.user_id).group_by(TimelineEntry.user_id).having(
+        func.count() > timeline_store.max_length
+    ).all()
+    removed = 0
+    for user_id, in oversized:
+        removed += timeline_store.trim(user_id)
+        db.session.commit()
+    click.echo(f'Removed {removed} timeline entries')
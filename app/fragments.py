@@ -0,0 +1,244 @@
+"""
+Rendered-fragment cache for post cards and profile headers.
+
+Templates wrap expensive markup in a cache block:
+
+    {% cache 'post', 'explore', post.post_id, post.updated_at, post.author.updated_at %}
+        ...
+    {% endcache %}
+
+The arguments are the object kind, the fragment name, the object id and any
+number of version stamps. A fragment is reused only while its stamps match.
+Editing a post or profile bumps updated_at, so stale copies are simply never
+read. Changes that leave updated_at alone, such as reaction, comment and
+share counters, invalidate explicitly with invalidate_after_commit().
+
+Backends, picked with FRAGMENT_CACHE_BACKEND:
+
+* 'local': an LRU per worker process; invalidations reach every worker
+  through the event bus.
+* 'server': a shared LRU served by `flask fragments server`, which stands in
+  for an external cache server.
+* 'null': disables caching.
+"""
+import os
+import threading
+from collections import OrderedDict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+
+import click
+from flask.cli import AppGroup
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from app.after_commit import after_commit
+from app.broker import BrokerConfigError, client_authkey, listen_authkey, parse_address, serve_forever
+from app.events import event_bus
+
+fragments_cli = AppGroup('fragments', help='Rendered-fragment cache commands.')
+
+FRAGMENT_CHANNEL = 'fragments'
+
+# Fragment names per object kind, so invalidating an object reaches all of its fragments
+FRAGMENTS = {
+    'post': ('feed-header', 'feed-body', 'explore', 'profile'),
+    'user': ('header-media', 'header-details'),
+}
+
+
+def fragment_key(kind, name, object_id):
+    return f'{kind}:{object_id}:{name}'
+
+
+class LRUStore:
+    """Thread-safe bounded mapping with least-recently-used eviction"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+
+class NullBackend:
+    shared = True
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete_many(self, keys):
+        pass
+
+
+class LocalBackend(LRUStore):
+    shared = False  # each worker has its own copy, invalidations are broadcast
+
+
+class ServerBackend:
+    """Client for the shared cache server; any failure is treated as a miss"""
+    shared = True
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _call(self, *request):
+        with self._lock:
+            try:
+                # Connections are not shared across fork(), reconnect in each worker
+                if self._conn is None or self._pid != os.getpid():
+                    self._conn = Client(self.address, authkey=self.authkey)
+                    self._pid = os.getpid()
+                self._conn.send(request)
+                return self._conn.recv()
+            except (EOFError, OSError, AuthenticationError):
+                self._conn = None
+                return None
+
+    def get(self, key):
+        return self._call('get', key)
+
+    def set(self, key, value):
+        self._call('set', key, value)
+
+    def delete_many(self, keys):
+        self._call('delete', list(keys))
+
+
+class FragmentCache:
+    def __init__(self, app=None):
+        self.backend = LocalBackend(5000)
+        self._listener = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        kind = app.config['FRAGMENT_CACHE_BACKEND']
+        if kind == 'server':
+            authkey = client_authkey(app.config['FRAGMENT_CACHE_AUTHKEY'])
+            self.backend = ServerBackend(parse_address(app.config['FRAGMENT_CACHE_URL']), authkey)
+        elif kind == 'null':
+            self.backend = NullBackend()
+        else:
+            self.backend = LocalBackend(app.config['FRAGMENT_CACHE_SIZE'])
+        if not self.backend.shared and self._listener is None:
+            self._listener = event_bus.listen(FRAGMENT_CHANNEL, self._on_invalidate)
+        app.jinja_env.add_extension(FragmentCacheExtension)
+        app.extensions['fragment_cache'] = self
+
+    def render(self, kind, name, object_id, version, caller):
+        if name not in FRAGMENTS.get(kind, ()):
+            raise ValueError(f'Unknown {kind} fragment {name!r}, add it to FRAGMENTS')
+        key = fragment_key(kind, name, object_id)
+        version = '|'.join(str(part) for part in version)
+        cached = self.backend.get(key)
+        if cached is not None and cached[0] == version:
+            return Markup(cached[1])
+        html = caller()
+        self.backend.set(key, (version, str(html)))
+        return Markup(html)
+
+    def keys_for(self, kind, object_ids):
+        return [fragment_key(kind, name, object_id) for object_id in object_ids for name in FRAGMENTS[kind]]
+
+    def invalidate(self, kind, *object_ids):
+        keys = self.keys_for(kind, object_ids)
+        if self.backend.shared:
+            self.backend.delete_many(keys)
+        else:
+            event_bus.publish(FRAGMENT_CHANNEL, {'keys': keys})
+
+    def _on_invalidate(self, change):
+        self.backend.delete_many(change['keys'])
+
+    def invalidate_after_commit(self, kind, *object_ids):
+        """Invalidate once the current transaction commits, so readers never re-cache old rows"""
+        pending_fragments.queue().append((kind, object_ids))
+
+
+fragment_cache = FragmentCache()
+
+
+class FragmentCacheExtension(Extension):
+    """{% cache kind, name, object_id, *version %}...{% endcache %}"""
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [nodes.List(args)]), [], [], body).set_lineno(lineno)
+
+    def _render(self, args, caller):
+        kind, name, object_id, *version = args
+        return fragment_cache.render(kind, name, object_id, version, caller)
+
+
+@after_commit('pending_fragments')
+def pending_fragments(items):
+    for kind, object_ids in items:
+        fragment_cache.invalidate(kind, *object_ids)
+
+
+def run_server(address, authkey, max_entries):
+    """Serve one shared LRU to every app worker"""
+    store = LRUStore(max_entries)
+
+    def answer(conn, request):
+        if request[0] == 'get':
+            conn.send(store.get(request[1]))
+        elif request[0] == 'set':
+            store.set(request[1], request[2])
+            conn.send(True)
+        elif request[0] == 'delete':
+            store.delete_many(request[1])
+            conn.send(True)
+        else:
+            conn.send(None)
+
+    serve_forever(address, authkey, answer)
+
+
+@fragments_cli.command('server')
+@click.option('--url', default=None, help='host:port to listen on (defaults to FRAGMENT_CACHE_URL).')
+@click.option('--size', type=int, default=None, help='Maximum fragments kept (defaults to FRAGMENT_CACHE_SIZE).')
+def server_command(url, size):
+    """Run the shared fragment cache server."""
+    from flask import current_app
+    url = url or current_app.config['FRAGMENT_CACHE_URL']
+    size = size or current_app.config['FRAGMENT_CACHE_SIZE']
+    address = parse_address(url)
+    try:
+        authkey = listen_authkey(address, current_app.config['FRAGMENT_CACHE_AUTHKEY'], 'FRAGMENT_CACHE_AUTHKEY')
+    except BrokerConfigError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Fragment cache listening on {url} ({size} entries)')
+    run_server(address, authkey, size)
@@ -0,0 +1,203 @@
+"""
+Cached connection graph.
+
+Each user's adjacency (every connection row they are part of, whatever its
+status) is loaded with one query on first use and kept in a bounded LRU, so
+relationship checks on hot pages are dictionary lookups. Connection inserts,
+updates and deletes invalidate both endpoints in every worker through the
+event bus once the transaction commits; a TTL bounds staleness if an event
+is ever missed.
+
+Degrees of separation (1st/2nd/3rd) are answered from the same cache with a
+bidirectional breadth-first search. Each BFS level loads all of its uncached
+adjacency with one query.
+"""
+from collections import namedtuple
+
+from sqlalchemy import event as sa_event
+
+from app import db
+from app.events import event_bus, publish_after_commit
+from app.models import Connection
+from app.ttl_cache import TTLCache
+
+GRAPH_CHANNEL = 'graph'
+MAX_DEGREE = 3
+DEGREE_LABELS = {1: '1st', 2: '2nd', 3: '3rd'}
+
+Edge = namedtuple('Edge', 'status connection_id requester_id')
+
+
+class ConnectionGraph:
+    def __init__(self, app=None):
+        self._adjacency = TTLCache(max_size=10000, ttl=300)  # user_id -> {other_id: Edge}
+        self._listener = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._adjacency.max_size = app.config['GRAPH_CACHE_SIZE']
+        self._adjacency.ttl = app.config['GRAPH_CACHE_TTL']
+        if self._listener is None:
+            self._listener = event_bus.listen(GRAPH_CHANNEL, self._on_change)
+        app.extensions['connection_graph'] = self
+
+    def _on_change(self, change):
+        self.invalidate(*change['user_ids'])
+
+    def invalidate(self, *user_ids):
+        self._adjacency.invalidate(*user_ids)
+
+    def clear(self):
+        self._adjacency.clear()
+
+    def edges(self, user_id):
+        """{other_user_id: Edge} for every connection row involving user_id"""
+        cached, generation = self._adjacency.get(user_id)
+        if cached is not None:
+            return cached
+
+        rows = db.session.query(
+            Connection.connection_id, Connection.requester_id, Connection.requested_id, Connection.status
+        ).filter(
+            (Connection.requester_id == user_id) | (Connection.requested_id == user_id)
+        ).all()
+        edges = {
+            (requested_id if requester_id == user_id else requester_id): Edge(status, connection_id, requester_id)
+            for connection_id, requester_id, requested_id, status in rows
+        }
+
+        self._adjacency.store({user_id: edges}, generation)
+        return edges
+
+    def edges_many(self, user_ids):
+        """Adjacency for several users, loading all cache misses with one query"""
+        result, generation = self._adjacency.get_many(user_ids)
+        missing = [user_id for user_id in user_ids if user_id not in result]
+        if not missing:
+            return result
+
+        loaded = {user_id: {} for user_id in missing}
+        rows = db.session.query(
+            Connection.connection_id, Connection.requester_id, Connection.requested_id, Connection.status
+        ).filter(
+            Connection.requester_id.in_(missing) | Connection.requested_id.in_(missing)
+        ).all()
+        for connection_id, requester_id, requested_id, status in rows:
+            edge = Edge(status, connection_id, requester_id)
+            if requester_id in loaded:
+                loaded[requester_id][requested_id] = edge
+            if requested_id in loaded:
+                loaded[requested_id][requester_id] = edge
+
+        self._adjacency.store(loaded, generation)
+        result.update(loaded)
+        return result
+
+    def edge(self, user_id, other_id):
+        return self.edges(user_id).get(other_id)
+
+    def status(self, user_id, other_id):
+        edge = self.edge(user_id, other_id)
+        return edge.status if edge else None
+
+    def is_connected(self, user_id, other_id):
+        return self.status(user_id, other_id) == 'accepted'
+
+    def connection_ids(self, user_id):
+        return {other_id for other_id, edge in self.edges(user_id).items() if edge.status == 'accepted'}
+
+    def expand(self, frontier):
+        """Accepted neighbours of every user in frontier, loaded with at most one query"""
+        neighbours = set()
+        for edges in self.edges_many(frontier).values():
+            neighbours.update(other_id for other_id, edge in edges.items() if edge.status == 'accepted')
+        return neighbours
+
+    def degree(self, user_id, other_id, max_depth=MAX_DEGREE):
+        """Hops between two users (0 for the same user), or None beyond max_depth"""
+        if user_id == other_id:
+            return 0
+        # Visited sets with their BFS depth, grown from whichever side is smaller
+        seen = [{user_id: 0}, {other_id: 0}]
+        frontiers = [{user_id}, {other_id}]
+        depths = [0, 0]
+        while frontiers[0] and frontiers[1] and depths[0] + depths[1] < max_depth:
+            side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            depths[side] += 1
+            frontier = set()
+            best = None
+            for node in self.expand(frontiers[side]):
+                if node in seen[side]:
+                    continue
+                if node in seen[1 - side]:
+                    hops = depths[side] + seen[1 - side][node]
+                    best = hops if best is None else min(best, hops)
+                seen[side][node] = depths[side]
+                frontier.add(node)
+            if best is not None:
+                return best
+            frontiers[side] = frontier
+        return None
+
+    def degrees(self, user_id, other_ids, max_depth=MAX_DEGREE):
+        """{other_id: degree or None} for a batch of users relative to one viewer
+
+        The viewer's side is expanded once for the whole batch (first-degree
+        connections, then their neighbours only if still needed) and each
+        target contributes one hop from its own cached adjacency, so the
+        batch costs a couple of queries at most.
+        """
+        other_ids = set(other_ids)
+        result = dict.fromkeys(other_ids)
+        if user_id in other_ids:
+            result[user_id] = 0
+            other_ids.discard(user_id)
+        if not other_ids or max_depth < 1:
+            return result
+
+        rings = [{user_id}, self.connection_ids(user_id)]  # rings[d]: users exactly d hops away
+        pending = set()
+        for other_id in other_ids:
+            if other_id in rings[1]:
+                result[other_id] = 1
+            else:
+                pending.add(other_id)
+        if not pending or max_depth < 2:
+            return result
+
+        target_edges = self.edges_many(pending)
+        target_neighbours = {
+            other_id: {nid for nid, edge in target_edges.get(other_id, {}).items() if edge.status == 'accepted'}
+            for other_id in pending
+        }
+        for depth in range(2, max_depth + 1):
+            ring = rings[depth - 1]
+            for other_id in list(pending):
+                if not target_neighbours[other_id].isdisjoint(ring):
+                    result[other_id] = depth
+                    pending.discard(other_id)
+            if not pending or depth == max_depth:
+                break
+            visited = set().union(*rings)
+            rings.append(self.expand(ring) - visited)
+        return result
+
+
+connection_graph = ConnectionGraph()
+
+
+def degree_label(degree):
+    """Badge text for a degree of separation, e.g. '2nd'; '3rd+' when out of range"""
+    if degree == 0:
+        return None
+    return DEGREE_LABELS.get(degree, '3rd+')
+
+
+@sa_event.listens_for(Connection, 'after_insert')
+@sa_event.listens_for(Connection, 'after_update')
+@sa_event.listens_for(Connection, 'after_delete')
+def _queue_graph_change(mapper, connection, target):
+    # Drop this worker's copy now and every worker's copy after the commit
+    connection_graph.invalidate(target.requester_id, target.requested_id)
+    publish_after_commit(target, GRAPH_CHANNEL, {'user_ids': [target.requester_id, target.requested_id]})
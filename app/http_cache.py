@@ -0,0 +1,105 @@
+"""
+HTTP caching for pages served to logged-out visitors and crawlers.
+
+A view decorated with @cached_page(version) handles anonymous GETs
+differently. version(**view_args) returns cheap version stamps, such as
+updated_at columns or post counts, together with a last-modified time, or
+None if the page must not be cached. The stamps become the ETag. A request
+whose If-None-Match or If-Modified-Since still matches gets a bare 304
+before the view runs, so no page queries or rendering happen.
+
+Responses carry the Cache-Control policy configured for their blueprint,
+plus Vary: Cookie. Signed-in users see personalised pages at the same
+URLs, so their responses are marked private and never validated.
+"""
+import hashlib
+import os
+from datetime import datetime
+from functools import wraps
+
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+
+
+class HttpCache:
+    def __init__(self, app=None):
+        self.template_stamp = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # Pages change when templates do, which only happens with a deploy
+        template_dir = os.path.join(app.root_path, app.template_folder)
+        mtimes = [os.path.getmtime(os.path.join(root, name))
+                  for root, _, names in os.walk(template_dir) for name in names]
+        self.template_stamp = datetime.utcfromtimestamp(int(max(mtimes))) if mtimes else None
+        app.extensions['http_cache'] = self
+
+    def applies(self):
+        # Pending flash messages are rendered into the page, so it cannot be shared
+        return (current_app.config['HTTP_CACHE_ENABLED'] and request.method in ('GET', 'HEAD')
+                and not current_user.is_authenticated and '_flashes' not in session)
+
+    def validators(self, stamps, last_modified):
+        parts = (request.endpoint, self.template_stamp) + tuple(stamps)
+        etag = hashlib.sha1(repr(parts).encode()).hexdigest()[:32]
+        if self.template_stamp and (last_modified is None or self.template_stamp > last_modified):
+            last_modified = self.template_stamp
+        return etag, last_modified.replace(microsecond=0) if last_modified else None
+
+    def not_modified(self, etag, last_modified):
+        # If-None-Match wins whenever the client sent one
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(etag)
+        since = request.if_modified_since
+        if last_modified is None or since is None:
+            return False
+        return last_modified <= since.replace(tzinfo=None)
+
+    def policy(self):
+        policies = current_app.config['HTTP_CACHE_CONTROL']
+        return policies.get(request.blueprint, policies['default'])
+
+    def apply(self, response, etag, last_modified):
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        response.headers['Cache-Control'] = self.policy()
+        response.vary.add('Cookie')
+        return response
+
+
+http_cache = HttpCache()
+
+
+def cached_page(version):
+    """Serve anonymous requests with validators from version(**view_args), answering 304 when unchanged"""
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            if not http_cache.applies():
+                response = make_response(view(*args, **kwargs))
+                if current_user.is_authenticated:
+                    response.headers['Cache-Control'] = current_app.config['HTTP_CACHE_PRIVATE']
+                    response.vary.add('Cookie')
+                return response
+
+            stamps = version(**kwargs)
+            if stamps is None:
+                return view(*args, **kwargs)
+            etag, last_modified = http_cache.validators(*stamps)
+            if http_cache.not_modified(etag, last_modified):
+                return http_cache.apply(current_app.response_class(status=304), etag, last_modified)
+
+            response = make_response(view(*args, **kwargs))
+            # Redirects, errors and responses that set a cookie stay uncached
+            if response.status_code != 200 or session.modified:
+                return response
+            return http_cache.apply(response, etag, last_modified)
+        return wrapped
+    return decorator
+
+
+def static_page(**kwargs):
+    """Version for pages that only change with their templates"""
+    return (), None
@@ -0,0 +1,77 @@
+"""
+Cached identity for Flask-Login's user_loader.
+
+Every authenticated request needs current_user. Without a cache, that is a
+SELECT of the whole users row. Instead, the light columns of recently seen
+users are kept in a short-TTL LRU per worker. On a hit the User is rebuilt
+from that snapshot and attached to the session as already loaded, so no
+query runs. summary and password_hash are never cached. They load on first
+access, as deferred columns do.
+
+Any flush that updates a users row, such as a profile edit or the
+last_login stamp at login, drops the entry in every worker through the
+event bus once the transaction commits.
+"""
+from sqlalchemy import event as sa_event
+from sqlalchemy.orm import defer, make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+
+from app import db
+from app.events import event_bus, publish_after_commit
+from app.models import User
+from app.ttl_cache import TTLCache
+
+IDENTITY_CHANNEL = 'identity'
+
+# Large or sensitive columns left out of the cache and loaded on demand
+DEFERRED_COLUMNS = ('summary', 'password_hash')
+CACHED_COLUMNS = tuple(column.key for column in User.__table__.c if column.key not in DEFERRED_COLUMNS)
+
+
+class IdentityCache:
+    def __init__(self, app=None):
+        self._snapshots = TTLCache(max_size=10000, ttl=30)  # user_id -> {column: value}
+        self._listener = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._snapshots.max_size = app.config['USER_CACHE_SIZE']
+        self._snapshots.ttl = app.config['USER_CACHE_TTL']
+        if self._listener is None:
+            self._listener = event_bus.listen(IDENTITY_CHANNEL, self._on_change)
+        app.extensions['identity_cache'] = self
+
+    def _on_change(self, change):
+        self.invalidate(*change['user_ids'])
+
+    def invalidate(self, *user_ids):
+        self._snapshots.invalidate(*user_ids)
+
+    def load(self, user_id):
+        """The User for user_id, attached to the session, or None"""
+        attached = db.session.identity_map.get(identity_key(User, user_id))
+        if attached is not None:
+            return attached
+
+        snapshot, generation = self._snapshots.get(user_id)
+        if snapshot is None:
+            user = User.query.options(*[defer(getattr(User, name)) for name in DEFERRED_COLUMNS]).get(user_id)
+            if user is not None:
+                self._snapshots.store({user_id: {name: getattr(user, name) for name in CACHED_COLUMNS}}, generation)
+            return user
+
+        # Rebuild as a persistent instance; unset (deferred) columns load on first access
+        user = User(**snapshot)
+        make_transient_to_detached(user)
+        db.session.add(user)
+        return user
+
+
+identity_cache = IdentityCache()
+
+
+@sa_event.listens_for(User, 'after_update')
+@sa_event.listens_for(User, 'after_delete')
+def _invalidate_identity(mapper, connection, target):
+    publish_after_commit(target, IDENTITY_CHANNEL, {'user_ids': [target.user_id]})
@@ -0,0 +1,205 @@
+"""
+Image processing for uploads.
+
+Uploaded images (post media, profile and cover photos, message images) are
+processed in a process pool once the upload's transaction commits, so
+Pillow's CPU-bound work never runs on a request thread or holds the GIL.
+The worker:
+
+* applies the EXIF orientation, then strips EXIF (camera, GPS) from the
+  original;
+* writes resized variants next to it, e.g. photo.jpg ->
+  photo.thumb.webp, photo.medium.webp and photo.medium.jpg;
+* reports the dimensions, which are stored in processed_images.
+
+Templates pick a variant with the image_variant filter. It falls back to
+the original until the variant exists on disk:
+
+    url_for('static', filename=user.profile_picture_url|image_variant('thumb'))
+
+Animated GIFs are left as they are; a single-frame variant would lose the
+animation.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from app import db
+from app.after_commit import after_commit
+from app.fragments import fragment_cache
+from app.models import ProcessedImage
+
+IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp'}
+
+# Variant name -> (longest side in pixels, formats written)
+VARIANTS = {
+    'thumb': (200, ('webp',)),
+    'medium': (1280, ('webp', 'jpg')),
+}
+
+SAVE_OPTIONS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def is_image(media_url):
+    return bool(media_url) and media_url.rsplit('.', 1)[-1].lower() in IMAGE_EXTENSIONS
+
+
+def variant_path(media_url, name, fmt):
+    return f"{media_url.rsplit('.', 1)[0]}.{name}.{fmt}"
+
+
+def _for_format(image, fmt):
+    # JPEG has no alpha channel, flatten onto white
+    if fmt == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    if fmt == 'WEBP' and image.mode not in ('RGB', 'RGBA'):
+        return image.convert('RGBA')
+    return image
+
+
+def process_image(path, variants):
+    """Pool worker: strip metadata and write variants; returns (width, height, variant names)"""
+    with Image.open(path) as source:
+        source_format = source.format
+        if getattr(source, 'is_animated', False):
+            return source.width, source.height, []
+        has_exif = bool(source.getexif())
+        image = ImageOps.exif_transpose(source)
+        image.load()
+
+    if has_exif and source_format in ('JPEG', 'PNG', 'WEBP'):
+        # Rewrite the original without EXIF (location, camera serials), already rotated upright
+        options = {'quality': 92} if source_format != 'PNG' else {}
+        tmp_path = f'{path}.tmp'
+        _for_format(image, source_format).save(tmp_path, source_format, **options)
+        os.replace(tmp_path, path)
+
+    written = []
+    for name, (size, formats) in variants.items():
+        resized = image.copy()
+        resized.thumbnail((size, size), Image.Resampling.LANCZOS)
+        root = path.rsplit('.', 1)[0]
+        for fmt in formats:
+            pil_format, options = SAVE_OPTIONS[fmt]
+            _for_format(resized, pil_format).save(f'{root}.{name}.{fmt}', pil_format, **options)
+        written.append(name)
+    return image.width, image.height, written
+
+
+class ImageProcessor:
+    def __init__(self, app=None):
+        self.asynchronous = True
+        self.max_workers = 2
+        self._app = None
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._ready = set()  # variant paths known to exist
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._app = app
+        self.asynchronous = app.config['IMAGE_PROCESSING_ASYNC']
+        self.max_workers = app.config['IMAGE_PROCESSING_WORKERS']
+        app.add_template_filter(self.variant, 'image_variant')
+        app.extensions['image_processor'] = self
+
+    def _pool(self):
+        # Pools do not survive fork(); spawn keeps the workers free of this process's threads
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._executor = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _path(self, media_url):
+        return os.path.join(self._app.static_folder, media_url)
+
+    def submit(self, media_url, owner=None):
+        """Process an uploaded image; owner is a fragment-cache (kind, id) to refresh when done"""
+        # Deduplicated media may already have been processed for an earlier upload
+        if not is_image(media_url) or self.processed(media_url):
+            return
+        if not self.asynchronous:
+            self._record(media_url, owner, process_image(self._path(media_url), VARIANTS))
+            return
+        future = self._pool().submit(process_image, self._path(media_url), VARIANTS)
+        future.add_done_callback(lambda done: self._finished(media_url, owner, done))
+
+    def _finished(self, media_url, owner, future):
+        try:
+            result = future.result()
+            with self._app.app_context():
+                self._record(media_url, owner, result)
+        except Exception:
+            self._app.logger.exception('Image processing failed for %s', media_url)
+
+    def _record(self, media_url, owner, result):
+        width, height, variants = result
+        stmt = mysql_insert(ProcessedImage.__table__).values(
+            media_url=media_url, width=width, height=height, variants=','.join(variants)
+        )
+        with db.engine.begin() as conn:
+            conn.execute(stmt.on_duplicate_key_update(
+                width=stmt.inserted.width, height=stmt.inserted.height, variants=stmt.inserted.variants
+            ))
+        if owner is not None:
+            fragment_cache.invalidate(*owner)
+
+    def process_after_commit(self, media_url, owner=None):
+        """Queue an upload for processing once the current transaction commits"""
+        pending_images.queue().append((media_url, owner))
+
+    def variant(self, media_url, name, fmt='webp'):
+        """Static path of a variant if it has been generated, otherwise the original"""
+        if not is_image(media_url):
+            return media_url
+        path = variant_path(media_url, name, fmt)
+        if path in self._ready:
+            return path
+        if os.path.exists(self._path(path)):
+            self._ready.add(path)
+            return path
+        return media_url
+
+    def processed(self, media_url):
+        return all(os.path.exists(self._path(variant_path(media_url, name, fmt)))
+                   for name, (_, formats) in VARIANTS.items() for fmt in formats)
+
+    def remove_files(self, media_url):
+        """Delete an image's variant files; the caller removes the original"""
+        if not is_image(media_url):
+            return
+        for name, (_, formats) in VARIANTS.items():
+            for fmt in formats:
+                path = variant_path(media_url, name, fmt)
+                self._ready.discard(path)
+                if os.path.exists(self._path(path)):
+                    os.remove(self._path(path))
+
+    def remove(self, media_url):
+        """Delete an image's variants and record"""
+        if not is_image(media_url):
+            return
+        self.remove_files(media_url)
+        ProcessedImage.query.filter_by(media_url=media_url).delete(synchronize_session=False)
+
+
+image_processor = ImageProcessor()
+
+
+@after_commit('pending_images')
+def pending_images(items):
+    for media_url, owner in items:
+        image_processor.submit(media_url, owner)
@@ -1,74 +1,51 @@
-from flask import render_template, request, current_app, jsonify, flash, redirect, url_for
+from flask import render_template, request, current_app, jsonify, flash, redirect, url_for, Response
 from flask_login import current_user, login_required
 from app import db
 from app.main import bp
-from app.models import User, Post, Connection, Notification, PostReaction, Comment
+from app.badges import badge_counters
+from app.events import event_bus, user_channel
+from app.feed import timeline_store
+from app.graph import connection_graph, degree_label
+from app.http_cache import cached_page, static_page
+from app.notifications import notify
+from app.post_list import with_authors, load_post_page
+from app.pagination import keyset_paginate
+from app.search import search_service, fetch_ordered
+from app.suggestions import top_suggestions
+from app.models import User, Post, Connection, Notification, PostReaction, Comment, REACTION_TYPES
 from app.forms import SearchForm
 from sqlalchemy import or_, and_, desc
+from sqlalchemy.orm import joinedload
 from datetime import datetime, timedelta
 
 @bp.route('/')
 @bp.route('/index')
+@cached_page(static_page)  # only the logged-out landing page is cached
 def index():
     # If user is not logged in, show landing page
     if not current_user.is_authenticated:
         return render_template('main/landing.html', title='Welcome to LinkedIn Clone')
 
-    # Get posts from user's connections and own posts
-    page = request.args.get('page', 1, type=int)
+    # Get connection suggestions (precomputed People You May Know) first: a stale set is
+    # recomputed and committed, which would expire the posts if they were already loaded
+    suggestions = top_suggestions(current_user.user_id, 5)
 
-    # Get connected user IDs
-    connected_users = db.session.query(Connection.requester_id, Connection.requested_id).filter(
-        and_(
-            or_(Connection.requester_id == current_user.user_id, Connection.requested_id == current_user.user_id),
-            Connection.status == 'accepted'
-        )
-    ).all()
-
-    connected_user_ids = set()
-    for req_id, resp_id in connected_users:
-        if req_id == current_user.user_id:
-            connected_user_ids.add(resp_id)
-        else:
-            connected_user_ids.add(req_id)
-
-    # Add current user's own posts
-    connected_user_ids.add(current_user.user_id)
-
-    # Get posts from connections and public posts
-    posts = Post.query.filter(
-        or_(
-            Post.user_id.in_(connected_user_ids),
-            Post.visibility == 'public'
-        )
-    ).order_by(desc(Post.created_at)).paginate(
-        page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False
-    )
-
-    # Get connection suggestions (users not already connected)
-    suggestions = User.query.filter(
-        and_(
-            User.user_id != current_user.user_id,
-            ~User.user_id.in_(connected_user_ids)
-        )
-    ).limit(5).all()
-
-    # Get unread notifications count
-    unread_notifications = Notification.query.filter_by(
-        user_id=current_user.user_id, is_read=False
-    ).count()
+    # Get posts from the precomputed timeline merged with public posts
+    cursor = request.args.get('cursor')
+    posts = load_post_page(timeline_store.read(current_user, cursor, current_app.config['POSTS_PER_PAGE']))
 
-    return render_template('main/index.html', title='Home', posts=posts, 
-                         suggestions=suggestions, unread_notifications=unread_notifications)
+    # The unread badge comes from the badge counters context processor
+    return render_template('main/index.html', title='Home', posts=posts, suggestions=suggestions)
 
 @bp.route('/explore')
 @login_required
 def explore():
     """Explore page showing all public posts"""
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.filter_by(visibility='public').order_by(desc(Post.created_at)).paginate(
-        page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False
-    )
+    cursor = request.args.get('cursor')
+    posts = load_post_page(keyset_paginate(
+        with_authors(Post.query.filter_by(visibility='public')), Post.created_at, Post.post_id,
+        cursor, current_app.config['POSTS_PER_PAGE']
+    ))
     return render_template('main/explore.html', title='Explore', posts=posts)
 
 @bp.route('/search')
@@ -76,39 +53,28 @@ def explore():
 def search():
     form = SearchForm()
     results = {'users': [], 'posts': [], 'companies': []}
+    degree_badges = {}
     query = request.args.get('q', '', type=str)
     search_type = request.args.get('type', 'all', type=str)
 
     if query:
         if search_type in ['all', 'people']:
-            # Search users
-            users = User.query.filter(
-                or_(
-                    User.first_name.contains(query),
-                    User.last_name.contains(query),
-                    User.username.contains(query),
-                    User.headline.contains(query)
-                )
-            ).limit(20).all()
-            results['users'] = users
+            # Search users, best match first
+            results['users'] = fetch_ordered(User, search_service.search_users(query, limit=20))
+            degrees = connection_graph.degrees(current_user.user_id, [user.user_id for user in results['users']])
+            degree_badges = {user_id: degree_label(degree) for user_id, degree in degrees.items()}
 
         if search_type in ['all', 'posts']:
-            # Search posts
-            posts = Post.query.filter(
-                and_(
-                    Post.content.contains(query),
-                    or_(
-                        Post.visibility == 'public',
-                        Post.user_id == current_user.user_id
-                    )
-                )
-            ).order_by(desc(Post.created_at)).limit(20).all()
-            results['posts'] = posts
+            # Search posts visible to the current user, best match first
+            post_ids = search_service.search_posts(query, limit=20, viewer_id=current_user.user_id)
+            results['posts'] = fetch_ordered(Post, post_ids, joinedload(Post.author))
 
     return render_template('main/search.html', title='Search Results', 
-                         form=form, results=results, query=query, search_type=search_type)
+                         form=form, results=results, query=query, search_type=search_type,
+                         degree_badges=degree_badges)
 
 @bp.route('/about')
+@cached_page(static_page)
 def about():
     return render_template('main/about.html', title='About')
 
@@ -118,6 +84,8 @@ def react_to_post(post_id):
     """API endpoint to react to a post"""
     post = Post.query.get_or_404(post_id)
     reaction_type = request.json.get('reaction_type', 'like')
+    if reaction_type not in REACTION_TYPES:
+        return jsonify({'status': 'error', 'message': 'Invalid reaction type'})
 
     # Check if user already reacted
     existing_reaction = PostReaction.query.filter_by(
@@ -128,9 +96,12 @@ def react_to_post(post_id):
         if existing_reaction.reaction_type == reaction_type:
             # Remove reaction
             db.session.delete(existing_reaction)
+            Post.adjust_counters(post_id, reaction_count=-1, **{f'{reaction_type}_count': -1})
             action = 'removed'
         else:
             # Update reaction type
+            Post.adjust_counters(post_id, **{f'{existing_reaction.reaction_type}_count': -1,
+                                             f'{reaction_type}_count': 1})
             existing_reaction.reaction_type = reaction_type
             action = 'updated'
     else:
@@ -141,24 +112,25 @@ def react_to_post(post_id):
             reaction_type=reaction_type
         )
         db.session.add(new_reaction)
+        Post.adjust_counters(post_id, reaction_count=1, **{f'{reaction_type}_count': 1})
         action = 'added'
 
         # Create notification for post author (if not self)
         if post.user_id != current_user.user_id:
-            notification = Notification(
+            notify(
                 user_id=post.user_id,
                 type='post_like',
                 title=f'{current_user.get_full_name()} reacted to your post',
                 message=f'{current_user.get_full_name()} {reaction_type}d your post.',
                 related_user_id=current_user.user_id,
                 related_post_id=post_id,
-                action_url=url_for('posts.view_post', id=post_id)
+                action_url=url_for('posts.view_post', id=post_id),
+                actor_name=current_user.get_full_name()
             )
-            db.session.add(notification)
 
     db.session.commit()
 
-    # Return updated counts
+    # Return updated counts (one row reload after the commit expired the post)
     return jsonify({
         'status': 'success',
         'action': action,
@@ -175,16 +147,24 @@ def react_to_post(post_id):
 @login_required
 def notifications():
     """Show user notifications"""
-    page = request.args.get('page', 1, type=int)
-    notifications = Notification.query.filter_by(user_id=current_user.user_id).order_by(
-        desc(Notification.created_at)
-    ).paginate(page=page, per_page=20, error_out=False)
+    cursor = request.args.get('cursor')
+    notifications = keyset_paginate(
+        Notification.query.filter_by(user_id=current_user.user_id),
+        Notification.created_at, Notification.notification_id, cursor, 20
+    )
 
-    # Mark all as read
-    Notification.query.filter_by(user_id=current_user.user_id, is_read=False).update({'is_read': True})
-    db.session.commit()
+    # Render before marking read so unread items are highlighted and the
+    # commit does not expire the loaded page
+    html = render_template('main/notifications.html', title='Notifications', notifications=notifications)
 
-    return render_template('main/notifications.html', title='Notifications', notifications=notifications)
+    # Mark all as read, skipping the UPDATE when nothing is unread
+    unread = Notification.query.filter_by(user_id=current_user.user_id, is_read=False)
+    if db.session.query(unread.exists()).scalar():
+        unread.update({'is_read': True}, synchronize_session=False)
+        badge_counters.clear('notifications', current_user.user_id)
+        db.session.commit()
+
+    return html
 
 @bp.route('/api/mark_notification_read/<int:notification_id>', methods=['POST'])
 @login_required
@@ -194,7 +174,30 @@ def mark_notification_read(notification_id):
         notification_id=notification_id, user_id=current_user.user_id
     ).first_or_404()
 
-    notification.is_read = True
-    db.session.commit()
+    if not notification.is_read:
+        notification.is_read = True
+        badge_counters.adjust('notifications', {current_user.user_id: -1})
+        db.session.commit()
 
     return jsonify({'status': 'success'})
+
+@bp.route('/api/badges')
+@login_required
+def badges():
+    """Unread notification and message counts for the navbar"""
+    return jsonify(badge_counters.get(current_user.user_id))
+
+@bp.route('/api/events')
+@login_required
+def event_stream():
+    """Server-Sent Events stream of message and notification events"""
+    user_id = current_user.user_id
+    timeout = current_app.config['EVENT_STREAM_TIMEOUT']
+    heartbeat = current_app.config['EVENT_STREAM_HEARTBEAT']
+
+    # Hand the pooled connection back before the stream goes idle
+    db.session.remove()
+
+    subscription = event_bus.subscribe(user_channel(user_id))
+    return Response(subscription.stream(timeout, heartbeat), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -0,0 +1,83 @@
+"""
+Serving of uploaded media under /static/uploads.
+
+This route is more specific than Flask's static route, so it takes over
+every url_for('static', filename='uploads/...') without template changes.
+Other static assets still go through Flask.
+
+* Byte ranges: responses are conditional and honour Range/If-Range, so
+  video players can seek and resume with 206 Partial Content.
+* Offload: with USE_X_SENDFILE (Apache/lighttpd) or
+  MEDIA_ACCEL_REDIRECT_PREFIX (nginx), the worker returns only headers and
+  the front server streams the file, so a long video download does not
+  hold a Python worker. For nginx, map the prefix to UPLOAD_FOLDER:
+
+      location /_uploads/ { internal; alias /srv/app/app/static/uploads/; }
+
+* Caching: media store names are content hashes and never change, so
+  they are cached for a year as immutable. The exception is an image
+  original still waiting for its EXIF strip (see images.py). Legacy uuid
+  names get MEDIA_CACHE_MAX_AGE.
+* Precompressed siblings written by `flask media compress` (.br, .gz)
+  are served to clients that accept them. Under X-Accel-Redirect nginx
+  drops Content-Encoding, so use its gzip_static there instead.
+"""
+import mimetypes
+import os
+
+from flask import abort, current_app, request, send_file
+from werkzeug.security import safe_join
+
+from app.images import image_processor, is_image
+from app.media import bp
+from app.media_store import BLOB_PREFIX, PRECOMPRESSED
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def negotiate_encoding(path):
+    """(Content-Encoding or None, path to send, whether the response varies by Accept-Encoding)"""
+    siblings = [(encoding, path + suffix) for encoding, suffix in PRECOMPRESSED if os.path.isfile(path + suffix)]
+    for encoding, candidate in siblings:
+        if request.accept_encodings[encoding]:
+            return encoding, candidate, True
+    return None, path, bool(siblings)
+
+
+def is_immutable(media_url):
+    if not media_url.startswith(BLOB_PREFIX):
+        return False
+    # The original is rewritten once when its EXIF is stripped; its variants are final when written
+    name = media_url.rsplit('/', 1)[-1]
+    return name.count('.') > 1 or not is_image(media_url) or image_processor.processed(media_url)
+
+
+@bp.route('/static/uploads/<path:filename>')
+def serve(filename):
+    path = safe_join(current_app.config['UPLOAD_FOLDER'], filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    media_url = f'uploads/{filename}'
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    accel_prefix = current_app.config['MEDIA_ACCEL_REDIRECT_PREFIX']
+    if accel_prefix:
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = f"{accel_prefix.rstrip('/')}/{filename}"
+    else:
+        encoding, served, negotiated = negotiate_encoding(path)
+        # Ranges, If-Range and 304s are handled here; X-Sendfile hands the body to the front server
+        response = send_file(served, mimetype=mimetype, download_name=os.path.basename(path), conditional=True)
+        if encoding:
+            response.content_encoding = encoding
+        if negotiated:
+            response.vary.add('Accept-Encoding')
+
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    if is_immutable(media_url):
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = current_app.config['MEDIA_CACHE_MAX_AGE']
+    return response
@@ -0,0 +1,309 @@
+"""
+Content-addressed media store.
+
+Uploads are hashed as they stream to a temp file and stored once per
+distinct content at uploads/media/ab/cd/<sha256>.<ext>. A second upload of
+the same bytes reuses the existing file. Since a name always refers to the
+same upload, the URLs can be cached forever.
+
+media_blobs.ref_count counts the rows that point at a blob:
+Post.media_url, Message.media_url, User.profile_picture_url and
+User.cover_photo_url. save()/adopt() take a reference and release() drops
+one. When a transaction that released references commits, blobs left with
+no references are garbage-collected together with their image variants.
+
+Concurrent uploads of the same content are safe. The reference upsert
+holds the blob's row lock until the uploading transaction commits. The
+collector deletes the row and the file under that same lock.
+
+Files stored before this existed (uuid names) are still served. Each is
+owned by a single row, so releasing one deletes its files once the
+transaction commits, and `flask media migrate` moves them into the store.
+
+`flask media compress` writes .br/.gz siblings of compressible documents,
+which the media blueprint serves to clients that accept them.
+"""
+import gzip
+import hashlib
+import os
+import tempfile
+import time
+from collections import namedtuple
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func, select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from werkzeug.utils import secure_filename
+
+from app import db
+from app.after_commit import after_commit
+from app.fragments import fragment_cache
+from app.images import image_processor
+from app.models import User, Post, Message, MediaBlob, ProcessedImage
+
+media_cli = AppGroup('media', help='Media store commands.')
+
+BLOB_PREFIX = 'uploads/media/'
+BLOCK_SIZE = 64 * 1024
+
+# Columns holding media URLs; each non-null blob URL is one reference
+REFERENCES = (
+    (Post, Post.post_id, Post.media_url),
+    (Message, Message.message_id, Message.media_url),
+    (User, User.user_id, User.profile_picture_url),
+    (User, User.user_id, User.cover_photo_url),
+)
+
+# Precompressed siblings as (Content-Encoding, suffix), most preferred first
+PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+COMPRESSIBLE_EXTENSIONS = {'txt', 'csv', 'json', 'svg', 'pdf', 'doc'}
+
+StoredMedia = namedtuple('StoredMedia', 'media_url size')
+
+MEDIA_KINDS = {'jpg': 'image', 'jpeg': 'image', 'png': 'image', 'gif': 'image',
+               'mp4': 'video', 'avi': 'video', 'mov': 'video'}
+
+
+def media_kind(filename):
+    """'image', 'video' or 'document', from the file extension"""
+    return MEDIA_KINDS.get(filename.rsplit('.', 1)[-1].lower(), 'document')
+
+
+def blob_url(sha256, extension):
+    return f'{BLOB_PREFIX}{sha256[:2]}/{sha256[2:4]}/{sha256}.{extension}'
+
+
+def blob_hash(media_url):
+    """The sha256 behind a store URL, or None for legacy uploads"""
+    if not media_url or not media_url.startswith(BLOB_PREFIX):
+        return None
+    return media_url.rsplit('/', 1)[-1].split('.', 1)[0]
+
+
+def static_path(media_url):
+    return os.path.join(current_app.static_folder, media_url)
+
+
+def remove_file(media_url):
+    """Delete an upload and its precompressed siblings"""
+    path = static_path(media_url)
+    for candidate in [path] + [path + suffix for _, suffix in PRECOMPRESSED]:
+        if os.path.exists(candidate):
+            os.remove(candidate)
+
+
+class MediaStore:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['media_store'] = self
+
+    def save(self, file):
+        """Stream an uploaded FileStorage into the store, hashing it on the way; returns StoredMedia"""
+        tmp_dir = current_app.config['UPLOAD_TMP_FOLDER']
+        os.makedirs(tmp_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, suffix='.upload')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    block = file.stream.read(BLOCK_SIZE)
+                    if not block:
+                        break
+                    out.write(block)
+                    digest.update(block)
+                    size += len(block)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return self.adopt(tmp_path, digest.hexdigest(), size, file.filename)
+
+    def adopt(self, path, sha256, size, filename):
+        """Move a complete file with a known hash into the store and take a reference to it"""
+        extension = secure_filename(filename).rsplit('.', 1)[-1].lower()[:10] or 'bin'
+        table = MediaBlob.__table__
+        stmt = mysql_insert(table).values(
+            sha256=sha256, extension=extension, size=size, ref_count=1, created_at=datetime.utcnow()
+        )
+        db.session.execute(stmt.on_duplicate_key_update(ref_count=table.c.ref_count + 1))
+        # The first upload's extension names the blob
+        extension = db.session.query(MediaBlob.extension).filter_by(sha256=sha256).scalar()
+
+        media_url = blob_url(sha256, extension)
+        target = static_path(media_url)
+        if os.path.exists(target):
+            os.remove(path)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(path, target)
+        return StoredMedia(media_url, size)
+
+    def release(self, media_url):
+        """Drop one reference; the blob is collected after commit if nothing else uses it"""
+        if not media_url:
+            return
+        sha256 = blob_hash(media_url)
+        if sha256 is None:
+            # Legacy upload owned by a single row: the files go only if the release commits
+            ProcessedImage.query.filter_by(media_url=media_url).delete(synchronize_session=False)
+            released_files.queue().append(media_url)
+            return
+        MediaBlob.query.filter_by(sha256=sha256).update(
+            {MediaBlob.ref_count: func.greatest(MediaBlob.ref_count - 1, 0)}, synchronize_session=False
+        )
+        released_blobs.queue().add(sha256)
+
+    def collect(self, sha256s=None):
+        """Delete unreferenced blobs (all of them when sha256s is None); returns how many"""
+        table = MediaBlob.__table__
+        query = select([table.c.sha256, table.c.extension]).where(table.c.ref_count <= 0)
+        if sha256s is not None:
+            query = query.where(table.c.sha256.in_(list(sha256s)))
+        with db.engine.begin() as conn:
+            rows = conn.execute(query.with_for_update()).fetchall()
+            for sha256, extension in rows:
+                media_url = blob_url(sha256, extension)
+                conn.execute(table.delete().where(table.c.sha256 == sha256))
+                conn.execute(ProcessedImage.__table__.delete().where(ProcessedImage.media_url == media_url))
+                remove_file(media_url)
+                image_processor.remove_files(media_url)
+        return len(rows)
+
+
+media_store = MediaStore()
+
+
+@after_commit('released_blobs', container=set)
+def released_blobs(sha256s):
+    media_store.collect(sha256s)
+
+
+@after_commit('released_files')
+def released_files(media_urls):
+    for media_url in media_urls:
+        remove_file(media_url)
+        image_processor.remove_files(media_url)
+
+
+def reference_counts():
+    """{sha256: references} recounted from every media column"""
+    counts = {}
+    for model, _, column in REFERENCES:
+        rows = db.session.query(column, func.count()).filter(column.like(f'{BLOB_PREFIX}%')).group_by(column)
+        for media_url, count in rows:
+            sha256 = blob_hash(media_url)
+            counts[sha256] = counts.get(sha256, 0) + count
+    return counts
+
+
+@media_cli.command('reconcile')
+def reconcile_command():
+    """Recount blob references from posts, messages and profiles, then collect unused blobs."""
+    counts = reference_counts()
+    fixed = 0
+    for sha256, ref_count in db.session.query(MediaBlob.sha256, MediaBlob.ref_count).all():
+        if counts.get(sha256, 0) != ref_count:
+            MediaBlob.query.filter_by(sha256=sha256).update({'ref_count': counts.get(sha256, 0)})
+            fixed += 1
+    db.session.commit()
+    collected = media_store.collect()
+    click.echo(f'Fixed {fixed} reference counts, collected {collected} unused blobs')
+
+
+@media_cli.command('gc')
+@click.option('--min-age', default=3600, show_default=True, help='Seconds before an untracked file counts as orphaned.')
+def gc_command(min_age):
+    """Collect unreferenced blobs and remove store files with no media_blobs row."""
+    collected = media_store.collect()
+    known = {blob_url(sha256, extension) for sha256, extension in db.session.query(MediaBlob.sha256, MediaBlob.extension)}
+    root = static_path(BLOB_PREFIX)
+    cutoff = time.time() - min_age
+    orphans = 0
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            media_url = BLOB_PREFIX + os.path.relpath(path, root).replace(os.sep, '/')
+            # Variants and precompressed siblings belong to their original; young files may be
+            # uploads still committing
+            if name.count('.') > 1 or media_url in known or os.path.getmtime(path) > cutoff:
+                continue
+            os.remove(path)
+            image_processor.remove_files(media_url)
+            orphans += 1
+    click.echo(f'Collected {collected} unused blobs, removed {orphans} orphaned files')
+
+
+@media_cli.command('migrate')
+@click.option('--batch-size', default=200, show_default=True, help='Rows moved per transaction.')
+def migrate_command(batch_size):
+    """Move legacy uuid-named uploads into the store, merging duplicates."""
+    moved = missing = 0
+    for model, key, column in REFERENCES:
+        last_id = 0
+        while True:
+            rows = db.session.query(key, column).filter(
+                key > last_id, column.isnot(None), ~column.like(f'{BLOB_PREFIX}%')
+            ).order_by(key).limit(batch_size).all()
+            if not rows:
+                break
+            for row_id, media_url in rows:
+                path = static_path(media_url)
+                if not os.path.exists(path):
+                    missing += 1
+                    continue
+                digest = hashlib.sha256()
+                with open(path, 'rb') as f:
+                    for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+                        digest.update(block)
+                image_processor.remove(media_url)
+                stored = media_store.adopt(path, digest.hexdigest(), os.path.getsize(path), media_url)
+                values = {column: stored.media_url}
+                if model is User:
+                    values[User.updated_at] = datetime.utcnow()  # re-versions cached headers and post cards
+                elif model is Post:
+                    fragment_cache.invalidate_after_commit('post', row_id)
+                db.session.query(model).filter(key == row_id).update(values, synchronize_session=False)
+                image_processor.process_after_commit(stored.media_url)
+                moved += 1
+            db.session.commit()
+            last_id = rows[-1][0]
+    click.echo(f'Moved {moved} uploads into the media store ({missing} files missing)')
+
+
+@media_cli.command('compress')
+@click.option('--level', default=9, show_default=True, help='gzip compression level.')
+def compress_command(level):
+    """Write .gz (and .br when brotli is installed) siblings for compressible uploads."""
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+        click.echo('brotli is not installed, writing .gz only (pip install brotli)')
+    encoders = {'gzip': lambda data: gzip.compress(data, compresslevel=level, mtime=0)}
+    if brotli is not None:
+        encoders['br'] = brotli.compress
+    written = 0
+    for directory, _, names in os.walk(current_app.config['UPLOAD_FOLDER']):
+        for name in names:
+            if name.rsplit('.', 1)[-1].lower() not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            path = os.path.join(directory, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            for encoding, suffix in PRECOMPRESSED:
+                if encoding not in encoders or os.path.exists(path + suffix):
+                    continue
+                compressed = encoders[encoding](data)
+                # Only worth serving when it saves something
+                if len(compressed) < len(data) * 0.9:
+                    with open(f'{path}{suffix}.tmp', 'wb') as out:
+                        out.write(compressed)
+                    os.replace(f'{path}{suffix}.tmp', path + suffix)
+                    written += 1
+    click.echo(f'Wrote {written} precompressed files')
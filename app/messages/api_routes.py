@@ -1,28 +1,115 @@
 # Place this code as app/messages/api_routes.py
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, make_response, current_app
 from flask_login import login_required, current_user
 from app import db
-from app.models import Message, Conversation
+from app.models import Message, Conversation, conversation_participants
+from app.pagination import keyset_paginate
+from app.messages.inbox import mark_read
+from app.messages.sync import change_count, deleted_since
+from sqlalchemy import or_, func
+from sqlalchemy.orm import joinedload
 from datetime import datetime
 
 api_bp = Blueprint('messages_api', __name__)
 
+def serialize_message(m):
+    return {
+        'id': m.message_id,
+        'sender_id': m.sender_id,
+        'sender_name': m.sender.get_full_name(),
+        'avatar': m.sender.profile_picture_url,
+        'content': m.content,
+        'created': m.created_at.strftime('%m/%d %I:%M %p'),
+        'edited': bool(m.is_edited),
+        'self': (m.sender_id==current_user.user_id)
+    }
+
+def is_participant(conversation_id, user_id):
+    """Membership check against the association table, without loading every participant"""
+    return db.session.query(conversation_participants.c.user_id).filter(
+        conversation_participants.c.conversation_id == conversation_id,
+        conversation_participants.c.user_id == user_id
+    ).first() is not None
+
 @api_bp.route('/get_messages/<int:conversation_id>', methods=['GET'])
 @login_required
 def get_messages(conversation_id):
-    messages = Message.query.filter_by(conversation_id=conversation_id).order_by(Message.created_at).all()
-    msg_list = []
-    for m in messages:
-        msg_list.append({
-            'id': m.message_id,
-            'sender_id': m.sender_id,
-            'sender_name': m.sender.get_full_name(),
-            'avatar': m.sender.profile_picture_url,
-            'content': m.content,
-            'created': m.created_at.strftime('%m/%d %I:%M %p'),
-            'self': (m.sender_id==current_user.user_id)
-        })
-    return jsonify({'messages': msg_list})
+    """Page backwards through history; pass next_cursor as ?cursor= for older messages"""
+    if not is_participant(conversation_id, current_user.user_id):
+        return jsonify({'status': 'error', 'message': 'Access denied'}), 403
+    messages = keyset_paginate(
+        Message.query.options(joinedload(Message.sender)).filter_by(conversation_id=conversation_id),
+        Message.created_at, Message.message_id, request.args.get('cursor'),
+        current_app.config['MESSAGES_PER_PAGE']
+    )
+    messages.items.reverse()
+    page = messages.to_dict(serialize_message)
+    return jsonify({'messages': page['items'], 'next_cursor': page['next_cursor'],
+                    'prev_cursor': page['prev_cursor']})
+
+@api_bp.route('/sync/<int:conversation_id>', methods=['GET'])
+@login_required
+def sync_messages(conversation_id):
+    """Return only messages created or edited, and ids deleted, after the client's cursor.
+
+    The cursor is (since, since_ts, changes): the highest message_id, the
+    latest updated_at and the conversation change count the client has seen.
+    The ETag is the change count, which moves on every insert, edit and
+    delete, so idle conversations are answered with a 304 from a primary key
+    lookup. Edits are matched inclusively on since_ts, so the client should
+    upsert messages by id.
+    """
+    if not is_participant(conversation_id, current_user.user_id):
+        return jsonify({'status': 'error', 'message': 'Access denied'}), 403
+
+    since = request.args.get('since', 0, type=int)
+    since_ts = request.args.get('since_ts', '', type=str)
+    changes = request.args.get('changes', 0, type=int)
+    try:
+        since_ts = datetime.fromisoformat(since_ts) if since_ts else None
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid since_ts'}), 400
+
+    # Conversation version stamp
+    current_changes = change_count(conversation_id)
+    etag = '{}-{}'.format(conversation_id, current_changes)
+
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+
+    last_id, last_updated = db.session.query(
+        func.max(Message.message_id), func.max(Message.updated_at)
+    ).filter(Message.conversation_id == conversation_id).one()
+    last_id = last_id or 0
+
+    query = Message.query.options(joinedload(Message.sender)).filter(
+        Message.conversation_id == conversation_id
+    )
+    if since_ts is not None:
+        query = query.filter(or_(Message.message_id > since, Message.updated_at >= since_ts))
+    else:
+        query = query.filter(Message.message_id > since)
+    messages = query.order_by(Message.message_id).all()
+    msg_list = [serialize_message(m) for m in messages]
+    deleted = deleted_since(conversation_id, changes) if changes < current_changes else []
+    if messages:
+        mark_read(conversation_id, current_user.user_id, last_id)
+        db.session.commit()
+
+    response = jsonify({
+        'messages': msg_list,
+        'deleted': deleted,
+        'cursor': {
+            'since': last_id,
+            'since_ts': last_updated.isoformat() if last_updated else None,
+            'changes': current_changes
+        }
+    })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 @api_bp.route('/edit_message', methods=['POST'])
 @login_required
@@ -32,5 +119,6 @@ def edit_message():
     if message.sender_id != current_user.user_id:
         return jsonify({'status': 'error', 'message': 'Not allowed'})
     message.content = data['content']
+    message.is_edited = True
     db.session.commit()
     return jsonify({'status': 'success'})
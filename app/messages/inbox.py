@@ -0,0 +1,114 @@
+from collections import defaultdict
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func, desc, or_, select
+from sqlalchemy.orm import defer
+from app import db
+from app.badges import badge_counters
+from app.models import User, Conversation, Message, conversation_participants
+
+messages_cli = AppGroup('messages', help='Messaging commands.')
+
+def load_inbox(user_id):
+    """Conversations with their latest message, other participants and unread count.
+
+    Latest message and unread count come from correlated subqueries on the
+    (conversation_id, message_id) index in a single statement; participants
+    for every conversation are fetched with one more query.
+    """
+    cp = conversation_participants
+    latest_id = db.session.query(func.max(Message.message_id)).filter(
+        Message.conversation_id == cp.c.conversation_id
+    ).correlate(cp).scalar_subquery()
+    unread_count = db.session.query(func.count(Message.message_id)).filter(
+        Message.conversation_id == cp.c.conversation_id,
+        Message.message_id > func.coalesce(cp.c.last_read_message_id, 0),
+        Message.sender_id != user_id
+    ).correlate(cp).scalar_subquery()
+
+    rows = db.session.query(Conversation, Message, unread_count).select_from(cp).join(
+        Conversation, Conversation.conversation_id == cp.c.conversation_id
+    ).outerjoin(
+        Message, Message.message_id == latest_id
+    ).filter(cp.c.user_id == user_id).order_by(desc(Conversation.updated_at)).all()
+
+    participants = defaultdict(list)
+    conversation_ids = [conv.conversation_id for conv, _, _ in rows]
+    if conversation_ids:
+        others = db.session.query(cp.c.conversation_id, User).join(
+            User, User.user_id == cp.c.user_id
+        ).options(defer(User.summary)).filter(
+            cp.c.conversation_id.in_(conversation_ids), cp.c.user_id != user_id
+        )
+        for conversation_id, user in others:
+            participants[conversation_id].append(user)
+
+    return [{
+        'conversation': conv,
+        'latest_message': latest_message,
+        'other_participants': participants[conv.conversation_id],
+        'unread_count': unread or 0
+    } for conv, latest_message, unread in rows]
+
+def private_conversation(sender, recipient):
+    """The private conversation between two users, created (and flushed) if there is none yet"""
+    conversation = db.session.query(Conversation).join(
+        Conversation.participants
+    ).filter(User.user_id == sender.user_id).join(
+        Conversation.participants.and_(User.user_id == recipient.user_id)
+    ).filter(Conversation.conversation_type == 'private').first()
+
+    if not conversation:
+        conversation = Conversation(
+            conversation_type='private',
+            created_by=sender.user_id
+        )
+        conversation.participants.append(sender)
+        conversation.participants.append(recipient)
+        db.session.add(conversation)
+        db.session.flush()  # Get the ID
+    return conversation
+
+def mark_read(conversation_id, user_id, message_id):
+    """Advance the user's read cursor; it never moves backwards"""
+    if not message_id:
+        return
+    cp = conversation_participants
+    last_read = db.session.query(cp.c.last_read_message_id).filter(
+        cp.c.conversation_id == conversation_id, cp.c.user_id == user_id
+    ).scalar() or 0
+    if last_read >= message_id:
+        return
+    newly_read = db.session.query(func.count(Message.message_id)).filter(
+        Message.conversation_id == conversation_id, Message.message_id > last_read,
+        Message.message_id <= message_id, Message.sender_id != user_id
+    ).scalar()
+    db.session.execute(cp.update().where(
+        (cp.c.conversation_id == conversation_id) & (cp.c.user_id == user_id) &
+        or_(cp.c.last_read_message_id.is_(None), cp.c.last_read_message_id < message_id)
+    ).values(last_read_message_id=message_id))
+    badge_counters.adjust('messages', {user_id: -newly_read})
+
+@messages_cli.command('backfill-read')
+@click.option('--batch-size', default=1000, show_default=True, help='Conversations updated per transaction.')
+def backfill_read_command(batch_size):
+    """Start read cursors that were never set at the conversation's latest message."""
+    cp = conversation_participants
+    latest_id = select([func.max(Message.message_id)]).where(
+        Message.conversation_id == cp.c.conversation_id
+    ).scalar_subquery()
+    last_id = 0
+    updated = 0
+    while True:
+        conversation_ids = [conversation_id for conversation_id, in db.session.query(
+            Conversation.conversation_id
+        ).filter(Conversation.conversation_id > last_id).order_by(Conversation.conversation_id).limit(batch_size)]
+        if not conversation_ids:
+            break
+        result = db.session.execute(cp.update().where(
+            cp.c.conversation_id.in_(conversation_ids), cp.c.last_read_message_id.is_(None)
+        ).values(last_read_message_id=latest_id))
+        db.session.commit()
+        updated += result.rowcount
+        last_id = conversation_ids[-1]
+    click.echo(f'Set {updated} read cursors; run `flask badges reconcile` to recount message badges')
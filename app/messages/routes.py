@@ -3,42 +3,24 @@ from flask_login import current_user, login_required
 from werkzeug.utils import secure_filename
 from app import db
 from app.messages import bp
-from app.models import User, Conversation, Message, Notification
+from app.models import User, Conversation, Message
+from app.notifications import notify
+from app.images import image_processor
+from app.media_store import media_store, media_kind
 from app.forms import MessageForm
+from app.pagination import keyset_paginate
+from app.messages.inbox import load_inbox, mark_read, private_conversation
+from app.typeahead import typeahead_index
+from sqlalchemy.orm import joinedload
 from sqlalchemy import or_, and_, desc
 from datetime import datetime
-import os
-import uuid
 
 @bp.route('/inbox')
 @login_required
 def inbox():
     """Show user's message inbox"""
-    # Get conversations where user is a participant
-    conversations = db.session.query(Conversation).join(
-        Conversation.participants
-    ).filter(User.user_id == current_user.user_id).order_by(
-        desc(Conversation.updated_at)
-    ).all()
-
-    # Get latest message for each conversation
-    conversation_data = []
-    for conv in conversations:
-        latest_message = Message.query.filter_by(
-            conversation_id=conv.conversation_id
-        ).order_by(desc(Message.created_at)).first()
-
-        # Get other participants (exclude current user)
-        other_participants = [p for p in conv.participants if p.user_id != current_user.user_id]
-
-        conversation_data.append({
-            'conversation': conv,
-            'latest_message': latest_message,
-            'other_participants': other_participants,
-            'unread_count': Message.query.filter_by(
-                conversation_id=conv.conversation_id
-            ).filter(Message.sender_id != current_user.user_id).count()  # Simplified unread logic
-        })
+    # Conversations with latest message, participants and unread counts
+    conversation_data = load_inbox(current_user.user_id)
 
     return render_template('messages/inbox.html', title='Messages', 
                          conversation_data=conversation_data)
@@ -54,23 +36,31 @@ def view_conversation(conversation_id):
         flash('You do not have access to this conversation.', 'error')
         return redirect(url_for('messages.inbox'))
 
-    # Get messages
-    page = request.args.get('page', 1, type=int)
-    messages = Message.query.filter_by(
-        conversation_id=conversation_id
-    ).order_by(Message.created_at.asc()).paginate(
-        page=page, per_page=current_app.config['MESSAGES_PER_PAGE'], error_out=False
+    # Get the newest messages first, then show them oldest at the top
+    cursor = request.args.get('cursor')
+    messages = keyset_paginate(
+        Message.query.options(joinedload(Message.sender)).filter_by(conversation_id=conversation_id),
+        Message.created_at, Message.message_id, cursor, current_app.config['MESSAGES_PER_PAGE']
     )
+    messages.items.reverse()
 
     # Get other participants
     other_participants = [p for p in conversation.participants if p.user_id != current_user.user_id]
 
     form = MessageForm()
 
-    return render_template('messages/conversation.html', title='Conversation',
+    html = render_template('messages/conversation.html', title='Conversation',
                          conversation=conversation, messages=messages,
                          other_participants=other_participants, form=form)
 
+    # Reading the newest page moves the read cursor (after rendering, as the
+    # commit expires the loaded messages)
+    if messages.items and not messages.has_prev:
+        mark_read(conversation_id, current_user.user_id, messages.items[-1].message_id)
+        db.session.commit()
+
+    return html
+
 @bp.route('/new_message/<username>')
 @login_required
 def new_message(username):
@@ -108,22 +98,7 @@ def send_message():
         recipient = User.query.get_or_404(recipient_id)
 
         # Find or create conversation
-        conversation = db.session.query(Conversation).join(
-            Conversation.participants
-        ).filter(User.user_id == current_user.user_id).join(
-            Conversation.participants.and_(User.user_id == recipient_id)
-        ).filter(Conversation.conversation_type == 'private').first()
-
-        if not conversation:
-            # Create new conversation
-            conversation = Conversation(
-                conversation_type='private',
-                created_by=current_user.user_id
-            )
-            conversation.participants.append(current_user)
-            conversation.participants.append(recipient)
-            db.session.add(conversation)
-            db.session.flush()  # Get the ID
+        conversation = private_conversation(current_user, recipient)
 
         # Create message
         message = Message(
@@ -138,24 +113,14 @@ def send_message():
             file = form.media_file.data
             if file.filename:
                 filename = secure_filename(file.filename)
-                unique_filename = str(uuid.uuid4()) + '_' + filename
-
-                # Determine upload folder
-                file_ext = filename.rsplit('.', 1)[1].lower()
-                if file_ext in ['jpg', 'jpeg', 'png', 'gif']:
-                    upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'messages', 'images')
-                    message.message_type = 'image'
-                else:
-                    upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'messages', 'files')
-                    message.message_type = 'file'
-
-                os.makedirs(upload_folder, exist_ok=True)
-                file_path = os.path.join(upload_folder, unique_filename)
-                file.save(file_path)
-
-                message.media_url = f'uploads/messages/{message.message_type}s/{unique_filename}'
+                message.message_type = 'image' if media_kind(filename) == 'image' else 'file'
+
+                # Stored once per distinct content in the media store
+                stored = media_store.save(file)
+                message.media_url = stored.media_url
                 message.file_name = filename
-                message.file_size = os.path.getsize(file_path)
+                message.file_size = stored.size
+                image_processor.process_after_commit(message.media_url)
 
         db.session.add(message)
 
@@ -163,16 +128,16 @@ def send_message():
         conversation.updated_at = datetime.utcnow()
 
         # Create notification for recipient
-        notification = Notification(
+        notify(
             user_id=recipient_id,
             type='message',
             title=f'New message from {current_user.get_full_name()}',
             message=f'{current_user.get_full_name()}: {form.content.data[:50]}...',
             related_user_id=current_user.user_id,
             action_url=url_for('messages.view_conversation', 
-                              conversation_id=conversation.conversation_id)
+                              conversation_id=conversation.conversation_id),
+            actor_name=current_user.get_full_name()
         )
-        db.session.add(notification)
 
         db.session.commit()
 
@@ -213,19 +178,19 @@ def send_quick_message():
     # Update conversation timestamp
     conversation.updated_at = datetime.utcnow()
 
-    # Create notifications for other participants
+    # Queue notifications for other participants (written in one batch after commit)
     for participant in conversation.participants:
         if participant.user_id != current_user.user_id:
-            notification = Notification(
+            notify(
                 user_id=participant.user_id,
                 type='message',
                 title=f'New message from {current_user.get_full_name()}',
                 message=f'{current_user.get_full_name()}: {content[:50]}...',
                 related_user_id=current_user.user_id,
                 action_url=url_for('messages.view_conversation', 
-                                  conversation_id=conversation_id)
+                                  conversation_id=conversation_id),
+                actor_name=current_user.get_full_name()
             )
-            db.session.add(notification)
 
     db.session.commit()
 
@@ -248,13 +213,9 @@ def delete_message(message_id):
     if message.sender_id != current_user.user_id:
         return jsonify({'status': 'error', 'message': 'You can only delete your own messages'})
 
-    # Delete associated media file
-    if message.media_url:
-        file_path = os.path.join(current_app.root_path, 'static', message.media_url)
-        if os.path.exists(file_path):
-            os.remove(file_path)
+    # Release the media; the file goes once nothing else references it
+    media_store.release(message.media_url)
 
-    conversation_id = message.conversation_id
     db.session.delete(message)
     db.session.commit()
 
@@ -263,30 +224,15 @@ def delete_message(message_id):
 @bp.route('/search_users')
 @login_required
 def search_users():
-    """Search users for messaging"""
+    """Typeahead for the recipient picker, answered from the in-memory index"""
     query = request.args.get('q', '', type=str)
 
-    if len(query) < 2:
+    if not query.strip():
         return jsonify([])
 
-    users = User.query.filter(
-        and_(
-            User.user_id != current_user.user_id,
-            or_(
-                User.first_name.contains(query),
-                User.last_name.contains(query),
-                User.username.contains(query)
-            )
-        )
-    ).limit(10).all()
-
-    user_list = []
-    for user in users:
-        user_list.append({
-            'user_id': user.user_id,
-            'username': user.username,
-            'full_name': user.get_full_name(),
-            'profile_picture': user.profile_picture_url or '/static/img/default-avatar.png'
-        })
-
-    return jsonify(user_list)
+    boost_ids = ()
+    if current_app.config['TYPEAHEAD_RANK_CONNECTIONS']:
+        boost_ids = current_user.get_connection_ids()
+
+    return jsonify(typeahead_index.suggest(query, limit=10, exclude_ids={current_user.user_id},
+                                           boost_ids=boost_ids))
@@ -0,0 +1,52 @@
+"""
+Change tracking for incremental message sync.
+
+messages.updated_at only has second precision, so two changes within one
+second look the same to a timestamp. conversations.change_count is bumped in
+the same transaction as every message insert, edit and delete. The sync
+endpoint uses it as its ETag and as the cursor for deletions: each deleted
+message leaves a message_deletions row stamped with the count its delete
+produced.
+"""
+from sqlalchemy import event as sa_event, select
+
+from app import db
+from app.models import Conversation, Message, MessageDeletion
+
+
+def change_count(conversation_id):
+    return db.session.query(Conversation.change_count).filter_by(conversation_id=conversation_id).scalar() or 0
+
+
+def deleted_since(conversation_id, changes):
+    """Ids of messages deleted after the client's change count"""
+    return [message_id for message_id, in db.session.query(MessageDeletion.message_id).filter(
+        MessageDeletion.conversation_id == conversation_id, MessageDeletion.change_count > changes
+    ).order_by(MessageDeletion.change_count)]
+
+
+def _bump(connection, conversation_id):
+    table = Conversation.__table__
+    # A message change is not a conversation edit, keep updated_at from firing its onupdate
+    connection.execute(table.update().where(table.c.conversation_id == conversation_id).values(
+        change_count=table.c.change_count + 1, updated_at=table.c.updated_at
+    ))
+
+
+@sa_event.listens_for(Message, 'after_insert')
+@sa_event.listens_for(Message, 'after_update')
+def _count_message_change(mapper, connection, target):
+    _bump(connection, target.conversation_id)
+
+
+@sa_event.listens_for(Message, 'after_delete')
+def _record_deletion(mapper, connection, target):
+    _bump(connection, target.conversation_id)
+    table = Conversation.__table__
+    # The row stays locked by the update above, so this is the count our delete produced
+    count = connection.execute(
+        select([table.c.change_count]).where(table.c.conversation_id == target.conversation_id)
+    ).scalar()
+    connection.execute(MessageDeletion.__table__.insert().values(
+        message_id=target.message_id, conversation_id=target.conversation_id, change_count=count
+    ))
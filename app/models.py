@@ -17,7 +17,8 @@ conversation_participants = db.Table('conversation_participants',
     db.Column('conversation_id', db.Integer, db.ForeignKey('conversations.conversation_id'), primary_key=True),
     db.Column('user_id', db.Integer, db.ForeignKey('users.user_id'), primary_key=True),
     db.Column('joined_at', db.DateTime, default=datetime.utcnow),
-    db.Column('role', db.String(20), default='member')
+    db.Column('role', db.String(20), default='member'),
+    db.Column('last_read_message_id', db.Integer)
 )
 
 class User(UserMixin, db.Model):
@@ -59,6 +60,11 @@ class User(UserMixin, db.Model):
     sent_connections = relationship('Connection', foreign_keys='Connection.requester_id', backref='requester', lazy='dynamic')
     received_connections = relationship('Connection', foreign_keys='Connection.requested_id', backref='requested', lazy='dynamic')
 
+    # Used by the 'database' search backend (see app/search.py)
+    __table_args__ = (
+        db.Index('ft_users_search', 'first_name', 'middle_name', 'last_name', 'username', 'headline', mysql_prefix='FULLTEXT'),
+    )
+
     def get_id(self):
         return str(self.user_id)
 
@@ -79,18 +85,19 @@ class User(UserMixin, db.Model):
             & (Connection.status == 'accepted')
         ).all()
 
+    # Relationship checks go through the cached connection graph (app/graph.py)
+
+    def get_connection_ids(self):
+        from app.graph import connection_graph
+        return connection_graph.connection_ids(self.user_id)
+
     def is_connected_with(self, user):
-        return Connection.query.filter(
-            ((Connection.requester_id == self.user_id) & (Connection.requested_id == user.user_id)) |
-            ((Connection.requester_id == user.user_id) & (Connection.requested_id == self.user_id))
-        ).filter(Connection.status == 'accepted').first() is not None
+        from app.graph import connection_graph
+        return connection_graph.is_connected(self.user_id, user.user_id)
 
     def connection_status_with(self, user):
-        connection = Connection.query.filter(
-            ((Connection.requester_id == self.user_id) & (Connection.requested_id == user.user_id)) |
-            ((Connection.requester_id == user.user_id) & (Connection.requested_id == self.user_id))
-        ).first()
-        return connection.status if connection else None
+        from app.graph import connection_graph
+        return connection_graph.status(self.user_id, user.user_id)
 
 class Post(db.Model):
     __tablename__ = 'posts'
@@ -110,21 +117,96 @@ class Post(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    # Denormalized counters, kept current by adjust_counters()
+    reaction_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    love_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    celebrate_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    support_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    funny_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    insightful_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    share_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     # Relationships
     reactions = relationship('PostReaction', backref='post', lazy='dynamic', cascade='all, delete-orphan')
     comments = relationship('Comment', backref='post', lazy='dynamic', cascade='all, delete-orphan')
     shares = relationship('PostShare', backref='post', lazy='dynamic', cascade='all, delete-orphan')
 
+    # Keyset pagination indexes (see app/pagination.py)
+    __table_args__ = (
+        db.Index('ix_posts_user_created', 'user_id', 'created_at', 'post_id'),
+        db.Index('ix_posts_visibility_created', 'visibility', 'created_at', 'post_id'),
+        db.Index('ft_posts_content', 'content', mysql_prefix='FULLTEXT'),
+    )
+
     def get_reaction_count(self, reaction_type=None):
         if reaction_type:
-            return self.reactions.filter_by(reaction_type=reaction_type).count()
-        return self.reactions.count()
+            return getattr(self, f'{reaction_type}_count') or 0
+        return self.reaction_count or 0
 
     def get_comment_count(self):
-        return self.comments.count()
+        return self.comment_count or 0
 
     def get_share_count(self):
-        return self.shares.count()
+        return self.share_count or 0
+
+    @classmethod
+    def adjust_counters(cls, post_id, **deltas):
+        """Atomically add deltas to counter columns, e.g. adjust_counters(1, like_count=1)"""
+        values = {getattr(cls, name): getattr(cls, name) + delta for name, delta in deltas.items() if delta}
+        if not values:
+            return
+        # Counter bumps are not edits, keep updated_at from firing its onupdate
+        values[cls.updated_at] = cls.updated_at
+        cls.query.filter(cls.post_id == post_id).update(values, synchronize_session=False)
+        # ...so cached cards showing the counts are dropped explicitly
+        from app.fragments import fragment_cache
+        fragment_cache.invalidate_after_commit('post', post_id)
+
+class TimelineEntry(db.Model):
+    """A post pushed into a user's home feed when it was created (fan-out on write)"""
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id', ondelete='CASCADE'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.post_id', ondelete='CASCADE'), primary_key=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('users.user_id', ondelete='CASCADE'), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (db.Index('ix_timeline_user_created', 'user_id', 'created_at', 'post_id'),)
+
+class ConnectionSuggestion(db.Model):
+    """A precomputed "People You May Know" candidate, refreshed by `flask suggestions refresh`"""
+    __tablename__ = 'connection_suggestions'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id', ondelete='CASCADE'), primary_key=True)
+    suggested_user_id = db.Column(db.Integer, db.ForeignKey('users.user_id', ondelete='CASCADE'), primary_key=True)
+    score = db.Column(db.Integer, nullable=False, default=0)
+    mutual_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    suggested_user = relationship('User', foreign_keys=[suggested_user_id])
+
+    __table_args__ = (db.Index('ix_suggestions_user_score', 'user_id', 'score', 'suggested_user_id'),)
+
+class SuggestionRefresh(db.Model):
+    """When a user's suggestions were last computed, even if none were found"""
+    __tablename__ = 'suggestion_refreshes'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id', ondelete='CASCADE'), primary_key=True)
+    refreshed_at = db.Column(db.DateTime, nullable=False)
+
+class MutualConnection(db.Model):
+    """Top mutual-connection counts per user, written by `flask suggestions mutuals`"""
+    __tablename__ = 'mutual_connections'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id', ondelete='CASCADE'), primary_key=True)
+    other_user_id = db.Column(db.Integer, db.ForeignKey('users.user_id', ondelete='CASCADE'), primary_key=True)
+    mutual_count = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (db.Index('ix_mutual_connections_user_count', 'user_id', 'mutual_count'),)
+
+REACTION_TYPES = ('like', 'love', 'celebrate', 'support', 'funny', 'insightful')
 
 class PostReaction(db.Model):
     __tablename__ = 'post_reactions'
@@ -270,6 +352,8 @@ class Conversation(db.Model):
     created_by = db.Column(db.Integer, db.ForeignKey('users.user_id'))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Bumped by every message insert, edit and delete (see app/messages/sync.py)
+    change_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     messages = relationship('Message', backref='conversation', lazy='dynamic', cascade='all, delete-orphan')
     creator = relationship('User', foreign_keys=[created_by])
@@ -290,6 +374,19 @@ class Message(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    __table_args__ = (db.Index('ix_messages_conversation_created', 'conversation_id', 'created_at', 'message_id'),)
+
+class MessageDeletion(db.Model):
+    """Tombstone of a deleted message, so syncing clients can drop it (see app/messages/sync.py)"""
+    __tablename__ = 'message_deletions'
+
+    message_id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.conversation_id', ondelete='CASCADE'), nullable=False)
+    change_count = db.Column(db.Integer, nullable=False)  # the conversation's count after the delete
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_message_deletions_conversation_change', 'conversation_id', 'change_count'),)
+
 class Notification(db.Model):
     __tablename__ = 'notifications'
 
@@ -303,7 +400,103 @@ class Notification(db.Model):
     action_url = db.Column(db.String(1000))
     is_read = db.Column(db.Boolean, default=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    # Coalesced notifications ("Ann and 12 others reacted to your post") share a group_key
+    group_key = db.Column(db.String(255))
+    actor_count = db.Column(db.Integer, nullable=False, default=1)
+    actor_ids = db.Column(db.JSON)  # distinct users folded into a coalesced row, so repeats are not recounted
+
+    __table_args__ = (
+        db.Index('ix_notifications_user_created', 'user_id', 'created_at', 'notification_id'),
+        db.Index('ix_notifications_user_group', 'user_id', 'group_key', 'is_read'),
+        db.Index('ix_notifications_user_unread', 'user_id', 'is_read'),
+    )
 
     user = relationship('User', foreign_keys=[user_id], backref='notifications')
     related_user = relationship('User', foreign_keys=[related_user_id])
     related_post = relationship('Post', foreign_keys=[related_post_id])
+
+class BadgeCounter(db.Model):
+    """Per-user unread counts behind the navbar badges (see app/badges.py)"""
+    __tablename__ = 'badge_counters'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id', ondelete='CASCADE'), primary_key=True)
+    unread_notifications = db.Column(db.Integer, nullable=False, default=0)
+    unread_messages = db.Column(db.Integer, nullable=False, default=0)
+
+class ProfileView(db.Model):
+    """One row per viewer per profile per day, written by app/profile_views.py"""
+    __tablename__ = 'profile_views'
+
+    profile_user_id = db.Column(db.Integer, db.ForeignKey('users.user_id', ondelete='CASCADE'), primary_key=True)
+    viewer_id = db.Column(db.Integer, db.ForeignKey('users.user_id', ondelete='CASCADE'), primary_key=True)
+    view_date = db.Column(db.Date, primary_key=True)
+    viewed_at = db.Column(db.DateTime, nullable=False)
+
+    viewer = relationship('User', foreign_keys=[viewer_id])
+
+    __table_args__ = (db.Index('ix_profile_views_profile_date', 'profile_user_id', 'view_date', 'viewed_at'),)
+
+class ArchivedNotification(db.Model):
+    """Notifications moved out of the live table by `flask notifications compact`"""
+    __tablename__ = 'archived_notifications'
+
+    notification_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    type = db.Column(db.String(50), nullable=False)
+    title = db.Column(db.String(255), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    related_user_id = db.Column(db.Integer)
+    related_post_id = db.Column(db.Integer)
+    action_url = db.Column(db.String(1000))
+    is_read = db.Column(db.Boolean, default=False)
+    created_at = db.Column(db.DateTime)
+    group_key = db.Column(db.String(255))
+    actor_count = db.Column(db.Integer, nullable=False, default=1)
+    actor_ids = db.Column(db.JSON)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ProcessedImage(db.Model):
+    """Dimensions and generated variants of an uploaded image (see app/images.py)"""
+    __tablename__ = 'processed_images'
+
+    image_id = db.Column(db.Integer, primary_key=True)
+    media_url = db.Column(db.String(500), unique=True, nullable=False)
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+    variants = db.Column(db.String(255))  # comma-separated variant names, e.g. 'thumb,medium'
+    processed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class UploadSession(db.Model):
+    """A resumable chunked upload in progress (see app/uploads)"""
+    __tablename__ = 'upload_sessions'
+
+    upload_id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id', ondelete='CASCADE'), nullable=False, index=True)
+    purpose = db.Column(db.Enum('post', 'message', name='upload_purpose_enum'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    total_size = db.Column(db.BigInteger, nullable=False)
+    received = db.Column(db.BigInteger, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class MediaBlob(db.Model):
+    """One stored file per distinct content, shared by every row that references it (see app/media_store.py)"""
+    __tablename__ = 'media_blobs'
+
+    sha256 = db.Column(db.String(64), primary_key=True)
+    extension = db.Column(db.String(10), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class LinkPreview(db.Model):
+    """OpenGraph metadata fetched for a shared URL, cached for link posts (see app/unfurl.py)"""
+    __tablename__ = 'link_previews'
+
+    url_hash = db.Column(db.String(64), primary_key=True)  # sha256 of the URL
+    url = db.Column(db.String(1000), nullable=False)
+    title = db.Column(db.String(500))
+    description = db.Column(db.Text)
+    image_url = db.Column(db.String(1000))
+    status = db.Column(db.Enum('ok', 'failed', name='link_preview_status_enum'), nullable=False, default='ok')
+    fetched_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
@@ -0,0 +1,128 @@
+"""
+Bulk mutual-connection counts for the suggestions engine.
+
+Accepted connections are loaded into a sparse symmetric adjacency matrix A.
+Row i of A·A then holds the number of connections user i shares with every
+other user. The product is taken one block of rows at a time, so peak memory
+depends on --chunk-size and not on the size of the network. The top
+MUTUALS_TOP_K counts per user are written to mutual_connections, which
+app/suggestions.py reads instead of walking the graph per user.
+
+Only this offline job needs numpy and scipy (pip install -r requirements-jobs.txt).
+"""
+import numpy as np
+from scipy import sparse
+
+from app import db
+from app.models import Connection, MutualConnection
+
+
+def load_edges(batch_size):
+    """(requester_ids, requested_ids, is_accepted) arrays for every connection row"""
+    requesters, requesteds, accepted = [], [], []
+    last_id = 0
+    while True:
+        rows = db.session.query(
+            Connection.connection_id, Connection.requester_id, Connection.requested_id, Connection.status
+        ).filter(Connection.connection_id > last_id).order_by(Connection.connection_id).limit(batch_size).all()
+        if not rows:
+            break
+        connection_ids, requester_ids, requested_ids, statuses = zip(*rows)
+        requesters.append(np.array(requester_ids, dtype=np.int64))
+        requesteds.append(np.array(requested_ids, dtype=np.int64))
+        accepted.append(np.array([status == 'accepted' for status in statuses], dtype=bool))
+        last_id = connection_ids[-1]
+    if not requesters:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=bool)
+    return np.concatenate(requesters), np.concatenate(requesteds), np.concatenate(accepted)
+
+
+def adjacency(sources, targets, size):
+    """Symmetric 0/1 CSR matrix with an entry for each (source, target) pair"""
+    rows = np.concatenate([sources, targets])
+    cols = np.concatenate([targets, sources])
+    matrix = sparse.coo_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(size, size)).tocsr()
+    matrix.data[:] = 1  # a pair stored in both directions is still one edge
+    return matrix
+
+
+def degree_stats(matrix):
+    degrees = np.diff(matrix.indptr)
+    if not len(degrees):
+        return {'users': 0, 'edges': 0, 'mean': 0.0, 'median': 0.0, 'p99': 0.0, 'max': 0}
+    return {
+        'users': len(degrees),
+        'edges': int(matrix.nnz // 2),
+        'mean': float(degrees.mean()),
+        'median': float(np.median(degrees)),
+        'p99': float(np.percentile(degrees, 99)),
+        'max': int(degrees.max()),
+    }
+
+
+def top_counts(block, top_k):
+    """Yield (row, column indices, counts) for each non-empty row, keeping the top_k counts"""
+    for row in range(block.shape[0]):
+        start, stop = block.indptr[row], block.indptr[row + 1]
+        if start == stop:
+            continue
+        cols = block.indices[start:stop]
+        counts = block.data[start:stop]
+        if stop - start > top_k:
+            best = np.argpartition(counts, -top_k)[-top_k:]
+            cols, counts = cols[best], counts[best]
+        yield row, cols, counts
+
+
+def recompute_mutuals(chunk_size, top_k, edge_batch_size, echo=print):
+    """Rewrite mutual_connections from the connections table, returning degree stats"""
+    requesters, requesteds, accepted = load_edges(edge_batch_size)
+    table = MutualConnection.__table__
+    if not len(requesters):
+        db.session.execute(table.delete())
+        db.session.commit()
+        return degree_stats(sparse.csr_matrix((0, 0), dtype=np.int32))
+
+    # Map user ids onto dense matrix indices (user_ids is sorted)
+    user_ids, inverse = np.unique(np.concatenate([requesters, requesteds]), return_inverse=True)
+    size = len(user_ids)
+    sources, targets = inverse[:len(requesters)], inverse[len(requesters):]
+    graph = adjacency(sources[accepted], targets[accepted], size)
+    linked = adjacency(sources, targets, size)  # any connection row, whatever its status
+    stats = degree_stats(graph)
+
+    written = 0
+    for start in range(0, size, chunk_size):
+        stop = min(start + chunk_size, size)
+        block = (graph[start:stop] @ graph).tocsr()
+
+        # Drop each user's own entry and anyone they already have a connection row with
+        own = sparse.csr_matrix(
+            (np.ones(stop - start, dtype=np.int32), (np.arange(stop - start), np.arange(start, stop))),
+            shape=(stop - start, size)
+        )
+        block = block - block.multiply((linked[start:stop] + own) > 0)
+        block.eliminate_zeros()
+
+        rows = []
+        for row, cols, counts in top_counts(block, top_k):
+            user_id = int(user_ids[start + row])
+            rows.extend({'user_id': user_id, 'other_user_id': int(user_ids[col]), 'mutual_count': int(count)}
+                        for col, count in zip(cols, counts))
+
+        # Replace the whole user id range this block covers, so users who
+        # lost their last connection since the previous run are cleared too
+        delete = table.delete()
+        if start > 0:
+            delete = delete.where(table.c.user_id > int(user_ids[start - 1]))
+        if stop < size:
+            delete = delete.where(table.c.user_id <= int(user_ids[stop - 1]))
+        db.session.execute(delete)
+        if rows:
+            db.session.execute(table.insert(), rows)
+        db.session.commit()
+        written += len(rows)
+        echo(f'Users {start + 1}-{stop} of {size}: {len(rows)} rows')
+
+    stats['rows'] = written
+    return stats
@@ -0,0 +1,292 @@
+"""
+Write-behind notification pipeline.
+
+Routes call notify() instead of adding Notification rows. Requests are held
+on the session until it commits and then handed to a background worker. The
+worker collects events for NOTIFY_FLUSH_INTERVAL seconds and writes each
+batch in a single transaction.
+
+Reactions, comments, shares and messages coalesce per recipient and post (or
+conversation), e.g. "Ann and 12 others reacted to your post". A burst is
+merged into the recipient's existing unread notification for that group
+instead of adding a row per event. The row keeps the ids of its distinct
+actors, so someone reacting twice or replying again is not counted twice.
+
+The queue is an in-process queue.Queue. With NOTIFY_ASYNC = False each batch
+is written on the committing thread instead, which suits the shell and CLI
+commands.
+
+`flask notifications compact` keeps the live table small for long-lived
+accounts. It merges old read notifications per (user, type, post) and moves
+anything past the retention window to archived_notifications, or deletes it.
+"""
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func, literal, select, tuple_
+
+from app import db
+from app.after_commit import after_commit
+from app.badges import badge_counters
+from app.batching import WriteBehindQueue
+from app.events import event_bus, user_channel
+from app.models import User, Notification, ArchivedNotification
+
+notifications_cli = AppGroup('notifications', help='Notification maintenance commands.')
+
+# Types that coalesce, with the title used once a group has several actors
+GROUPED_TITLES = {
+    'post_like': '{actor} and {others} reacted to your post',
+    'post_comment': '{actor} and {others} commented on your post',
+    'post_share': '{actor} and {others} shared your post',
+    'message': 'New messages from {actor} and {others}',
+}
+
+
+def group_key(type, related_post_id, action_url):
+    if type not in GROUPED_TITLES:
+        return None
+    return f'{type}:post:{related_post_id}' if related_post_id else f'{type}:{action_url}'
+
+
+def grouped_title(item, actor_count, titles=GROUPED_TITLES):
+    if actor_count <= 1 or not item.get('actor_name') or item['type'] not in titles:
+        return item['title']
+    others = actor_count - 1
+    return titles[item['type']].format(
+        actor=item['actor_name'], others=f"{others} other{'s' if others != 1 else ''}"
+    )
+
+
+def coalesce(items):
+    """Collapse queued notifications into one write per (recipient, group)"""
+    groups = OrderedDict()
+    for item in items:
+        key = group_key(item['type'], item.get('related_post_id'), item.get('action_url'))
+        slot = (item['user_id'], key) if key else (item['user_id'], None, len(groups))
+        group = groups.get(slot)
+        if group is None:
+            groups[slot] = group = {'key': key, 'actors': [], 'latest': item}
+        group['latest'] = item
+        actor = item.get('related_user_id')
+        if actor is not None and actor not in group['actors']:
+            group['actors'].append(actor)
+    return list(groups.values())
+
+
+def stored_actors(row):
+    """Distinct actor ids already counted on a notification row"""
+    if row.actor_ids is not None:
+        return list(row.actor_ids)
+    # Rows written before actor_ids existed only know their latest actor
+    return [row.related_user_id] if row.related_user_id is not None else []
+
+
+class NotificationPipeline(WriteBehindQueue):
+    thread_name = 'notification-writer'
+
+    def __init__(self, app=None):
+        super().__init__()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.configure(app, app.config['NOTIFY_ASYNC'], app.config['NOTIFY_FLUSH_INTERVAL'],
+                       app.config['NOTIFY_BATCH_SIZE'])
+        app.extensions['notification_pipeline'] = self
+
+    def write(self, items):
+        """Coalesce a batch and write it in one transaction, then push it to clients"""
+        groups = coalesce(items)
+        table = Notification.__table__
+        now = datetime.utcnow()
+        keyed = [(group['latest']['user_id'], group['key']) for group in groups if group['key']]
+        inserts, updates, events = [], [], []
+
+        with db.engine.begin() as conn:
+            existing = {}
+            if keyed:
+                # Locked so concurrent writers in other workers merge actors one after the other
+                rows = conn.execute(select([
+                    table.c.notification_id, table.c.user_id, table.c.group_key,
+                    table.c.related_user_id, table.c.actor_count, table.c.actor_ids
+                ]).where(tuple_(table.c.user_id, table.c.group_key).in_(keyed)).where(
+                    table.c.is_read == False
+                ).order_by(table.c.notification_id).with_for_update())
+                for row in rows:
+                    existing[(row.user_id, row.group_key)] = row
+
+            for group in groups:
+                item = group['latest']
+                current = existing.get((item['user_id'], group['key'])) if group['key'] else None
+                if current is not None:
+                    known = stored_actors(current)
+                    added = [actor for actor in group['actors'] if actor not in known]
+                    actor_count = current.actor_count + len(added)
+                    updates.append((current.notification_id, {
+                        'title': grouped_title(item, actor_count), 'message': item['message'],
+                        'related_user_id': item.get('related_user_id'), 'actor_count': actor_count,
+                        'actor_ids': known + added, 'created_at': now
+                    }))
+                else:
+                    actor_count = max(len(group['actors']), 1)
+                    inserts.append({
+                        'user_id': item['user_id'], 'type': item['type'],
+                        'title': grouped_title(item, actor_count), 'message': item['message'],
+                        'related_user_id': item.get('related_user_id'),
+                        'related_post_id': item.get('related_post_id'),
+                        'action_url': item.get('action_url'), 'group_key': group['key'],
+                        'actor_count': actor_count, 'actor_ids': group['actors'], 'is_read': False,
+                        'created_at': now
+                    })
+                events.append((item['user_id'], {
+                    'type': 'notification', 'notification_type': item['type'],
+                    'title': grouped_title(item, actor_count), 'action_url': item.get('action_url'),
+                    'new': current is None
+                }))
+
+            for notification_id, values in updates:
+                conn.execute(table.update().where(table.c.notification_id == notification_id).values(**values))
+            if inserts:
+                conn.execute(table.insert(), inserts)
+                new_unread = defaultdict(int)
+                for row in inserts:
+                    new_unread[row['user_id']] += 1
+                badge_counters.adjust('notifications', new_unread, connection=conn)
+
+        for user_id, payload in events:
+            event_bus.publish(user_channel(user_id), payload)
+        return len(inserts), len(updates)
+
+
+notification_pipeline = NotificationPipeline()
+
+
+def notification_item(user_id, type, title, message, related_user_id=None, related_post_id=None,
+                      action_url=None, actor_name=None):
+    return {
+        'user_id': user_id, 'type': type, 'title': title, 'message': message,
+        'related_user_id': related_user_id, 'related_post_id': related_post_id,
+        'action_url': action_url, 'actor_name': actor_name
+    }
+
+
+def notify(*args, **kwargs):
+    """Queue a notification; it is written after the current transaction commits"""
+    pending_notifications.queue().append(notification_item(*args, **kwargs))
+
+
+@after_commit('pending_notifications')
+def pending_notifications(items):
+    notification_pipeline.enqueue(items)
+
+
+# Compaction and retention
+
+COMPACT_TITLES = dict(GROUPED_TITLES, profile_view='{actor} and {others} viewed your profile')
+
+
+def same_post(post_id):
+    return Notification.related_post_id.is_(None) if post_id is None else Notification.related_post_id == post_id
+
+
+def compact_notifications(user_ids, cutoff):
+    """Merge read notifications older than cutoff into one row per (user, type, post)"""
+    groups = db.session.query(
+        Notification.user_id, Notification.type, Notification.related_post_id,
+        func.max(Notification.notification_id)
+    ).filter(
+        Notification.user_id.in_(user_ids), Notification.is_read == True,
+        Notification.created_at < cutoff, Notification.type.in_(list(COMPACT_TITLES))
+    ).group_by(
+        Notification.user_id, Notification.type, Notification.related_post_id
+    ).having(func.count() > 1).all()
+    if not groups:
+        return 0
+
+    keep_ids = [keep_id for _, _, _, keep_id in groups]
+    kept = {row.notification_id: row for row in db.session.query(
+        Notification.notification_id, Notification.title, Notification.related_user_id
+    ).filter(Notification.notification_id.in_(keep_ids))}
+    names = {user.user_id: user.get_full_name() for user in User.query.filter(
+        User.user_id.in_({row.related_user_id for row in kept.values() if row.related_user_id})
+    )}
+
+    removed = 0
+    for user_id, type, post_id, keep_id in groups:
+        merged = Notification.query.filter(
+            Notification.user_id == user_id, Notification.type == type, same_post(post_id),
+            Notification.is_read == True, Notification.created_at < cutoff,
+            Notification.notification_id <= keep_id
+        )
+        # Union of the rows' actors; rows from before actor_ids add their uncounted extras
+        actors, unknown = set(), 0
+        for row in merged.with_entities(Notification.related_user_id, Notification.actor_ids,
+                                        Notification.actor_count):
+            known = stored_actors(row)
+            actors.update(known)
+            unknown += max(row.actor_count - max(len(known), 1), 0)
+        removed += merged.filter(Notification.notification_id < keep_id).delete(synchronize_session=False)
+        row = kept[keep_id]
+        actor_count = max(len(actors) + unknown, 1)
+        item = {'title': row.title, 'type': type, 'actor_name': names.get(row.related_user_id)}
+        title = grouped_title(item, actor_count, COMPACT_TITLES)
+        Notification.query.filter_by(notification_id=keep_id).update(
+            {'actor_count': actor_count, 'actor_ids': sorted(actors), 'title': title}, synchronize_session=False
+        )
+    return removed
+
+
+def expire_notifications(user_ids, cutoff, archive, row_limit):
+    """Archive or delete notifications older than cutoff, row_limit rows per transaction"""
+    table = Notification.__table__
+    expired = 0
+    while True:
+        ids = [notification_id for notification_id, in db.session.query(Notification.notification_id).filter(
+            Notification.user_id.in_(user_ids), Notification.created_at < cutoff
+        ).order_by(Notification.notification_id).limit(row_limit)]
+        if not ids:
+            return expired
+        unread = db.session.query(Notification.user_id, func.count()).filter(
+            Notification.notification_id.in_(ids), Notification.is_read == False
+        ).group_by(Notification.user_id).all()
+        badge_counters.adjust('notifications', {user_id: -count for user_id, count in unread})
+        if archive:
+            columns = [column.name for column in table.c]
+            rows = select([table.c[name] for name in columns] + [literal(datetime.utcnow())]).where(
+                table.c.notification_id.in_(ids)
+            )
+            db.session.execute(ArchivedNotification.__table__.insert().from_select(columns + ['archived_at'], rows))
+        db.session.execute(table.delete().where(table.c.notification_id.in_(ids)))
+        db.session.commit()
+        expired += len(ids)
+
+
+@notifications_cli.command('compact')
+@click.option('--batch-size', default=200, show_default=True, help='Users processed per transaction.')
+@click.option('--row-limit', default=5000, show_default=True, help='Expired notifications moved per transaction.')
+@click.option('--delete', 'delete_expired', is_flag=True, help='Delete expired notifications instead of archiving.')
+def compact_command(batch_size, row_limit, delete_expired):
+    """Merge old read notifications and expire those past the retention window."""
+    now = datetime.utcnow()
+    compact_cutoff = now - timedelta(days=current_app.config['NOTIFICATION_COMPACT_AFTER_DAYS'])
+    retention_cutoff = now - timedelta(days=current_app.config['NOTIFICATION_RETENTION_DAYS'])
+    archive = current_app.config['NOTIFICATION_ARCHIVE'] and not delete_expired
+
+    last_id = 0
+    merged = expired = 0
+    while True:
+        user_ids = [user_id for user_id, in db.session.query(User.user_id).filter(
+            User.user_id > last_id
+        ).order_by(User.user_id).limit(batch_size)]
+        if not user_ids:
+            break
+        expired += expire_notifications(user_ids, retention_cutoff, archive, row_limit)
+        merged += compact_notifications(user_ids, compact_cutoff)
+        db.session.commit()
+        last_id = user_ids[-1]
+    action = 'archived' if archive else 'deleted'
+    click.echo(f'Merged away {merged} notifications, {action} {expired} past retention')
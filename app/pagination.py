@@ -0,0 +1,110 @@
+"""
+Keyset (seek) pagination with opaque cursors.
+
+Lists are ordered newest first on a (timestamp, id) key, or highest first on
+a (score, id) key. A cursor encodes the key of the last (or first) row shown
+plus the direction to read in, so every page is a single indexed range scan
+with no OFFSET and no COUNT.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+
+def encode_cursor(direction, key, row_id):
+    if isinstance(key, datetime):
+        key = {'t': key.isoformat()}
+    payload = json.dumps([direction, key, row_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Return (direction, key, row_id), or None for a missing or malformed cursor"""
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        direction, key, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if direction not in ('next', 'prev'):
+            return None
+        if isinstance(key, dict):
+            key = datetime.fromisoformat(key['t'])
+        elif not isinstance(key, (int, float)):
+            return None
+        return direction, key, int(row_id)
+    except (ValueError, TypeError, KeyError, binascii.Error):
+        return None
+
+
+def older_than(created_col, id_col, created_at, row_id):
+    return or_(created_col < created_at, and_(created_col == created_at, id_col < row_id))
+
+
+def newer_than(created_col, id_col, created_at, row_id):
+    return or_(created_col > created_at, and_(created_col == created_at, id_col > row_id))
+
+
+class KeysetPage:
+    """A page of rows plus opaque cursors for the neighbouring pages"""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def to_dict(self, serialize):
+        return {
+            'items': [serialize(item) for item in self.items],
+            'next_cursor': self.next_cursor,
+            'prev_cursor': self.prev_cursor
+        }
+
+
+def key_of(item, created_attr, id_attr):
+    return getattr(item, created_attr), getattr(item, id_attr)
+
+
+def build_page(rows, per_page, cursor, created_attr, id_attr):
+    """Turn rows read in cursor direction (per_page + 1 of them) into a KeysetPage"""
+    direction = cursor[0] if cursor else 'next'
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if direction == 'prev':
+        rows.reverse()
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if has_more or direction == 'prev':
+            next_cursor = encode_cursor('next', *key_of(rows[-1], created_attr, id_attr))
+        if cursor and (has_more or direction == 'next'):
+            prev_cursor = encode_cursor('prev', *key_of(rows[0], created_attr, id_attr))
+    return KeysetPage(rows, next_cursor, prev_cursor)
+
+
+def seek(query, created_col, id_col, cursor):
+    """Filter and order a query to read from a decoded cursor in its direction"""
+    if cursor is None:
+        return query.order_by(created_col.desc(), id_col.desc())
+    if cursor[0] == 'next':
+        return query.filter(older_than(created_col, id_col, cursor[1], cursor[2])).order_by(
+            created_col.desc(), id_col.desc())
+    return query.filter(newer_than(created_col, id_col, cursor[1], cursor[2])).order_by(
+        created_col.asc(), id_col.asc())
+
+
+def keyset_paginate(query, created_col, id_col, cursor_token, per_page):
+    """Paginate a query newest first on (created_col, id_col)"""
+    cursor = decode_cursor(cursor_token)
+    rows = seek(query, created_col, id_col, cursor).limit(per_page + 1).all()
+    return build_page(rows, per_page, cursor, created_col.key, id_col.key)
@@ -0,0 +1,96 @@
+"""
+Shared loader for post lists (home feed, explore, profile posts).
+
+Posts are fetched with their authors in the same query and wrapped in
+PostView objects that carry everything the post card templates read, so
+rendering a page never lazy-loads per post. Counters come from the
+denormalized columns on Post; the viewer's own reactions for the whole page
+are fetched with one query.
+"""
+import time
+
+import click
+from flask.cli import AppGroup
+from flask_login import current_user
+from sqlalchemy import event as sa_event, desc
+from sqlalchemy.orm import joinedload
+
+from app import db
+from app.models import Post, PostReaction, User
+
+posts_cli = AppGroup('posts', help='Post list commands.')
+
+
+class PostView:
+    """A post ready for rendering: the post row, its author and the viewer's reaction"""
+
+    __slots__ = ('post', 'viewer_reaction')
+
+    def __init__(self, post, viewer_reaction=None):
+        self.post = post
+        self.viewer_reaction = viewer_reaction
+
+    def __getattr__(self, name):
+        return getattr(self.post, name)
+
+
+def with_authors(query):
+    """Load post authors in the same round trip as the posts"""
+    return query.options(joinedload(Post.author))
+
+
+def build_post_views(posts, viewer=None):
+    """Wrap already loaded posts, fetching the viewer's reactions in one query"""
+    posts = list(posts)
+    reactions = {}
+    if posts and viewer is not None and viewer.is_authenticated:
+        reactions = dict(db.session.query(PostReaction.post_id, PostReaction.reaction_type).filter(
+            PostReaction.user_id == viewer.user_id,
+            PostReaction.post_id.in_([post.post_id for post in posts])
+        ))
+    return [PostView(post, reactions.get(post.post_id)) for post in posts]
+
+
+def load_post_page(pagination, viewer=None):
+    """Replace a page's items with PostViews in place and return the page"""
+    pagination.items = build_post_views(pagination.items, viewer if viewer is not None else current_user)
+    return pagination
+
+
+def render_card_fields(view):
+    """Touch every attribute a post card template reads"""
+    author = view.author
+    return (author.get_full_name(), author.username, author.headline, author.profile_picture_url,
+            view.get_reaction_count('like'), view.get_comment_count(), view.get_share_count(),
+            view.viewer_reaction)
+
+
+@posts_cli.command('bench-queries')
+@click.option('--sizes', default='5,10,25,50', show_default=True, help='Comma separated page sizes.')
+@click.option('--viewer-id', type=int, default=None, help='Load reactions for this user.')
+def bench_queries_command(sizes, viewer_id):
+    """Show that loading a post list page costs a constant number of queries."""
+    viewer = User.query.get(viewer_id) if viewer_id else None
+    engine = db.engine
+    statements = []
+
+    def count_statement(*args):
+        statements.append(1)
+
+    sa_event.listen(engine, 'before_cursor_execute', count_statement)
+    try:
+        for size in [int(s) for s in sizes.split(',')]:
+            db.session.expunge_all()
+            statements.clear()
+            started = time.perf_counter()
+            posts = with_authors(Post.query.filter_by(visibility='public')).order_by(
+                desc(Post.created_at)
+            ).limit(size).all()
+            views = build_post_views(posts, viewer)
+            for view in views:
+                render_card_fields(view)
+            elapsed = (time.perf_counter() - started) * 1000
+            click.echo(f'page size {size:>4}: {len(views):>4} posts, '
+                       f'{len(statements)} queries, {elapsed:.1f} ms')
+    finally:
+        sa_event.remove(engine, 'before_cursor_execute', count_statement)
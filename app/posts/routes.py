@@ -1,13 +1,16 @@
 from flask import render_template, redirect, url_for, flash, request, current_app, jsonify
 from flask_login import current_user, login_required
-from werkzeug.utils import secure_filename
 from app import db
 from app.posts import bp
-from app.models import Post, PostReaction, Comment, PostShare, User, Notification
+from app.models import Post, PostReaction, Comment, PostShare, User
+from app.notifications import notify
 from app.forms import PostForm, CommentForm
+from app.feed import timeline_store
+from app.fragments import fragment_cache
+from app.images import image_processor
+from app.media_store import media_store, media_kind
+from app.unfurl import link_unfurler
 from datetime import datetime
-import os
-import uuid
 
 def allowed_file(filename, allowed_extensions):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_extensions
@@ -29,28 +32,9 @@ def create_post():
         if form.media_file.data:
             file = form.media_file.data
             if allowed_file(file.filename, current_app.config['ALLOWED_EXTENSIONS']):
-                # Generate unique filename
-                filename = secure_filename(file.filename)
-                unique_filename = str(uuid.uuid4()) + '_' + filename
-
-                # Determine upload folder based on file type
-                file_ext = filename.rsplit('.', 1)[1].lower()
-                if file_ext in ['jpg', 'jpeg', 'png', 'gif']:
-                    upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'posts', 'images')
-                    post.post_type = 'image'
-                elif file_ext in ['mp4', 'avi', 'mov']:
-                    upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'posts', 'videos')
-                    post.post_type = 'video'
-                else:
-                    upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'posts', 'documents')
-                    post.post_type = 'document'
-
-                os.makedirs(upload_folder, exist_ok=True)
-                file_path = os.path.join(upload_folder, unique_filename)
-                file.save(file_path)
-
-                # Store relative path
-                post.media_url = f'uploads/posts/{post.post_type}s/{unique_filename}'
+                # Stored once per distinct content in the media store
+                post.post_type = media_kind(file.filename)
+                post.media_url = media_store.save(file).media_url
 
         # Handle link data
         if form.post_type.data == 'link' and form.link_url.data:
@@ -59,6 +43,11 @@ def create_post():
             post.link_description = form.link_description.data
 
         db.session.add(post)
+        db.session.flush()
+        timeline_store.fan_out_post(post)
+        image_processor.process_after_commit(post.media_url, owner=('post', post.post_id))
+        # Title, description and image the author left blank are filled in from the page
+        link_unfurler.unfurl_after_commit(post)
         db.session.commit()
 
         flash('Your post has been created!', 'success')
@@ -98,6 +87,7 @@ def edit_post(id):
 
     form = PostForm(obj=post)
     if form.validate_on_submit():
+        visibility_changed = post.visibility != form.visibility.data
         post.content = form.content.data
         post.visibility = form.visibility.data
         post.allow_comments = form.allow_comments.data
@@ -107,30 +97,18 @@ def edit_post(id):
         if form.media_file.data:
             file = form.media_file.data
             if allowed_file(file.filename, current_app.config['ALLOWED_EXTENSIONS']):
-                # Delete old media file if exists
-                if post.media_url:
-                    old_file_path = os.path.join(current_app.root_path, 'static', post.media_url)
-                    if os.path.exists(old_file_path):
-                        os.remove(old_file_path)
-
-                # Save new file
-                filename = secure_filename(file.filename)
-                unique_filename = str(uuid.uuid4()) + '_' + filename
-
-                file_ext = filename.rsplit('.', 1)[1].lower()
-                if file_ext in ['jpg', 'jpeg', 'png', 'gif']:
-                    upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'posts', 'images')
-                    post.post_type = 'image'
-                else:
-                    upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'posts', 'documents')
-                    post.post_type = 'document'
-
-                os.makedirs(upload_folder, exist_ok=True)
-                file_path = os.path.join(upload_folder, unique_filename)
-                file.save(file_path)
-
-                post.media_url = f'uploads/posts/{post.post_type}s/{unique_filename}'
-
+                # Drop the reference to the old media and store the new file
+                media_store.release(post.media_url)
+                post.post_type = media_kind(file.filename)
+                post.media_url = media_store.save(file).media_url
+                image_processor.process_after_commit(post.media_url, owner=('post', post.post_id))
+
+        # Re-deliver the post to its new audience
+        if visibility_changed:
+            timeline_store.remove_post(post.post_id)
+            timeline_store.fan_out_post(post)
+
+        fragment_cache.invalidate_after_commit('post', post.post_id)
         db.session.commit()
         flash('Your post has been updated!', 'success')
         return redirect(url_for('posts.view_post', id=id))
@@ -146,12 +124,11 @@ def delete_post(id):
         flash('You can only delete your own posts.', 'error')
         return redirect(url_for('posts.view_post', id=id))
 
-    # Delete associated media file
-    if post.media_url:
-        file_path = os.path.join(current_app.root_path, 'static', post.media_url)
-        if os.path.exists(file_path):
-            os.remove(file_path)
+    # Release the media; the file goes once nothing else references it
+    media_store.release(post.media_url)
 
+    timeline_store.remove_post(post.post_id)
+    fragment_cache.invalidate_after_commit('post', post.post_id)
     db.session.delete(post)
     db.session.commit()
 
@@ -175,19 +152,20 @@ def add_comment(id):
             content=form.content.data
         )
         db.session.add(comment)
+        Post.adjust_counters(id, comment_count=1)
 
         # Create notification for post author (if not self)
         if post.user_id != current_user.user_id:
-            notification = Notification(
+            notify(
                 user_id=post.user_id,
                 type='post_comment',
                 title=f'{current_user.get_full_name()} commented on your post',
                 message=f'{current_user.get_full_name()} commented: "{form.content.data[:50]}..."',
                 related_user_id=current_user.user_id,
                 related_post_id=id,
-                action_url=url_for('posts.view_post', id=id)
+                action_url=url_for('posts.view_post', id=id),
+                actor_name=current_user.get_full_name()
             )
-            db.session.add(notification)
 
         db.session.commit()
         flash('Your comment has been added!', 'success')
@@ -211,19 +189,20 @@ def share_post(id):
         share_message=share_message
     )
     db.session.add(share)
+    Post.adjust_counters(id, share_count=1)
 
     # Create notification for post author (if not self)
     if post.user_id != current_user.user_id:
-        notification = Notification(
+        notify(
             user_id=post.user_id,
             type='post_share',
             title=f'{current_user.get_full_name()} shared your post',
             message=f'{current_user.get_full_name()} shared your post with their network.',
             related_user_id=current_user.user_id,
             related_post_id=id,
-            action_url=url_for('posts.view_post', id=id)
+            action_url=url_for('posts.view_post', id=id),
+            actor_name=current_user.get_full_name()
         )
-        db.session.add(notification)
 
     db.session.commit()
 
@@ -243,6 +222,7 @@ def delete_comment(id):
 
     post_id = comment.post_id
     db.session.delete(comment)
+    Post.adjust_counters(post_id, comment_count=-1)
     db.session.commit()
 
     return jsonify({'status': 'success', 'message': 'Comment deleted successfully'})
@@ -1,31 +1,45 @@
 from flask import render_template, redirect, url_for, flash, request, current_app, jsonify
 from flask_login import current_user, login_required
-from werkzeug.utils import secure_filename
 from app import db
 from app.profile import bp
-from app.models import User, Post, WorkExperience, Education, Skill, Connection, Notification
+from app.models import User, Post, WorkExperience, Education, Skill, Connection
 from app.forms import ProfileForm, WorkExperienceForm, EducationForm
+from app.post_list import load_post_page
+from app.pagination import keyset_paginate
+from app.graph import connection_graph, degree_label
+from app.notifications import notification_item
+from app.http_cache import cached_page
+from app.profile_views import profile_view_tracker, view_count, view_stats
+from app.fragments import fragment_cache
+from app.images import image_processor
+from app.media_store import media_store
 from sqlalchemy import or_, and_, desc, func
 from datetime import datetime
-import os
-import uuid
 
 def allowed_file(filename):
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def save_profile_image(file, folder_name):
+def save_profile_image(file):
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        unique_filename = str(uuid.uuid4()) + '_' + filename
-        upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], folder_name)
-        os.makedirs(upload_folder, exist_ok=True)
-        file_path = os.path.join(upload_folder, unique_filename)
-        file.save(file_path)
-        return f'uploads/{folder_name}/{unique_filename}'
+        return media_store.save(file).media_url
     return None
 
+def public_profile_version(username):
+    """Version stamps for what a logged-out visitor sees of a profile"""
+    user = db.session.query(User.user_id, User.updated_at, User.privacy_level).filter_by(username=username).first()
+    if user is None or user.privacy_level == 'Private':
+        return None
+    posts = db.session.query(
+        func.count(), func.max(Post.created_at), func.max(Post.updated_at),
+        func.sum(Post.reaction_count), func.sum(Post.comment_count)
+    ).filter(Post.user_id == user.user_id, Post.visibility == 'public').one()
+    connection_count = len(connection_graph.connection_ids(user.user_id))
+    changed = [stamp for stamp in (user.updated_at, posts[1], posts[2]) if stamp]
+    return (user.updated_at, connection_count) + tuple(posts), max(changed) if changed else None
+
 @bp.route('/<username>')
+@cached_page(public_profile_version)
 def view_profile(username):
     user = User.query.filter_by(username=username).first_or_404()
 
@@ -33,18 +47,25 @@ def view_profile(username):
         flash('This profile is private.', 'info')
         return redirect(url_for('main.index'))
 
+    is_owner = current_user.is_authenticated and current_user.user_id == user.user_id
+    viewer_connected = current_user.is_authenticated and not is_owner and current_user.is_connected_with(user)
+
     if user.privacy_level == 'Connections Only' and current_user.is_authenticated:
-        if current_user.user_id != user.user_id and not current_user.is_connected_with(user):
+        if not is_owner and not viewer_connected:
             flash('This profile is only visible to connections.', 'info')
             return redirect(url_for('main.index'))
 
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     posts_query = Post.query.filter_by(user_id=user.user_id)
 
-    if not current_user.is_authenticated or current_user.user_id != user.user_id:
-        posts_query = posts_query.filter(or_(Post.visibility == 'public', and_(Post.visibility == 'connections', current_user.is_authenticated, current_user.is_connected_with(user))))
+    if not is_owner:
+        if viewer_connected:
+            posts_query = posts_query.filter(Post.visibility.in_(['public', 'connections']))
+        else:
+            posts_query = posts_query.filter(Post.visibility == 'public')
 
-    posts = posts_query.order_by(desc(Post.created_at)).paginate(page=page, per_page=10, error_out=False)
+    posts = load_post_page(keyset_paginate(posts_query, Post.created_at, Post.post_id, cursor,
+                                           current_app.config['POSTS_PER_PAGE']))
 
     work_experiences = WorkExperience.query.filter_by(user_id=user.user_id).order_by(desc(WorkExperience.start_date)).all()
     education = Education.query.filter_by(user_id=user.user_id).order_by(desc(Education.start_date)).all()
@@ -52,23 +73,31 @@ def view_profile(username):
 
     connection_status = None
     connection_id = None
+    degree_badge = None
+    if current_user.is_authenticated and not is_owner:
+        edge = connection_graph.edge(current_user.user_id, user.user_id)
+        if edge:
+            connection_status = edge.status
+            connection_id = edge.connection_id
+        degree_badge = degree_label(connection_graph.degree(current_user.user_id, user.user_id))
+
+    connection_count = len(connection_graph.connection_ids(user.user_id))
+
+    # Record the view (deduplicated per day, written in the background)
+    profile_view_count = None
     if current_user.is_authenticated and current_user.user_id != user.user_id:
-        connection = Connection.query.filter(or_(and_(Connection.requester_id == current_user.user_id, Connection.requested_id == user.user_id), and_(Connection.requester_id == user.user_id, Connection.requested_id == current_user.user_id))).first()
-        if connection:
-            connection_status = connection.status
-            connection_id = connection.connection_id
-
-    connection_count = Connection.query.filter(or_(Connection.requester_id == user.user_id, Connection.requested_id == user.user_id)).filter(Connection.status == 'accepted').count()
+        profile_view_tracker.record(user.user_id, current_user.user_id, notification=notification_item(user_id=user.user_id, type='profile_view', title=f'{current_user.get_full_name()} viewed your profile', message=f'{current_user.get_full_name()} viewed your profile.', related_user_id=current_user.user_id, action_url=url_for('profile.view_profile', username=current_user.username)))
+    elif is_owner:
+        profile_view_count = view_count(user.user_id, current_app.config['PROFILE_VIEW_STATS_DAYS'])
 
-    if current_user.is_authenticated and current_user.user_id != user.user_id:
-        today = datetime.utcnow().date()
-        existing_view_today = Notification.query.filter(and_(Notification.user_id == user.user_id, Notification.related_user_id == current_user.user_id, Notification.type == 'profile_view', func.date(Notification.created_at) == today)).first()
-        if not existing_view_today:
-            notification = Notification(user_id=user.user_id, type='profile_view', title=f'{current_user.get_full_name()} viewed your profile', message=f'{current_user.get_full_name()} viewed your profile.', related_user_id=current_user.user_id, action_url=url_for('profile.view_profile', username=current_user.username))
-            db.session.add(notification)
-            db.session.commit()
+    return render_template('profile/view_profile.html', title=f'{user.get_full_name()}', user=user, posts=posts, work_experiences=work_experiences, education=education, skills=skills, connection_status=connection_status, connection_id=connection_id, connection_count=connection_count, degree_badge=degree_badge, profile_view_count=profile_view_count)
 
-    return render_template('profile/view_profile.html', title=f'{user.get_full_name()}', user=user, posts=posts, work_experiences=work_experiences, education=education, skills=skills, connection_status=connection_status, connection_id=connection_id, connection_count=connection_count)
+@bp.route('/views')
+@login_required
+def profile_views():
+    """Who viewed your profile"""
+    stats = view_stats(current_user.user_id, current_app.config['PROFILE_VIEW_STATS_DAYS'])
+    return render_template('profile/profile_views.html', title='Who Viewed Your Profile', stats=stats)
 
 @bp.route('/edit')
 @login_required
@@ -97,35 +126,29 @@ def update_profile():
             current_user.updated_at = datetime.utcnow()
 
             if form.profile_picture.data:
-                if current_user.profile_picture_url:
-                    old_file_path = os.path.join(current_app.root_path, 'static', current_user.profile_picture_url)
-                    if os.path.exists(old_file_path):
-                        try:
-                            os.remove(old_file_path)
-                        except:
-                            pass
-                profile_pic_path = save_profile_image(form.profile_picture.data, 'profiles')
+                profile_pic_path = save_profile_image(form.profile_picture.data)
                 if profile_pic_path:
+                    media_store.release(current_user.profile_picture_url)
                     current_user.profile_picture_url = profile_pic_path
+                    image_processor.process_after_commit(profile_pic_path, owner=('user', current_user.user_id))
                 else:
+                    db.session.rollback()
                     flash('Invalid profile picture format. Please use JPG, PNG, or GIF.', 'error')
                     return render_template('profile/edit_profile.html', title='Edit Profile', form=form)
 
             if form.cover_photo.data:
-                if current_user.cover_photo_url:
-                    old_file_path = os.path.join(current_app.root_path, 'static', current_user.cover_photo_url)
-                    if os.path.exists(old_file_path):
-                        try:
-                            os.remove(old_file_path)
-                        except:
-                            pass
-                cover_pic_path = save_profile_image(form.cover_photo.data, 'profiles')
+                cover_pic_path = save_profile_image(form.cover_photo.data)
                 if cover_pic_path:
+                    media_store.release(current_user.cover_photo_url)
                     current_user.cover_photo_url = cover_pic_path
+                    image_processor.process_after_commit(cover_pic_path, owner=('user', current_user.user_id))
                 else:
+                    # Undo the edits made so far, including releasing a replaced profile picture
+                    db.session.rollback()
                     flash('Invalid cover photo format. Please use JPG, PNG, or GIF.', 'error')
                     return render_template('profile/edit_profile.html', title='Edit Profile', form=form)
 
+            fragment_cache.invalidate_after_commit('user', current_user.user_id)
             db.session.commit()
             flash('Your profile has been updated successfully!', 'success')
             return redirect(url_for('profile.view_profile', username=current_user.username))
@@ -0,0 +1,140 @@
+"""
+Profile-view tracking.
+
+A profile view is recorded at most once per viewer, profile and UTC day.
+Each worker checks a daily Bloom filter before queueing a view, so repeat
+views cost no database work. Queued views are written in batches to
+profile_views, whose primary key is the daily dedup key; views another
+worker already recorded are skipped. The first view of the day still
+notifies the profile owner through the notification pipeline.
+
+A Bloom filter false positive drops a genuinely new view, at about a 1%
+rate with the default sizing. That is an acceptable loss for view
+statistics.
+"""
+import hashlib
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select, tuple_
+
+from app import db
+from app.batching import WriteBehindQueue
+from app.models import User, ProfileView
+from app.notifications import notification_pipeline
+
+
+class DailyBloomFilter:
+    """Bloom filter of keys seen today; starts empty again when the UTC date changes"""
+
+    def __init__(self, bits, hashes):
+        self.bits = bits
+        self.hashes = hashes
+        self.day = None
+        self.array = bytearray((bits + 7) // 8)
+        self.lock = threading.Lock()
+
+    def _positions(self, key):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, key, day):
+        """Add key for day, returning False if it was (probably) already there"""
+        positions = self._positions(key)
+        with self.lock:
+            if day != self.day:
+                self.day = day
+                self.array = bytearray(len(self.array))
+            if all(self.array[p >> 3] & (1 << (p & 7)) for p in positions):
+                return False
+            for p in positions:
+                self.array[p >> 3] |= 1 << (p & 7)
+            return True
+
+
+class ProfileViewTracker(WriteBehindQueue):
+    thread_name = 'profile-view-writer'
+
+    def __init__(self, app=None):
+        super().__init__()
+        self.seen = DailyBloomFilter(8 * 1024 * 1024, 7)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.configure(app, app.config['PROFILE_VIEW_ASYNC'], app.config['PROFILE_VIEW_FLUSH_INTERVAL'],
+                       app.config['PROFILE_VIEW_BATCH_SIZE'])
+        self.seen = DailyBloomFilter(app.config['PROFILE_VIEW_BLOOM_BITS'], app.config['PROFILE_VIEW_BLOOM_HASHES'])
+        app.extensions['profile_view_tracker'] = self
+
+    def record(self, profile_user_id, viewer_id, notification=None):
+        """Queue a view unless it was already seen today; notification is sent if the view is new"""
+        now = datetime.utcnow()
+        if not self.seen.add(f'{profile_user_id}:{viewer_id}', now.date()):
+            return False
+        self.enqueue([{'profile_user_id': profile_user_id, 'viewer_id': viewer_id,
+                       'view_date': now.date(), 'viewed_at': now, 'notification': notification}])
+        return True
+
+    def write(self, items):
+        table = ProfileView.__table__
+        views = {}
+        for item in items:
+            views.setdefault((item['profile_user_id'], item['viewer_id'], item['view_date']), item)
+
+        with db.engine.begin() as conn:
+            # Another worker, or this one before a restart, may have recorded the view already
+            recorded = {tuple(row) for row in conn.execute(
+                select([table.c.profile_user_id, table.c.viewer_id, table.c.view_date]).where(
+                    tuple_(table.c.profile_user_id, table.c.viewer_id, table.c.view_date).in_(list(views))
+                )
+            )}
+            new = [item for key, item in views.items() if key not in recorded]
+            if new:
+                conn.execute(table.insert().prefix_with('IGNORE'), [
+                    {key: item[key] for key in ('profile_user_id', 'viewer_id', 'view_date', 'viewed_at')}
+                    for item in new
+                ])
+
+        notification_pipeline.enqueue([item['notification'] for item in new if item['notification']])
+        return len(new)
+
+
+profile_view_tracker = ProfileViewTracker()
+
+
+def view_count(user_id, days):
+    since = datetime.utcnow().date() - timedelta(days=days)
+    return db.session.query(func.count()).select_from(ProfileView).filter(
+        ProfileView.profile_user_id == user_id, ProfileView.view_date >= since
+    ).scalar()
+
+
+def view_stats(user_id, days, recent_limit=20):
+    """Who viewed a profile over the last days: totals, views per day and the latest viewers"""
+    since = datetime.utcnow().date() - timedelta(days=days)
+    in_window = (ProfileView.profile_user_id == user_id, ProfileView.view_date >= since)
+
+    total, unique_viewers = db.session.query(
+        func.count(), func.count(func.distinct(ProfileView.viewer_id))
+    ).filter(*in_window).one()
+
+    daily = db.session.query(ProfileView.view_date, func.count()).filter(*in_window).group_by(
+        ProfileView.view_date
+    ).order_by(ProfileView.view_date).all()
+
+    last_viewed = func.max(ProfileView.viewed_at).label('last_viewed')
+    recent = db.session.query(User, last_viewed).join(
+        ProfileView, ProfileView.viewer_id == User.user_id
+    ).filter(*in_window).group_by(User.user_id).order_by(last_viewed.desc()).limit(recent_limit).all()
+
+    return {
+        'days': days,
+        'total': total,
+        'unique_viewers': unique_viewers,
+        'daily': daily,
+        'recent': recent,
+    }
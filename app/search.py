@@ -0,0 +1,321 @@
+"""
+Search for people and posts.
+
+Two backends are available, picked with SEARCH_BACKEND:
+
+* 'local' keeps an in-memory inverted index per worker, built lazily from
+  the users and posts tables and updated from model change events relayed
+  over the event bus, so every worker sees every edit.
+* 'database' uses MySQL FULLTEXT indexes in boolean mode.
+
+Both rank results and treat the last query term as a prefix for typeahead.
+"""
+import math
+import re
+import threading
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+from sqlalchemy import event as sa_event, inspect, text
+
+from app import db
+from app.events import event_bus, publish_after_commit
+from app.models import User, Post
+
+SEARCH_CHANNEL = 'search'
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+USER_FIELDS = {'username': 3.0, 'first_name': 2.0, 'middle_name': 1.0, 'last_name': 2.0, 'headline': 1.0}
+POST_FIELDS = {'content': 1.0}
+
+
+def tokenize(value):
+    return TOKEN_RE.findall(value.lower()) if value else []
+
+
+def fetch_ordered(model, ids, *options):
+    """Load rows by primary key and return them in the order of ids"""
+    if not ids:
+        return []
+    pk = inspect(model).primary_key[0]
+    query = model.query.options(*options) if options else model.query
+    rows = {getattr(row, pk.key): row for row in query.filter(pk.in_(ids))}
+    return [rows[row_id] for row_id in ids if row_id in rows]
+
+
+class InvertedIndex:
+    """Token -> {doc_id: weight} postings with a sorted vocabulary for prefix lookups"""
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.postings = defaultdict(dict)
+        self.vocabulary = []
+        self.documents = {}
+        self.lock = threading.RLock()
+
+    def _weights(self, values):
+        weights = defaultdict(float)
+        for field, weight in self.fields.items():
+            for token in tokenize(values.get(field)):
+                weights[token] += weight
+        return weights
+
+    def add(self, doc_id, values, meta=None):
+        weights = self._weights(values)
+        with self.lock:
+            self._remove(doc_id)
+            for token, weight in weights.items():
+                if token not in self.postings:
+                    insort(self.vocabulary, token)
+                self.postings[token][doc_id] = weight
+            self.documents[doc_id] = (set(weights), meta or {})
+
+    def add_many(self, docs):
+        """Bulk add (doc_id, values, meta) rows; the vocabulary is re-sorted once by rebuild_vocabulary()"""
+        with self.lock:
+            for doc_id, values, meta in docs:
+                # Already indexed from a change event that arrived during the load, which is newer
+                if doc_id in self.documents:
+                    continue
+                weights = self._weights(values)
+                for token, weight in weights.items():
+                    self.postings[token][doc_id] = weight
+                self.documents[doc_id] = (set(weights), meta or {})
+
+    def rebuild_vocabulary(self):
+        with self.lock:
+            self.vocabulary = sorted(self.postings)
+
+    def remove(self, doc_id):
+        with self.lock:
+            self._remove(doc_id)
+
+    def _remove(self, doc_id):
+        entry = self.documents.pop(doc_id, None)
+        if entry is None:
+            return
+        for token in entry[0]:
+            postings = self.postings.get(token)
+            if postings is None:
+                continue
+            postings.pop(doc_id, None)
+            if not postings:
+                del self.postings[token]
+                # During a bulk load the vocabulary is not yet complete
+                position = bisect_left(self.vocabulary, token)
+                if position < len(self.vocabulary) and self.vocabulary[position] == token:
+                    del self.vocabulary[position]
+
+    def expand(self, prefix):
+        """Every vocabulary token starting with prefix, found by binary search"""
+        tokens = []
+        for position in range(bisect_left(self.vocabulary, prefix), len(self.vocabulary)):
+            token = self.vocabulary[position]
+            if not token.startswith(prefix):
+                break
+            tokens.append(token)
+        return tokens
+
+    def search(self, query, limit, prefix=True, predicate=None):
+        """Doc ids matching every term, best TF-IDF score first"""
+        terms = tokenize(query)
+        if not terms:
+            return []
+        with self.lock:
+            total = len(self.documents) or 1
+            scores = None
+            for position, term in enumerate(terms):
+                is_last = position == len(terms) - 1
+                tokens = self.expand(term) if prefix and is_last else [term]
+                term_scores = {}
+                for token in tokens:
+                    postings = self.postings.get(token)
+                    if not postings:
+                        continue
+                    idf = math.log(1 + total / len(postings))
+                    for doc_id, weight in postings.items():
+                        # Later terms only narrow the documents matched so far
+                        if scores is not None and doc_id not in scores:
+                            continue
+                        score = weight * idf
+                        if score > term_scores.get(doc_id, 0):
+                            term_scores[doc_id] = score
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {doc_id: scores[doc_id] + score
+                              for doc_id, score in term_scores.items() if doc_id in scores}
+                if not scores:
+                    return []
+
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+            results = []
+            for doc_id, _ in ranked:
+                if predicate is None or predicate(doc_id, self.documents[doc_id][1]):
+                    results.append(doc_id)
+                    if len(results) >= limit:
+                        break
+            return results
+
+
+class LocalSearchBackend:
+    def __init__(self):
+        self.users = InvertedIndex(USER_FIELDS)
+        self.posts = InvertedIndex(POST_FIELDS)
+        self._loaded = False
+        self._load_lock = threading.Lock()
+        self._listener = None
+
+    def start(self):
+        if self._listener is None:
+            self._listener = event_bus.listen(SEARCH_CHANNEL, self.apply)
+
+    def ensure_loaded(self, batch_size=1000):
+        if self._loaded:
+            return
+        with self._load_lock:
+            if self._loaded:
+                return
+            columns = [getattr(User, field) for field in USER_FIELDS]
+            for rows in self._batches(User.user_id, columns, batch_size):
+                self.users.add_many((row[0], dict(zip(USER_FIELDS, row[1:])), None) for row in rows)
+            self.users.rebuild_vocabulary()
+            for rows in self._batches(Post.post_id, [Post.content, Post.visibility, Post.user_id], batch_size):
+                self.posts.add_many(
+                    (post_id, {'content': content}, {'visibility': visibility, 'user_id': user_id})
+                    for post_id, content, visibility, user_id in rows
+                )
+            self.posts.rebuild_vocabulary()
+            self._loaded = True
+
+    def _batches(self, pk, columns, batch_size):
+        last_id = 0
+        while True:
+            rows = db.session.query(pk, *columns).filter(pk > last_id).order_by(pk).limit(batch_size).all()
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1][0]
+
+    def apply(self, change):
+        index = self.users if change['kind'] == 'user' else self.posts
+        if change['op'] == 'delete':
+            index.remove(change['id'])
+        else:
+            index.add(change['id'], change['values'], change.get('meta'))
+
+    def search_users(self, query, limit, exclude_ids=()):
+        self.ensure_loaded()
+        exclude_ids = set(exclude_ids)
+        predicate = (lambda doc_id, meta: doc_id not in exclude_ids) if exclude_ids else None
+        return self.users.search(query, limit, predicate=predicate)
+
+    def search_posts(self, query, limit, viewer_id=None):
+        self.ensure_loaded()
+        return self.posts.search(query, limit, prefix=False, predicate=lambda doc_id, meta: (
+            meta['visibility'] == 'public' or meta['user_id'] == viewer_id
+        ))
+
+
+class DatabaseSearchBackend:
+    USER_MATCH = 'MATCH (first_name, middle_name, last_name, username, headline) AGAINST (:q IN BOOLEAN MODE)'
+    POST_MATCH = 'MATCH (content) AGAINST (:q IN BOOLEAN MODE)'
+
+    def start(self):
+        pass
+
+    def boolean_query(self, query, prefix):
+        terms = tokenize(query)
+        if not terms:
+            return None
+        parts = [f'+{term}' for term in terms]
+        if prefix:
+            parts[-1] += '*'
+        return ' '.join(parts)
+
+    def search_users(self, query, limit, exclude_ids=()):
+        q = self.boolean_query(query, prefix=True)
+        if q is None:
+            return []
+        rows = db.session.query(User.user_id).filter(text(self.USER_MATCH).bindparams(q=q))
+        if exclude_ids:
+            rows = rows.filter(~User.user_id.in_(list(exclude_ids)))
+        rows = rows.order_by(text(self.USER_MATCH + ' DESC').bindparams(q=q)).limit(limit)
+        return [user_id for user_id, in rows]
+
+    def search_posts(self, query, limit, viewer_id=None):
+        q = self.boolean_query(query, prefix=False)
+        if q is None:
+            return []
+        rows = db.session.query(Post.post_id).filter(
+            text(self.POST_MATCH).bindparams(q=q),
+            (Post.visibility == 'public') | (Post.user_id == viewer_id)
+        ).order_by(text(self.POST_MATCH + ' DESC').bindparams(q=q)).limit(limit)
+        return [post_id for post_id, in rows]
+
+
+class SearchService:
+    """Facade over the configured backend"""
+
+    def __init__(self, app=None):
+        self.backend = LocalSearchBackend()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config.get('SEARCH_BACKEND') == 'database':
+            self.backend = DatabaseSearchBackend()
+        else:
+            self.backend = LocalSearchBackend()
+        self.backend.start()
+        app.extensions['search'] = self
+
+    def search_users(self, query, limit=20, exclude_ids=()):
+        return self.backend.search_users(query, limit, exclude_ids)
+
+    def search_posts(self, query, limit=20, viewer_id=None):
+        return self.backend.search_posts(query, limit, viewer_id)
+
+
+search_service = SearchService()
+
+
+# Model change hooks: indexed values are captured at flush time and relayed
+# to every worker's index after the transaction commits.
+
+def _changed(target, fields):
+    state = inspect(target)
+    return any(state.attrs[field].history.has_changes() for field in fields)
+
+
+@sa_event.listens_for(User, 'after_insert')
+@sa_event.listens_for(User, 'after_update')
+def _queue_user_change(mapper, connection, target):
+    if not _changed(target, USER_FIELDS):
+        return
+    publish_after_commit(target, SEARCH_CHANNEL, {
+        'kind': 'user', 'op': 'upsert', 'id': target.user_id,
+        'values': {field: getattr(target, field) for field in USER_FIELDS}
+    })
+
+
+@sa_event.listens_for(Post, 'after_insert')
+@sa_event.listens_for(Post, 'after_update')
+def _queue_post_change(mapper, connection, target):
+    if not _changed(target, ('content', 'visibility')):
+        return
+    publish_after_commit(target, SEARCH_CHANNEL, {
+        'kind': 'post', 'op': 'upsert', 'id': target.post_id,
+        'values': {'content': target.content},
+        'meta': {'visibility': target.visibility, 'user_id': target.user_id}
+    })
+
+
+@sa_event.listens_for(User, 'after_delete')
+def _queue_user_delete(mapper, connection, target):
+    publish_after_commit(target, SEARCH_CHANNEL, {'kind': 'user', 'op': 'delete', 'id': target.user_id})
+
+
+@sa_event.listens_for(Post, 'after_delete')
+def _queue_post_delete(mapper, connection, target):
+    publish_after_commit(target, SEARCH_CHANNEL, {'kind': 'post', 'op': 'delete', 'id': target.post_id})
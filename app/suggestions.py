@@ -0,0 +1,197 @@
+"""
+"People You May Know" suggestions.
+
+Candidates are scored by mutual connections plus shared companies, schools
+and skills, and the best SUGGESTIONS_PER_USER of them are stored per user in
+connection_suggestions, so the discover page and the home page sidebar are
+an indexed read. `flask suggestions refresh` recomputes them in batches.
+Users the batch job has not reached are computed on their first visit, and
+again once SUGGESTIONS_REFRESH_HOURS have passed. suggestion_refreshes
+records each computation, including those that found nobody, so a small
+or fully connected network does not recompute on every page view. On large networks run
+`flask suggestions mutuals` first so mutual counts come from the bulk job in
+app/mutuals.py rather than a per-user graph walk.
+"""
+import heapq
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import event as sa_event, func, or_, and_, select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.orm import joinedload
+
+from app import db
+from app.graph import connection_graph
+from app.models import (User, Connection, ConnectionSuggestion, SuggestionRefresh, MutualConnection,
+                        WorkExperience, Education, user_skills)
+
+suggestions_cli = AppGroup('suggestions', help='People You May Know commands.')
+
+# signal -> (user column, shared key column)
+SIGNALS = {
+    'company': (WorkExperience.user_id, WorkExperience.company_id),
+    'school': (Education.user_id, Education.institution_id),
+    'skill': (user_skills.c.user_id, user_skills.c.skill_id),
+}
+
+
+def mutual_counts(user_id):
+    """{other_user_id: number of connections shared with user_id}"""
+    stored = db.session.query(MutualConnection.other_user_id, MutualConnection.mutual_count).filter(
+        MutualConnection.user_id == user_id
+    ).all()
+    if stored:
+        return dict(stored)
+
+    counts = defaultdict(int)
+    friend_ids = connection_graph.connection_ids(user_id)
+    for edges in connection_graph.edges_many(friend_ids).values():
+        for other_id, edge in edges.items():
+            if edge.status == 'accepted':
+                counts[other_id] += 1
+    return counts
+
+
+def shared_counts(user_id, user_col, key_col, limit):
+    """{other_user_id: number of key_col values shared with user_id}, best matches only"""
+    mine = select([key_col]).where(and_(user_col == user_id, key_col.isnot(None)))
+    shared = func.count(func.distinct(key_col))
+    rows = db.session.query(user_col, shared).filter(
+        key_col.in_(mine), user_col != user_id
+    ).group_by(user_col).order_by(shared.desc()).limit(limit)
+    return dict(rows.all())
+
+
+def score_candidates(user_id):
+    """Score every candidate for user_id, returning ({user_id: score}, {user_id: mutual_count})"""
+    weights = current_app.config['SUGGESTION_WEIGHTS']
+    limit = current_app.config['SUGGESTION_CANDIDATE_LIMIT']
+    scores = defaultdict(int)
+    mutuals = mutual_counts(user_id)
+    for other_id, count in mutuals.items():
+        scores[other_id] += weights['mutual'] * count
+    for signal, (user_col, key_col) in SIGNALS.items():
+        for other_id, count in shared_counts(user_id, user_col, key_col, limit).items():
+            scores[other_id] += weights[signal] * count
+
+    # Anyone we already have a connection row with (any status) is not a suggestion
+    for other_id in set(connection_graph.edges(user_id)) | {user_id}:
+        scores.pop(other_id, None)
+    return scores, mutuals
+
+
+def refresh_user(user_id):
+    """Recompute and store user_id's suggestions, returning how many were stored"""
+    per_user = current_app.config['SUGGESTIONS_PER_USER']
+    scores, mutuals = score_candidates(user_id)
+
+    ranked = heapq.nlargest(per_user * 2, scores.items(), key=lambda item: (item[1], item[0]))
+    active = {uid for uid, in db.session.query(User.user_id).filter(
+        User.user_id.in_([uid for uid, _ in ranked]), User.is_active.isnot(False)
+    )} if ranked else set()
+    ranked = [(uid, score) for uid, score in ranked if uid in active][:per_user]
+
+    if len(ranked) < per_user:
+        # Not enough signal (e.g. a new account): top up with the newest members
+        excluded = set(connection_graph.edges(user_id)) | {user_id} | {uid for uid, _ in ranked}
+        newest = db.session.query(User.user_id).filter(User.is_active.isnot(False)).order_by(
+            User.created_at.desc(), User.user_id.desc()
+        ).limit(per_user + len(excluded))
+        for uid, in newest:
+            if uid not in excluded:
+                ranked.append((uid, 0))
+                if len(ranked) >= per_user:
+                    break
+
+    ConnectionSuggestion.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+    if ranked:
+        db.session.execute(ConnectionSuggestion.__table__.insert(), [
+            {'user_id': user_id, 'suggested_user_id': uid, 'score': score, 'mutual_count': mutuals.get(uid, 0)}
+            for uid, score in ranked
+        ])
+    stmt = mysql_insert(SuggestionRefresh.__table__).values(user_id=user_id, refreshed_at=datetime.utcnow())
+    db.session.execute(stmt.on_duplicate_key_update(refreshed_at=stmt.inserted.refreshed_at))
+    return len(ranked)
+
+
+def ensure_suggestions(user_id):
+    """Compute suggestions for users the batch job has not reached, or whose last refresh expired"""
+    refreshed_at = db.session.query(SuggestionRefresh.refreshed_at).filter_by(user_id=user_id).scalar()
+    max_age = timedelta(hours=current_app.config['SUGGESTIONS_REFRESH_HOURS'])
+    if refreshed_at is None or refreshed_at < datetime.utcnow() - max_age:
+        refresh_user(user_id)
+        db.session.commit()
+
+
+def suggestion_query(user_id):
+    return ConnectionSuggestion.query.filter_by(user_id=user_id).options(
+        joinedload(ConnectionSuggestion.suggested_user)
+    )
+
+
+def top_suggestions(user_id, limit):
+    """The best suggested users for user_id"""
+    ensure_suggestions(user_id)
+    rows = suggestion_query(user_id).order_by(
+        ConnectionSuggestion.score.desc(), ConnectionSuggestion.suggested_user_id.desc()
+    ).limit(limit)
+    return [row.suggested_user for row in rows]
+
+
+@sa_event.listens_for(Connection, 'after_insert')
+def _drop_suggestion(mapper, connection, target):
+    # Once either side sends a request the pair stops being a suggestion
+    table = ConnectionSuggestion.__table__
+    connection.execute(table.delete().where(or_(
+        and_(table.c.user_id == target.requester_id, table.c.suggested_user_id == target.requested_id),
+        and_(table.c.user_id == target.requested_id, table.c.suggested_user_id == target.requester_id)
+    )))
+
+
+@suggestions_cli.command('refresh')
+@click.option('--user-id', type=int, default=None, help='Only refresh this user\'s suggestions.')
+@click.option('--batch-size', default=100, show_default=True, help='Users refreshed per transaction.')
+def refresh_command(user_id, batch_size):
+    """Recompute People You May Know suggestions."""
+    if user_id is not None:
+        stored = refresh_user(user_id)
+        db.session.commit()
+        click.echo(f'Stored {stored} suggestions for user {user_id}')
+        return
+    last_id = 0
+    users = stored = 0
+    while True:
+        user_ids = [uid for uid, in db.session.query(User.user_id).filter(
+            User.user_id > last_id, User.is_active.isnot(False)
+        ).order_by(User.user_id).limit(batch_size)]
+        if not user_ids:
+            break
+        # Warm the graph cache for the whole batch with one query
+        connection_graph.edges_many(user_ids)
+        for uid in user_ids:
+            stored += refresh_user(uid)
+        db.session.commit()
+        users += len(user_ids)
+        last_id = user_ids[-1]
+    click.echo(f'Refreshed {users} users, stored {stored} suggestions')
+
+
+@suggestions_cli.command('mutuals')
+@click.option('--chunk-size', default=2000, show_default=True,
+              help='Users per sparse matrix product; bounds peak memory.')
+@click.option('--edge-batch-size', default=50000, show_default=True, help='Connection rows read per query.')
+@click.option('--top-k', type=int, default=None, help='Counts kept per user (defaults to MUTUALS_TOP_K).')
+def mutuals_command(chunk_size, edge_batch_size, top_k):
+    """Recompute mutual-connection counts for every user in bulk."""
+    try:
+        from app.mutuals import recompute_mutuals
+    except ImportError:
+        raise click.ClickException('This command needs numpy and scipy: pip install -r requirements-jobs.txt')
+    stats = recompute_mutuals(chunk_size, top_k or current_app.config['MUTUALS_TOP_K'], edge_batch_size,
+                              echo=click.echo)
+    click.echo(f"{stats['users']} users, {stats['edges']} connections, degree mean {stats['mean']:.1f}, "
+               f"median {stats['median']:.0f}, p99 {stats['p99']:.0f}, max {stats['max']}")
+    click.echo(f"Stored {stats.get('rows', 0)} mutual counts")
@@ -0,0 +1,61 @@
+"""
+Bounded per-worker LRU whose entries expire after a TTL.
+
+Used by the caches that sit in front of a query and are invalidated through
+the event bus (app/graph.py, app/identity.py). Every invalidation bumps a
+generation. A load reads the generation before it queries and hands it back
+to store(); if anything was invalidated in between, the result is dropped
+rather than cached, so a load racing with a change never caches old rows.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (loaded_at, value)
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        """({key: value} for every fresh entry, generation to pass to store())"""
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for key in keys:
+                cached = self._entries.get(key)
+                if cached is not None and now - cached[0] < self.ttl:
+                    self._entries.move_to_end(key)
+                    found[key] = cached[1]
+            return found, self._generation
+
+    def get(self, key):
+        """(value or None, generation to pass to store())"""
+        found, generation = self.get_many((key,))
+        return found.get(key), generation
+
+    def store(self, values, generation):
+        """Cache {key: value} unless anything was invalidated since generation was read"""
+        now = time.monotonic()
+        with self._lock:
+            if generation != self._generation:
+                return
+            for key, value in values.items():
+                self._entries[key] = (now, value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
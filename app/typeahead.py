@@ -0,0 +1,168 @@
+"""
+In-memory typeahead over usernames and names for the messaging recipient
+picker.
+
+Every user contributes a few normalized keys (username, first name, last
+name, full name) to one sorted array; a prefix lookup is a binary search
+plus a short scan, and the JSON payload for each user is kept alongside so
+answering a keystroke never touches the database. The index is loaded on
+first use, built and sorted in one pass, and then kept current by User
+change events relayed over the event bus.
+"""
+import threading
+from bisect import bisect_left, insort
+
+from sqlalchemy import event as sa_event, inspect
+
+from app import db
+from app.events import event_bus, publish_after_commit
+from app.models import User
+
+TYPEAHEAD_CHANNEL = 'typeahead'
+INDEXED_FIELDS = ('username', 'first_name', 'middle_name', 'last_name', 'profile_picture_url')
+DEFAULT_AVATAR = '/static/img/default-avatar.png'
+
+
+def normalize(value):
+    return ' '.join(value.lower().split()) if value else ''
+
+
+def full_name(values):
+    names = [values.get('first_name'), values.get('middle_name'), values.get('last_name')]
+    return ' '.join(name for name in names if name)
+
+
+def index_values(user_id, values):
+    """(keys, response payload) a user contributes to the index"""
+    name = full_name(values)
+    keys = {normalize(values.get('username')), normalize(values.get('first_name')),
+            normalize(values.get('last_name')), normalize(name)} - {''}
+    return keys, {
+        'user_id': user_id,
+        'username': values.get('username'),
+        'full_name': name,
+        'profile_picture': values.get('profile_picture_url') or DEFAULT_AVATAR
+    }
+
+
+class TypeaheadIndex:
+    def __init__(self):
+        self.entries = []  # sorted (key, user_id)
+        self.keys = {}  # user_id -> keys it contributed
+        self.profiles = {}  # user_id -> response payload
+        self.lock = threading.RLock()
+        self._load_lock = threading.Lock()
+        self._loaded = False
+        self._pending = None  # changes received while the initial load runs
+        self._listener = None
+
+    def start(self):
+        if self._listener is None:
+            self._listener = event_bus.listen(TYPEAHEAD_CHANNEL, self.apply)
+
+    def ensure_loaded(self, batch_size=1000):
+        if self._loaded:
+            return
+        with self._load_lock:
+            if self._loaded:
+                return
+            with self.lock:
+                self._pending = []
+            try:
+                # Built and sorted once, outside self.lock, so lookups and change events are not held up
+                entries, keys, profiles = [], {}, {}
+                columns = [getattr(User, field) for field in INDEXED_FIELDS]
+                last_id = 0
+                while True:
+                    rows = db.session.query(User.user_id, *columns).filter(
+                        User.user_id > last_id
+                    ).order_by(User.user_id).limit(batch_size).all()
+                    if not rows:
+                        break
+                    for row in rows:
+                        keys[row[0]], profiles[row[0]] = index_values(row[0], dict(zip(INDEXED_FIELDS, row[1:])))
+                        entries.extend((key, row[0]) for key in keys[row[0]])
+                    last_id = rows[-1][0]
+                entries.sort()
+            except BaseException:
+                with self.lock:
+                    self._pending = None
+                raise
+            with self.lock:
+                self.entries, self.keys, self.profiles = entries, keys, profiles
+                pending, self._pending = self._pending, None
+                self._loaded = True
+                # Changes committed during the load may be missing from the rows read; replaying is idempotent
+                for change in pending:
+                    self._apply(change)
+
+    def add(self, user_id, values):
+        keys, profile = index_values(user_id, values)
+        with self.lock:
+            self.remove(user_id)
+            for key in keys:
+                insort(self.entries, (key, user_id))
+            self.keys[user_id] = keys
+            self.profiles[user_id] = profile
+
+    def remove(self, user_id):
+        with self.lock:
+            for key in self.keys.pop(user_id, ()):
+                position = bisect_left(self.entries, (key, user_id))
+                if position < len(self.entries) and self.entries[position] == (key, user_id):
+                    del self.entries[position]
+            self.profiles.pop(user_id, None)
+
+    def apply(self, change):
+        with self.lock:
+            if self._loaded:
+                self._apply(change)
+            elif self._pending is not None:
+                self._pending.append(change)
+            # Before the first load there is nothing to update; the load reads current rows
+
+    def _apply(self, change):
+        if change['op'] == 'delete':
+            self.remove(change['id'])
+        else:
+            self.add(change['id'], change['values'])
+
+    def suggest(self, query, limit=10, exclude_ids=(), boost_ids=(), scan_limit=500):
+        """Users with a key starting with query; connections and exact matches rank first"""
+        self.ensure_loaded()
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        best = {}
+        with self.lock:
+            start = bisect_left(self.entries, (prefix,))
+            for key, user_id in self.entries[start:start + scan_limit]:
+                if not key.startswith(prefix):
+                    break
+                if user_id in exclude_ids:
+                    continue
+                rank = (0 if user_id in boost_ids else 1, 0 if key == prefix else 1, len(key), key)
+                if user_id not in best or rank < best[user_id]:
+                    best[user_id] = rank
+            ranked = sorted(best, key=lambda user_id: best[user_id])[:limit]
+            return [self.profiles[user_id] for user_id in ranked]
+
+
+typeahead_index = TypeaheadIndex()
+
+
+@sa_event.listens_for(User, 'after_insert')
+@sa_event.listens_for(User, 'after_update')
+def _queue_typeahead_change(mapper, connection, target):
+    state = inspect(target)
+    if not any(state.attrs[field].history.has_changes() for field in INDEXED_FIELDS):
+        return
+    publish_after_commit(target, TYPEAHEAD_CHANNEL, {
+        'op': 'upsert', 'id': target.user_id,
+        'values': {field: getattr(target, field) for field in INDEXED_FIELDS}
+    })
+
+
+@sa_event.listens_for(User, 'after_delete')
+def _queue_typeahead_delete(mapper, connection, target):
+    publish_after_commit(target, TYPEAHEAD_CHANNEL, {'op': 'delete', 'id': target.user_id})
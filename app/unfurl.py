@@ -0,0 +1,380 @@
+"""
+Link previews for link posts.
+
+create_post saves whatever title and description the author typed. Once
+the post commits, its URL is fetched on a background thread and the
+OpenGraph (or Twitter card, or plain <title>/description) metadata fills
+in link_title, link_description and link_image_url. Fields the author
+filled in are kept.
+
+Fetches are bounded so a slow or hostile site cannot tie up the pool:
+
+* LINK_UNFURL_TIMEOUT covers each socket operation and the whole read;
+* at most LINK_UNFURL_MAX_BYTES of HTML are read, and reading stops at
+  </head>;
+* only http(s) is fetched, with at most 3 redirects, and never from an
+  address that is not globally routable. The check is made on the socket
+  each connection actually opened, not on a separate DNS lookup, so a
+  host that rebinds to 127.0.0.1 or a metadata IP between the two is still
+  refused. Redirect hops connect through the same check, and environment
+  proxies are ignored. LINK_UNFURL_ALLOW_PRIVATE lifts the address check
+  so tests can unfurl a stub server on localhost.
+
+Results, failures included, are cached in link_previews by URL, so a
+link shared by many people is fetched once per LINK_UNFURL_CACHE_TTL.
+Posts of a URL whose fetch is already in flight in this worker wait for
+that fetch instead of starting another.
+"""
+import codecs
+import hashlib
+import http.client
+import ipaddress
+import os
+import socket
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import or_, select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from app import db
+from app.after_commit import after_commit
+from app.fragments import fragment_cache
+from app.models import LinkPreview, Post
+
+links_cli = AppGroup('links', help='Link preview commands.')
+
+BLOCK_SIZE = 16 * 1024
+MAX_REDIRECTS = 3
+HTML_TYPES = ('text/html', 'application/xhtml+xml')
+
+# Metadata field -> meta tags consulted, most preferred first
+META_KEYS = {
+    'title': ('og:title', 'twitter:title'),
+    'description': ('og:description', 'twitter:description', 'description'),
+    'image_url': ('og:image:secure_url', 'og:image', 'og:image:url', 'twitter:image', 'twitter:image:src'),
+}
+FIELD_LENGTHS = {'title': 500, 'description': 2000, 'image_url': 1000}
+
+# LinkPreview column -> Post column it fills
+POST_COLUMNS = {'title': 'link_title', 'description': 'link_description', 'image_url': 'link_image_url'}
+
+
+class UnfurlError(Exception):
+    pass
+
+
+def url_hash(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+def check_url(url):
+    """Raise UnfurlError unless url is an absolute http(s) URL"""
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise UnfurlError(f'Not an http(s) URL: {url}')
+
+
+def is_public(address):
+    return ipaddress.ip_address(address.split('%', 1)[0]).is_global
+
+
+def _connect_public(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    """socket.create_connection, refusing peers that are not globally routable"""
+    sock = socket.create_connection(address, timeout, source_address)
+    peer = sock.getpeername()[0]
+    if not is_public(peer):
+        sock.close()
+        raise UnfurlError(f'{address[0]} connected to non-public address {peer}')
+    return sock
+
+
+class _PublicConnectionMixin:
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_public
+
+
+class _PublicHTTPConnection(_PublicConnectionMixin, http.client.HTTPConnection):
+    pass
+
+
+class _PublicHTTPSConnection(_PublicConnectionMixin, http.client.HTTPSConnection):
+    pass
+
+
+class _PublicHTTPHandler(urllib.request.HTTPHandler):
+    def do_open(self, http_class, req, **kwargs):
+        return super().do_open(_PublicHTTPConnection, req, **kwargs)
+
+
+class _PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def do_open(self, http_class, req, **kwargs):
+        return super().do_open(_PublicHTTPSConnection, req, **kwargs)
+
+
+class _CheckedRedirects(urllib.request.HTTPRedirectHandler):
+    max_redirections = MAX_REDIRECTS
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        # urllib would also follow ftp:// redirects
+        check_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def build_opener(allow_private=False):
+    # No environment proxies: the connected peer must be the target itself
+    handlers = [urllib.request.ProxyHandler({}), _CheckedRedirects()]
+    if not allow_private:
+        handlers += [_PublicHTTPHandler(), _PublicHTTPSHandler()]
+    return urllib.request.build_opener(*handlers)
+
+
+class MetadataParser(HTMLParser):
+    """Collects <meta> tags and <title> from a document head"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.meta = {}
+        self.title = None
+        self.done = False
+        self._title_parts = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            # The rest of a block that ran past </head>
+            return
+        if tag == 'meta':
+            attrs = dict(attrs)
+            key = (attrs.get('property') or attrs.get('name') or '').lower()
+            content = (attrs.get('content') or '').strip()
+            if key and content:
+                self.meta.setdefault(key, content)
+        elif tag == 'title' and self.title is None:
+            self._title_parts = []
+        elif tag == 'body':
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self._title_parts is not None:
+            self.title = ' '.join(''.join(self._title_parts).split())
+            self._title_parts = None
+        elif tag == 'head':
+            self.done = True
+
+    def handle_data(self, data):
+        if self._title_parts is not None:
+            self._title_parts.append(data)
+
+    def metadata(self, base_url):
+        found = {field: next((self.meta[key] for key in keys if key in self.meta), None)
+                 for field, keys in META_KEYS.items()}
+        found['title'] = found['title'] or self.title or None
+        if found['image_url']:
+            image_url = urljoin(base_url, found['image_url'])
+            valid = urlsplit(image_url).scheme in ('http', 'https') and len(image_url) <= FIELD_LENGTHS['image_url']
+            found['image_url'] = image_url if valid else None
+        for field in ('title', 'description'):
+            if found[field]:
+                found[field] = found[field][:FIELD_LENGTHS[field]]
+        return found
+
+
+def fetch_metadata(url, timeout=3, max_bytes=512 * 1024, allow_private=False, user_agent='LinkPreview/1.0'):
+    """{'title', 'description', 'image_url'} for url; raises UnfurlError, OSError or HTTPException"""
+    check_url(url)
+    opener = build_opener(allow_private)
+    request = urllib.request.Request(url, headers={'User-Agent': user_agent, 'Accept': 'text/html,*/*;q=0.1'})
+    deadline = time.monotonic() + timeout
+    with opener.open(request, timeout=timeout) as response:
+        if response.headers.get_content_type() not in HTML_TYPES:
+            # A direct link to an image or file: nothing to unfurl, but not an error worth retrying
+            return dict.fromkeys(META_KEYS)
+        try:
+            decoder = codecs.getincrementaldecoder(response.headers.get_content_charset() or 'utf-8')('replace')
+        except LookupError:
+            decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        parser = MetadataParser()
+        remaining = max_bytes
+        while remaining and not parser.done:
+            if time.monotonic() > deadline:
+                raise UnfurlError(f'Timed out reading {url}')
+            # read1 returns what has arrived; read() would wait for a full block from a trickling server
+            block = response.read1(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            parser.feed(decoder.decode(block))
+        return parser.metadata(response.geturl())
+
+
+class LinkUnfurler:
+    def __init__(self, app=None):
+        self.enabled = True
+        self.asynchronous = True
+        self.max_workers = 4
+        self._app = None
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._inflight = {}  # url -> post ids waiting for its fetch
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._app = app
+        self.enabled = app.config['LINK_UNFURL_ENABLED']
+        self.asynchronous = app.config['LINK_UNFURL_ASYNC']
+        self.max_workers = app.config['LINK_UNFURL_WORKERS']
+        app.extensions['link_unfurler'] = self
+
+    def _pool(self):
+        # Threads do not survive fork(), so each worker process starts its own pool
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='unfurl')
+            return self._executor
+
+    def unfurl_after_commit(self, post):
+        """Fill in the post's link preview once the current transaction commits"""
+        if post.link_url:
+            pending_unfurls.queue().append((post.post_id, post.link_url))
+
+    def submit(self, post_id, url):
+        if not self.enabled:
+            return
+        if not self.asynchronous:
+            self._unfurl(url, [post_id])
+            return
+        with self._lock:
+            waiting = self._inflight.get(url)
+            if waiting is not None:
+                waiting.append(post_id)
+                return
+            post_ids = self._inflight[url] = [post_id]
+        self._pool().submit(self._run, url, post_ids)
+
+    def _run(self, url, post_ids):
+        with self._app.app_context():
+            self._unfurl(url, post_ids)
+
+    def _release(self, url, post_ids):
+        # Posts of this URL that arrived during the fetch have joined post_ids; later ones start their own
+        with self._lock:
+            if self._inflight.get(url) is post_ids:
+                del self._inflight[url]
+
+    def _unfurl(self, url, post_ids):
+        try:
+            preview = self.preview(url)
+            self._release(url, post_ids)
+            self.apply(preview, post_ids)
+        except Exception:
+            self._release(url, post_ids)
+            current_app.logger.exception('Link unfurl failed for %s', url)
+
+    def _expired(self, preview):
+        config = current_app.config
+        ttl = config['LINK_UNFURL_CACHE_TTL'] if preview['status'] == 'ok' else config['LINK_UNFURL_FAILURE_TTL']
+        return preview['fetched_at'] < datetime.utcnow() - timedelta(seconds=ttl)
+
+    def preview(self, url, refresh=False):
+        """Cached metadata for url as a dict, fetched when missing, expired or refresh is set"""
+        table = LinkPreview.__table__
+        key = url_hash(url)
+        if not refresh:
+            with db.engine.connect() as conn:
+                row = conn.execute(select([table]).where(table.c.url_hash == key)).first()
+            if row is not None and not self._expired(row._mapping):
+                return dict(row._mapping)
+
+        config = current_app.config
+        try:
+            metadata = fetch_metadata(url, config['LINK_UNFURL_TIMEOUT'], config['LINK_UNFURL_MAX_BYTES'],
+                                      config['LINK_UNFURL_ALLOW_PRIVATE'], config['LINK_UNFURL_USER_AGENT'])
+            status = 'ok'
+        except (UnfurlError, OSError, ValueError, http.client.HTTPException) as e:
+            # Cached too, so a dead or slow site is not retried on every post
+            current_app.logger.info('Could not unfurl %s: %s', url, e)
+            metadata, status = dict.fromkeys(META_KEYS), 'failed'
+
+        values = dict(metadata, url_hash=key, url=url[:1000], status=status, fetched_at=datetime.utcnow())
+        stmt = mysql_insert(table).values(**values)
+        with db.engine.begin() as conn:
+            conn.execute(stmt.on_duplicate_key_update(
+                **{name: stmt.inserted[name] for name in values if name != 'url_hash'}
+            ))
+        return values
+
+    def apply(self, preview, post_ids):
+        """Copy a preview into posts still linking to its URL, keeping fields their authors filled in"""
+        if not post_ids or preview['status'] != 'ok':
+            return
+        table = Post.__table__
+        with db.engine.begin() as conn:
+            for field, column_name in POST_COLUMNS.items():
+                if not preview[field]:
+                    continue
+                column = table.c[column_name]
+                # A preview is not an edit, so updated_at is left alone
+                conn.execute(table.update().where(
+                    table.c.post_id.in_(post_ids), table.c.link_url == preview['url'],
+                    or_(column.is_(None), column == '')
+                ).values({column: preview[field], table.c.updated_at: table.c.updated_at}))
+        fragment_cache.invalidate('post', *post_ids)
+
+
+link_unfurler = LinkUnfurler()
+
+
+@after_commit('pending_unfurls')
+def pending_unfurls(items):
+    for post_id, url in items:
+        link_unfurler.submit(post_id, url)
+
+
+@links_cli.command('unfurl')
+@click.argument('url')
+@click.option('--refresh', is_flag=True, help='Fetch again even if a cached preview is fresh.')
+def unfurl_command(url, refresh):
+    """Show the preview for URL, fetching it if it is not cached."""
+    preview = link_unfurler.preview(url, refresh=refresh)
+    for field in ('status', 'title', 'description', 'image_url', 'fetched_at'):
+        click.echo(f'{field}: {preview[field]}')
+
+
+@links_cli.command('backfill')
+@click.option('--batch-size', default=100, show_default=True, help='Posts loaded per query.')
+def backfill_command(batch_size):
+    """Unfurl existing link posts that have no title yet."""
+    last_id = filled = 0
+    while True:
+        rows = db.session.query(Post.post_id, Post.link_url).filter(
+            Post.post_id > last_id, Post.link_url.isnot(None), Post.link_url != '',
+            or_(Post.link_title.is_(None), Post.link_title == '')
+        ).order_by(Post.post_id).limit(batch_size).all()
+        if not rows:
+            break
+        for post_id, url in rows:
+            link_unfurler.apply(link_unfurler.preview(url), [post_id])
+            filled += 1
+        last_id = rows[-1][0]
+    click.echo(f'Unfurled {filled} link posts')
+
+
+@links_cli.command('purge')
+def purge_command():
+    """Delete cached previews older than LINK_UNFURL_CACHE_TTL."""
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config['LINK_UNFURL_CACHE_TTL'])
+    deleted = LinkPreview.query.filter(LinkPreview.fetched_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    click.echo(f'Deleted {deleted} expired link previews')
@@ -0,0 +1,156 @@
+"""
+Storage for resumable chunked uploads.
+
+Chunks must arrive in order. Each PUT streams its body to
+UPLOAD_TMP_FOLDER/<upload_id>.part in small blocks, so memory stays bounded
+whatever the file size. The SHA-256 is updated as the bytes go by. The
+running hash is kept per worker. A chunk that lands on another worker, or
+arrives after a restart, rebuilds it once from the part file. The database
+row's received offset is the source of truth; bytes past it, left behind by
+an interrupted chunk, are truncated before the next write.
+
+Writers of one upload are serialised by an flock on its part file, not by a
+row lock, so no transaction or pooled connection is held while a slow
+client sends its chunk. The offset only moves through a conditional UPDATE
+from the offset the chunk was written at.
+"""
+import fcntl
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from app import db
+from app.media_store import media_store
+from app.models import UploadSession
+
+uploads_cli = AppGroup('uploads', help='Chunked upload commands.')
+
+BLOCK_SIZE = 64 * 1024
+MAX_RUNNING_HASHES = 1000
+
+_hashes = OrderedDict()  # upload_id -> (offset, sha256 object)
+_hashes_lock = threading.Lock()
+
+
+class IncompleteChunk(Exception):
+    pass
+
+
+def part_path(upload_id):
+    return os.path.join(current_app.config['UPLOAD_TMP_FOLDER'], f'{upload_id}.part')
+
+
+def _hash_file(path, length):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        remaining = length
+        while remaining:
+            block = f.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+    return digest
+
+
+def _running_hash(upload_id, offset):
+    with _hashes_lock:
+        cached = _hashes.pop(upload_id, None)
+    if cached is not None and cached[0] == offset:
+        return cached[1]
+    return _hash_file(part_path(upload_id), offset) if offset else hashlib.sha256()
+
+
+def _remember_hash(upload_id, offset, digest):
+    with _hashes_lock:
+        _hashes[upload_id] = (offset, digest)
+        _hashes.move_to_end(upload_id)
+        while len(_hashes) > MAX_RUNNING_HASHES:
+            _hashes.popitem(last=False)
+
+
+@contextmanager
+def locked_part(upload_id):
+    """The part file opened for writing, locked against other writers on this host"""
+    path = part_path(upload_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield f
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def append_chunk(part, upload_id, offset, stream, length):
+    """Stream length bytes from stream onto the locked part file at offset"""
+    digest = _running_hash(upload_id, offset)
+    part.truncate(offset)
+    part.seek(offset)
+    remaining = length
+    while remaining:
+        block = stream.read(min(BLOCK_SIZE, remaining))
+        if not block:
+            break
+        part.write(block)
+        digest.update(block)
+        remaining -= len(block)
+    part.flush()
+    if remaining:
+        # The client went away mid-chunk; it resumes from the stored offset
+        raise IncompleteChunk(f'{length - remaining} of {length} bytes received')
+    _remember_hash(upload_id, offset + length, digest)
+
+
+def advance(upload_id, offset, length):
+    """Move the stored offset past a written chunk; False if it is no longer at offset"""
+    table = UploadSession.__table__
+    result = db.session.execute(
+        table.update()
+        .where(table.c.upload_id == upload_id)
+        .where(table.c.received == offset)
+        .values(received=offset + length)
+    )
+    return result.rowcount == 1
+
+
+def checksum(upload):
+    digest = _running_hash(upload.upload_id, upload.received)
+    _remember_hash(upload.upload_id, upload.received, digest)
+    return digest.hexdigest()
+
+
+def finish(upload, sha256):
+    """Move a complete upload into the media store; returns StoredMedia"""
+    stored = media_store.adopt(part_path(upload.upload_id), sha256, upload.total_size, upload.filename)
+    discard(upload.upload_id, remove_file=False)
+    return stored
+
+
+def discard(upload_id, remove_file=True):
+    with _hashes_lock:
+        _hashes.pop(upload_id, None)
+    if remove_file and os.path.exists(part_path(upload_id)):
+        os.remove(part_path(upload_id))
+
+
+@uploads_cli.command('purge')
+@click.option('--hours', type=int, default=None,
+              help='Age after which unfinished uploads are dropped (defaults to UPLOAD_SESSION_TTL_HOURS).')
+def purge_command(hours):
+    """Delete abandoned uploads and their part files."""
+    hours = hours or current_app.config['UPLOAD_SESSION_TTL_HOURS']
+    cutoff = datetime.utcnow() - timedelta(hours=hours)
+    stale = UploadSession.query.filter(UploadSession.updated_at < cutoff).all()
+    for upload in stale:
+        discard(upload.upload_id)
+        db.session.delete(upload)
+    db.session.commit()
+    click.echo(f'Purged {len(stale)} abandoned uploads')
@@ -0,0 +1,229 @@
+"""
+Resumable chunked upload API for post media and message attachments.
+
+    POST   /api/uploads                  {"filename", "size", "purpose": "post"|"message"}
+    GET    /api/uploads/<id>             current offset, to resume after a failure
+    PUT    /api/uploads/<id>             one chunk; Content-Range: bytes <start>-<end>/<size>
+    POST   /api/uploads/<id>/complete    {"sha256"?, post or message fields}
+    DELETE /api/uploads/<id>             abandon
+
+Chunks are streamed to disk (see chunked.py), so large videos never pass
+through MAX_CONTENT_LENGTH or sit in memory. Completing an upload creates
+the post or message exactly as the form routes do.
+"""
+import uuid
+from datetime import datetime
+
+from flask import current_app, jsonify, request, url_for
+from flask_login import current_user, login_required
+from werkzeug.http import parse_content_range_header
+from werkzeug.utils import secure_filename
+
+from app import db
+from app.feed import timeline_store
+from app.images import image_processor
+from app.media_store import media_kind
+from app.messages.inbox import private_conversation
+from app.models import Post, Message, User, UploadSession
+from app.notifications import notify
+from app.uploads import bp
+from app.uploads.chunked import IncompleteChunk, advance, append_chunk, checksum, discard, finish, locked_part
+
+def error(message, status):
+    return jsonify({'status': 'error', 'message': message}), status
+
+
+def upload_state(upload):
+    return {
+        'upload_id': upload.upload_id,
+        'offset': upload.received,
+        'size': upload.total_size,
+        'chunk_size': current_app.config['UPLOAD_CHUNK_SIZE'],
+        'url': url_for('uploads.upload_chunk', upload_id=upload.upload_id)
+    }
+
+
+def own_upload(upload_id, lock=False):
+    query = UploadSession.query.filter_by(upload_id=upload_id, user_id=current_user.user_id)
+    # Row lock serialises concurrent chunks for the same upload
+    return (query.with_for_update() if lock else query).first()
+
+
+@bp.route('', methods=['POST'])
+@login_required
+def create_upload():
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(data.get('filename') or '')
+    size = data.get('size')
+    purpose = data.get('purpose')
+    if purpose not in ('post', 'message'):
+        return error('purpose must be post or message', 400)
+    if '.' not in filename or filename.rsplit('.', 1)[1].lower() not in current_app.config['ALLOWED_EXTENSIONS']:
+        return error('File type not allowed', 400)
+    if not isinstance(size, int) or not 0 < size <= current_app.config['UPLOAD_MAX_SIZE']:
+        return error('Invalid file size', 413 if isinstance(size, int) and size > 0 else 400)
+
+    upload = UploadSession(upload_id=uuid.uuid4().hex, user_id=current_user.user_id, purpose=purpose,
+                           filename=filename, total_size=size, received=0)
+    db.session.add(upload)
+    db.session.commit()
+    return jsonify(upload_state(upload)), 201
+
+
+@bp.route('/<upload_id>', methods=['GET'])
+@login_required
+def upload_status(upload_id):
+    upload = own_upload(upload_id)
+    if upload is None:
+        return error('Upload not found', 404)
+    return jsonify(upload_state(upload))
+
+
+@bp.route('/<upload_id>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id):
+    content_range = parse_content_range_header(request.headers.get('Content-Range'))
+    if content_range is None or content_range.units != 'bytes':
+        return error('Content-Range: bytes <start>-<end>/<size> is required', 400)
+    length = content_range.stop - content_range.start
+    if request.content_length != length or length > current_app.config['UPLOAD_CHUNK_SIZE']:
+        return error('Chunk length does not match Content-Range or exceeds the chunk size', 400)
+
+    upload = own_upload(upload_id)
+    if upload is None:
+        return error('Upload not found', 404)
+    if content_range.length != upload.total_size or content_range.stop > upload.total_size:
+        return error('Content-Range does not match the upload size', 416)
+    # No transaction, row lock or pooled connection is held while the client sends the chunk;
+    # the upload's attributes expire here, so only upload_id is used below
+    db.session.rollback()
+
+    with locked_part(upload_id) as part:
+        # Another chunk may have landed, or the upload been abandoned, while we waited
+        upload = own_upload(upload_id)
+        if upload is None:
+            discard(upload_id)
+            return error('Upload not found', 404)
+        state = upload_state(upload)
+        if content_range.start != upload.received:
+            # Out of order or a retry of a stored chunk: tell the client where to resume
+            return jsonify(dict(state, status='error', message='Unexpected offset')), 409
+        db.session.rollback()
+
+        try:
+            append_chunk(part, upload_id, content_range.start, request.stream, length)
+        except IncompleteChunk as e:
+            return error(str(e), 400)
+        if not advance(upload_id, content_range.start, length):
+            # Abandoned meanwhile, or moved by a writer on another host
+            db.session.rollback()
+            return error('Upload offset changed, check its status and resume', 409)
+        db.session.commit()
+    return jsonify(dict(state, offset=content_range.stop))
+
+
+@bp.route('/<upload_id>', methods=['DELETE'])
+@login_required
+def abort_upload(upload_id):
+    upload = own_upload(upload_id, lock=True)
+    if upload is None:
+        db.session.rollback()
+        return error('Upload not found', 404)
+    discard(upload.upload_id)
+    db.session.delete(upload)
+    db.session.commit()
+    return jsonify({'status': 'success'})
+
+
+@bp.route('/<upload_id>/complete', methods=['POST'])
+@login_required
+def complete_upload(upload_id):
+    data = request.get_json(silent=True) or {}
+    upload = own_upload(upload_id, lock=True)
+    if upload is None:
+        db.session.rollback()
+        return error('Upload not found', 404)
+    if upload.received != upload.total_size:
+        state = upload_state(upload)
+        db.session.rollback()
+        return jsonify(dict(state, status='error', message='Upload is not complete')), 409
+
+    digest = checksum(upload)
+    if data.get('sha256') and data['sha256'].lower() != digest:
+        discard(upload.upload_id)
+        db.session.delete(upload)
+        db.session.commit()
+        return error('Checksum mismatch, upload discarded', 422)
+
+    if upload.purpose == 'post':
+        result = complete_post(upload, data, digest)
+    else:
+        result = complete_message(upload, data, digest)
+    if isinstance(result, tuple):
+        db.session.rollback()
+        return result
+    result['sha256'] = digest
+    return jsonify(result), 201
+
+
+def complete_post(upload, data, digest):
+    content = (data.get('content') or '').strip()
+    visibility = data.get('visibility', 'public')
+    if not content:
+        return error('Post content is required', 400)
+    if visibility not in ('public', 'connections', 'private'):
+        return error('Invalid visibility', 400)
+
+    post = Post(
+        user_id=current_user.user_id,
+        content=content,
+        post_type=media_kind(upload.filename),
+        visibility=visibility,
+        allow_comments=bool(data.get('allow_comments', True)),
+        media_url=finish(upload, digest).media_url
+    )
+    db.session.add(post)
+    db.session.delete(upload)
+    db.session.flush()
+    timeline_store.fan_out_post(post)
+    image_processor.process_after_commit(post.media_url, owner=('post', post.post_id))
+    db.session.commit()
+    return {'status': 'success', 'post_id': post.post_id,
+            'url': url_for('posts.view_post', id=post.post_id)}
+
+
+def complete_message(upload, data, digest):
+    recipient = User.query.get(data.get('recipient_id') or 0)
+    if recipient is None:
+        return error('Recipient not found', 404)
+
+    conversation = private_conversation(current_user, recipient)
+    message_type = 'image' if media_kind(upload.filename) == 'image' else 'file'
+    message = Message(
+        conversation_id=conversation.conversation_id,
+        sender_id=current_user.user_id,
+        content=data.get('content') or '',
+        message_type=message_type,
+        file_name=upload.filename,
+        file_size=upload.total_size,
+        media_url=finish(upload, digest).media_url
+    )
+    db.session.add(message)
+    db.session.delete(upload)
+    conversation.updated_at = datetime.utcnow()
+    image_processor.process_after_commit(message.media_url)
+
+    notify(
+        user_id=recipient.user_id,
+        type='message',
+        title=f'New message from {current_user.get_full_name()}',
+        message=f'{current_user.get_full_name()} sent you {upload.filename}',
+        related_user_id=current_user.user_id,
+        action_url=url_for('messages.view_conversation', conversation_id=conversation.conversation_id),
+        actor_name=current_user.get_full_name()
+    )
+    db.session.commit()
+    return {'status': 'success', 'message_id': message.message_id,
+            'conversation_id': conversation.conversation_id,
+            'url': url_for('messages.view_conversation', conversation_id=conversation.conversation_id)}
+
@@ -21,12 +21,100 @@ class Config:
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
     UPLOAD_FOLDER = os.path.join(basedir, 'app', 'static', 'uploads')
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf', 'doc', 'docx', 'mp4', 'avi', 'mov'}
+    # Chunked uploads (/api/uploads): each chunk must fit within MAX_CONTENT_LENGTH
+    UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+    UPLOAD_MAX_SIZE = 2 * 1024 * 1024 * 1024  # 2GB per file
+    UPLOAD_TMP_FOLDER = os.path.join(basedir, 'instance', 'upload-parts')
+    UPLOAD_SESSION_TTL_HOURS = 24  # `flask uploads purge` drops unfinished uploads older than this
+    IMAGE_PROCESSING_ASYNC = True  # False processes uploads on the committing thread
+    IMAGE_PROCESSING_WORKERS = 2  # processes resizing uploads per app worker
+    # Media serving (app/media): content-hashed uploads are cached as immutable, others for this long
+    MEDIA_CACHE_MAX_AGE = 3600
+    # Hand file bodies to the front server: USE_X_SENDFILE for Apache/lighttpd, or an nginx internal location
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE', 'false').lower() in ['true', 'on', '1']
+    MEDIA_ACCEL_REDIRECT_PREFIX = os.environ.get('MEDIA_ACCEL_REDIRECT_PREFIX')  # e.g. /_uploads/
 
     # Pagination Configuration
     POSTS_PER_PAGE = 10
     USERS_PER_PAGE = 12
     MESSAGES_PER_PAGE = 50
 
+    # Event Push Configuration
+    # Leave EVENT_BUS_URL unset for a single process; point every worker at
+    # `flask events broker` (host:port) when running several workers.
+    EVENT_BUS_URL = os.environ.get('EVENT_BUS_URL')
+    # Shared secret for the broker. Unset, the broker only listens on loopback (see app/broker.py)
+    EVENT_BUS_AUTHKEY = os.environ.get('EVENT_BUS_AUTHKEY')
+    EVENT_STREAM_TIMEOUT = 55  # seconds before the client reconnects
+    EVENT_STREAM_HEARTBEAT = 15
+
+    # Home Feed Configuration
+    FEED_MAX_LENGTH = 800  # entries kept per user timeline
+    FEED_FANOUT_LIMIT = 5000  # authors with more connections are merged at read time
+    FEED_BACKFILL_SIZE = 50  # posts copied into timelines when users connect
+    FEED_PULL_AUTHORS_TTL = 300
+
+    # Search Configuration: 'local' (in-memory inverted index) or 'database' (MySQL FULLTEXT)
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or 'local'
+    TYPEAHEAD_RANK_CONNECTIONS = True  # list existing connections first in the recipient picker
+
+    # Connection Graph Cache
+    GRAPH_CACHE_SIZE = 10000  # users whose adjacency is kept per worker
+    GRAPH_CACHE_TTL = 300
+
+    # Session User Cache
+    USER_CACHE_SIZE = 10000  # signed-in users whose light columns are kept per worker
+    USER_CACHE_TTL = 30
+
+    # People You May Know Configuration
+    SUGGESTIONS_PER_USER = 50  # candidates stored per user by `flask suggestions refresh`
+    SUGGESTION_CANDIDATE_LIMIT = 500  # best matches read per signal before scoring
+    SUGGESTION_WEIGHTS = {'mutual': 4, 'company': 3, 'school': 2, 'skill': 1}
+    SUGGESTIONS_REFRESH_HOURS = 24  # pages recompute a user's suggestions at most this often
+    MUTUALS_TOP_K = 200  # mutual-connection counts kept per user by `flask suggestions mutuals`
+
+    # Notification Pipeline Configuration
+    NOTIFY_ASYNC = True  # False writes notifications on the committing thread
+    NOTIFY_FLUSH_INTERVAL = 1.0  # seconds the worker collects events before writing a batch
+    NOTIFY_BATCH_SIZE = 500
+    NOTIFICATION_COMPACT_AFTER_DAYS = 14  # read notifications older than this are merged per post
+    NOTIFICATION_RETENTION_DAYS = 180  # older notifications leave the live table
+    NOTIFICATION_ARCHIVE = True  # move expired notifications to archived_notifications instead of deleting
+
+    # Profile View Tracking Configuration
+    PROFILE_VIEW_ASYNC = True
+    PROFILE_VIEW_FLUSH_INTERVAL = 2.0
+    PROFILE_VIEW_BATCH_SIZE = 1000
+    PROFILE_VIEW_BLOOM_BITS = 8 * 1024 * 1024  # per worker per day (1 MiB, ~1% false positives at 870k views)
+    PROFILE_VIEW_BLOOM_HASHES = 7
+    PROFILE_VIEW_STATS_DAYS = 90
+
+    # Fragment Cache Configuration: 'local' (per-worker LRU), 'server' (`flask fragments server`) or 'null'
+    FRAGMENT_CACHE_BACKEND = os.environ.get('FRAGMENT_CACHE_BACKEND') or 'local'
+    FRAGMENT_CACHE_URL = os.environ.get('FRAGMENT_CACHE_URL') or 'localhost:6390'
+    FRAGMENT_CACHE_AUTHKEY = os.environ.get('FRAGMENT_CACHE_AUTHKEY')  # required unless the server is on loopback
+    FRAGMENT_CACHE_SIZE = 20000  # rendered fragments kept before the least recently used is evicted
+
+    # HTTP Caching Configuration (pages for logged-out visitors and crawlers)
+    HTTP_CACHE_ENABLED = True
+    HTTP_CACHE_CONTROL = {  # Cache-Control per blueprint
+        'main': 'public, max-age=300, stale-while-revalidate=60',
+        'profile': 'public, max-age=60, stale-while-revalidate=300',
+        'default': 'public, max-age=60',
+    }
+    HTTP_CACHE_PRIVATE = 'private, no-cache'  # signed-in responses from the same URLs
+
+    # Link Preview Configuration (app/unfurl.py): OpenGraph metadata fetched for new link posts
+    LINK_UNFURL_ENABLED = True
+    LINK_UNFURL_ASYNC = True  # False fetches on the committing thread
+    LINK_UNFURL_WORKERS = 4  # fetch threads per app worker
+    LINK_UNFURL_TIMEOUT = 3  # seconds per socket operation and for reading the whole page
+    LINK_UNFURL_MAX_BYTES = 512 * 1024  # HTML read before giving up on finding </head>
+    LINK_UNFURL_CACHE_TTL = 24 * 3600  # a URL is fetched again after this many seconds
+    LINK_UNFURL_FAILURE_TTL = 3600  # failed fetches are retried sooner
+    LINK_UNFURL_ALLOW_PRIVATE = False  # True allows localhost/private addresses, e.g. a test stub server
+    LINK_UNFURL_USER_AGENT = os.environ.get('LINK_UNFURL_USER_AGENT') or 'LinkedInCloneBot/1.0 (link preview)'
+
     # Email Configuration (Optional)
     MAIL_SERVER = os.environ.get('MAIL_SERVER') or 'smtp.gmail.com'
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 587)
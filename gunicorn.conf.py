@@ -0,0 +1,21 @@
+"""
+Gunicorn settings, read automatically when gunicorn starts in this directory:
+
+    gunicorn run:app
+
+Every signed-in page keeps an /api/events stream open for up to
+EVENT_STREAM_TIMEOUT seconds. The default sync worker serves one request at
+a time, so a single open tab would hold a whole worker. The gthread worker
+serves each request on a thread from a per-worker pool instead; an idle
+stream costs one thread and no database connection.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+# Open event streams plus ordinary requests per worker
+threads = int(os.environ.get('GUNICORN_THREADS', 64))
+# Let open event streams end on their own when workers are restarted
+graceful_timeout = 60
@@ -0,0 +1,81 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import create_app, db
+from config import Config
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URI')
+    WTF_CSRF_ENABLED = False
+    # Everything that would write on a background thread runs inline or not at all
+    NOTIFY_ASYNC = False
+    PROFILE_VIEW_ASYNC = False
+    IMAGE_PROCESSING_ASYNC = False
+    LINK_UNFURL_ENABLED = False
+    # Post cards are rendered on every request so their queries are counted
+    FRAGMENT_CACHE_BACKEND = 'null'
+    HTTP_CACHE_ENABLED = False
+
+
+@pytest.fixture(scope='session')
+def app():
+    if not TestingConfig.SQLALCHEMY_DATABASE_URI:
+        pytest.skip('Set TEST_DATABASE_URI to an empty scratch MySQL database, '
+                    'e.g. mysql+pymysql://root:@localhost/linkedin_test')
+    app = create_app(TestingConfig)
+    # No app context is held across tests, so each request gets a fresh session as in production
+    with app.app_context():
+        db.create_all()
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture(scope='session')
+def network(app):
+    """A viewer connected to three authors with 30 public posts, some liked and commented on"""
+    from app.feed import timeline_store
+    from app.models import User, Connection, Post, PostReaction, Comment
+
+    with app.app_context():
+        users = [User(username=name, email=f'{name}@example.com', first_name=name.capitalize(), last_name='Test')
+                 for name in ('viewer', 'author0', 'author1', 'author2')]
+        for user in users:
+            user.set_password('password')
+        db.session.add_all(users)
+        db.session.flush()
+        viewer, authors = users[0], users[1:]
+        for author in authors:
+            db.session.add(Connection(requester_id=viewer.user_id, requested_id=author.user_id, status='accepted'))
+
+        start = datetime.utcnow() - timedelta(days=1)
+        for i in range(30):
+            author = authors[i % len(authors)]
+            post = Post(user_id=author.user_id, content=f'Post {i}', visibility='public',
+                        created_at=start + timedelta(minutes=i))
+            db.session.add(post)
+            db.session.flush()
+            timeline_store.fan_out_post(post)
+            if i % 2:
+                db.session.add(PostReaction(post_id=post.post_id, user_id=viewer.user_id, reaction_type='like'))
+                Post.adjust_counters(post.post_id, reaction_count=1, like_count=1)
+            if i % 3 == 0:
+                commenter = authors[(i + 1) % len(authors)]
+                db.session.add(Comment(post_id=post.post_id, user_id=commenter.user_id, content='Nice post'))
+                Post.adjust_counters(post.post_id, comment_count=1)
+        db.session.commit()
+        return {'viewer_id': viewer.user_id, 'author_usernames': [author.username for author in authors]}
+
+
+@pytest.fixture
+def client(app, network):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(network['viewer_id'])
+        session['_fresh'] = True
+    return client
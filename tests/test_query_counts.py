@@ -0,0 +1,84 @@
+"""
+The post list pages must cost the same number of queries whatever the
+page size. A count that grows with the page means an N+1 query is back.
+"""
+import re
+from contextlib import contextmanager
+
+import pytest
+from flask import url_for
+from sqlalchemy import event as sa_event
+
+from app import db
+
+PAGE_SIZES = (3, 8)
+POST_LINK_RE = re.compile(r'/posts/post/(\d+)"')
+
+PAGES = [
+    ('main.index', {}),
+    ('main.explore', {}),
+    ('profile.view_profile', {'username': 'author0'}),
+]
+
+
+@contextmanager
+def count_statements(app):
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    sa_event.listen(engine, 'before_cursor_execute', count)
+    try:
+        yield statements
+    finally:
+        sa_event.remove(engine, 'before_cursor_execute', count)
+
+
+@pytest.mark.parametrize('endpoint, args', PAGES, ids=[endpoint for endpoint, _ in PAGES])
+def test_query_count_does_not_grow_with_page_size(app, client, endpoint, args, monkeypatch):
+    with app.test_request_context():
+        url = url_for(endpoint, **args)
+
+    counts = {}
+    for size in PAGE_SIZES:
+        monkeypatch.setitem(app.config, 'POSTS_PER_PAGE', size)
+        # Warm the per-worker caches (identity, connection graph, suggestions, view dedup) first
+        assert client.get(url).status_code == 200
+        with count_statements(app) as statements:
+            response = client.get(url)
+        assert response.status_code == 200
+        assert len(set(POST_LINK_RE.findall(response.get_data(as_text=True)))) == size
+        counts[size] = len(statements)
+
+    small, large = PAGE_SIZES
+    assert counts[small] == counts[large], (
+        f'{endpoint}: {counts[small]} queries for {small} posts but {counts[large]} for {large}'
+    )
+
+
+def test_stale_suggestions_do_not_reload_the_home_feed(app, client, network, monkeypatch):
+    """The first home page of the day recomputes suggestions without expiring the loaded posts"""
+    from app.models import SuggestionRefresh
+
+    with app.test_request_context():
+        url = url_for('main.index')
+
+    counts = {}
+    for size in PAGE_SIZES:
+        monkeypatch.setitem(app.config, 'POSTS_PER_PAGE', size)
+        assert client.get(url).status_code == 200
+        with app.app_context():
+            SuggestionRefresh.query.filter_by(user_id=network['viewer_id']).delete()
+            db.session.commit()
+        with count_statements(app) as statements:
+            response = client.get(url)
+        assert response.status_code == 200
+        counts[size] = len(statements)
+
+    small, large = PAGE_SIZES
+    assert counts[small] == counts[large], (
+        f'{counts[small]} queries for {small} posts but {counts[large]} for {large} while refreshing suggestions'
+    )
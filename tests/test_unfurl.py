@@ -0,0 +1,191 @@
+"""
+Link unfurling against a stub HTTP server on localhost.
+
+The fetch tests need no database. The caching and post tests use the app
+fixture, so they run only when TEST_DATABASE_URI is set.
+"""
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app import db
+from app.unfurl import UnfurlError, fetch_metadata, link_unfurler, url_hash
+
+ARTICLE = b'''<!doctype html>
+<html><head>
+<title>Fallback title</title>
+<meta property="og:title" content="Stub &amp; Article">
+<meta name="twitter:title" content="Twitter title">
+<meta name="description" content="Plain description">
+<meta property="og:image" content="/images/cover.png">
+</head><body><meta property="og:description" content="Ignored, in the body"></body></html>
+'''
+
+PLAIN = b'<html><head><title>\n  Only a\n  title </title><meta name="description" content="Described"></head></html>'
+
+PADDING = b'<!--' + b'x' * 64 * 1024 + b'-->'
+LARGE = b'<html><head><title>Large</title>' + PADDING + b'<meta property="og:description" content="Late"></head></html>'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send_page(self, body, content_type='text/html; charset=utf-8'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.hits[self.path] += 1
+        if self.path == '/article':
+            self.send_page(ARTICLE)
+        elif self.path == '/plain':
+            self.send_page(PLAIN)
+        elif self.path == '/large':
+            self.send_page(LARGE)
+        elif self.path == '/image.png':
+            self.send_page(b'\x89PNG', 'image/png')
+        elif self.path == '/stall':
+            # Headers, then nothing: the socket timeout has to fire
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.end_headers()
+            self.wfile.write(b'<html><head>')
+            self.wfile.flush()
+            time.sleep(3)
+        elif self.path == '/trickle':
+            # A byte at a time, each well within the socket timeout: only the overall deadline stops it
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.end_headers()
+            try:
+                for _ in range(40):
+                    self.wfile.write(b' ')
+                    self.wfile.flush()
+                    time.sleep(0.1)
+            except OSError:
+                pass
+        else:
+            self.send_error(404)
+
+
+@pytest.fixture(scope='module')
+def stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.hits = Counter()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_extracts_opengraph_metadata(stub):
+    metadata = fetch_metadata(stub.url + '/article', allow_private=True)
+    assert metadata == {
+        'title': 'Stub & Article',
+        'description': 'Plain description',
+        'image_url': stub.url + '/images/cover.png',
+    }
+
+
+def test_falls_back_to_title_and_description(stub):
+    metadata = fetch_metadata(stub.url + '/plain', allow_private=True)
+    assert metadata == {'title': 'Only a title', 'description': 'Described', 'image_url': None}
+
+
+def test_non_html_is_not_parsed(stub):
+    assert fetch_metadata(stub.url + '/image.png', allow_private=True) == dict.fromkeys(
+        ('title', 'description', 'image_url'))
+
+
+def test_reads_at_most_max_bytes(stub):
+    capped = fetch_metadata(stub.url + '/large', max_bytes=16 * 1024, allow_private=True)
+    assert capped['title'] == 'Large'
+    assert capped['description'] is None
+    assert fetch_metadata(stub.url + '/large', max_bytes=len(LARGE), allow_private=True)['description'] == 'Late'
+
+
+def test_stalled_server_times_out(stub):
+    started = time.monotonic()
+    with pytest.raises(OSError):
+        fetch_metadata(stub.url + '/stall', timeout=0.5, allow_private=True)
+    assert time.monotonic() - started < 2
+
+
+def test_trickling_server_hits_the_deadline(stub):
+    started = time.monotonic()
+    with pytest.raises(UnfurlError):
+        fetch_metadata(stub.url + '/trickle', timeout=0.5, allow_private=True)
+    assert time.monotonic() - started < 2
+
+
+def test_private_addresses_are_refused_unless_allowed(stub):
+    hits = stub.hits['/article']
+    with pytest.raises(UnfurlError):
+        fetch_metadata(stub.url + '/article')
+    with pytest.raises(UnfurlError):
+        fetch_metadata(stub.url.replace('127.0.0.1', 'localhost') + '/article')
+    assert stub.hits['/article'] == hits  # refused before any request was sent
+    assert fetch_metadata(stub.url + '/article', allow_private=True)['title'] == 'Stub & Article'
+
+
+@pytest.fixture
+def unfurler(app, monkeypatch):
+    """The app's unfurler, enabled and running on the calling thread, allowed to reach the stub"""
+    monkeypatch.setattr(link_unfurler, 'enabled', True)
+    monkeypatch.setattr(link_unfurler, 'asynchronous', False)
+    monkeypatch.setitem(app.config, 'LINK_UNFURL_ALLOW_PRIVATE', True)
+    return link_unfurler
+
+
+def test_previews_are_cached(app, stub, unfurler):
+    from app.models import LinkPreview
+
+    url = stub.url + '/plain'
+    with app.app_context():
+        hits = stub.hits['/plain']
+        first = unfurler.preview(url)
+        second = unfurler.preview(url)
+        assert first['status'] == second['status'] == 'ok'
+        assert second['title'] == 'Only a title'
+        assert stub.hits['/plain'] == hits + 1
+        assert LinkPreview.query.get(url_hash(url)) is not None
+
+        unfurler.preview(url, refresh=True)
+        assert stub.hits['/plain'] == hits + 2
+
+
+def test_refused_fetches_are_cached_as_failed(app, stub, monkeypatch):
+    monkeypatch.setattr(link_unfurler, 'enabled', True)
+    url = stub.url + '/article?private'
+    with app.app_context():
+        assert link_unfurler.preview(url)['status'] == 'failed'
+        assert link_unfurler.preview(url)['status'] == 'failed'
+    assert stub.hits['/article?private'] == 0
+
+
+def test_new_link_post_is_filled_in(app, client, network, stub, unfurler):
+    from app.models import Post
+
+    url = stub.url + '/article'
+    response = client.post('/posts/create', data={
+        'content': 'Worth a read', 'post_type': 'link', 'link_url': url,
+        'link_description': 'My own summary', 'visibility': 'private', 'allow_comments': 'y',
+    })
+    assert response.status_code == 302
+
+    with app.app_context():
+        post = Post.query.filter_by(link_url=url).order_by(Post.post_id.desc()).first()
+        assert post.link_title == 'Stub & Article'
+        assert post.link_description == 'My own summary'  # what the author typed is kept
+        assert post.link_image_url == stub.url + '/images/cover.png'
+        db.session.remove()